@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Measures per address cost of address parsing in request handlers: pytonlib parsing against
+the memoized forms, for single addresses and for detectAddresses batches with a share of
+hot addresses.
+
+Usage: python benchmarks/address_cache.py --addresses 20000 --hot-ratios 0 0.5 0.9 --cache-size 100000
+"""
+import argparse
+import asyncio
+import inspect
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from pytonlib.utils.address import detect_address, prepare_address
+
+
+def make_addresses(count):
+    raw = [f'{random.choice([0, -1])}:{os.urandom(32).hex()}' for _ in range(count)]
+    return [random.choice([a, detect_address(a)['bounceable']['b64url'], detect_address(a)['non_bounceable']['b64']]) for a in raw]
+
+
+def workload(addresses, hot, count, hot_ratio):
+    return [random.choice(hot) if random.random() < hot_ratio else random.choice(addresses) for _ in range(count)]
+
+
+def per_address_us(func, addresses):
+    start = time.perf_counter()
+    for address in addresses:
+        func(address)
+    return (time.perf_counter() - start) / len(addresses) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser('address_cache')
+    parser.add_argument('--addresses', type=int, default=20000, help='Number of distinct addresses')
+    parser.add_argument('--hot', type=int, default=1000, help='Number of hot addresses')
+    parser.add_argument('--hot-ratios', type=float, nargs='+', default=[0, 0.5, 0.9], help='Shares of requests to hot addresses')
+    parser.add_argument('--requests', type=int, default=50000, help='Number of addresses per measurement')
+    parser.add_argument('--cache-size', type=int, default=100000, help='Address cache size')
+    parser.add_argument('--batch', type=int, default=1000, help='Number of addresses per detectAddresses call')
+    args = parser.parse_args()
+
+    os.environ['TON_API_ADDRESS_CACHE_SIZE'] = str(args.cache_size)
+    os.environ['TON_API_MAX_BULK_ADDRESSES'] = str(args.batch)
+    from pyTON.main import _parse_address, prepare_address as cached_prepare_address, detect_addresses
+
+    addresses = make_addresses(args.addresses)
+    hot = addresses[:args.hot]
+
+    print(f'{"hot_ratio":>9} {"function":>16} {"uncached_us":>11} {"cached_us":>9} {"speedup":>7} {"hit_rate":>8} {"hit_us":>6}')
+    for hot_ratio in args.hot_ratios:
+        requests = workload(addresses, hot, args.requests, hot_ratio)
+        for name, plain, cached in [('detect_address', detect_address, _parse_address),
+                                    ('prepare_address', prepare_address, cached_prepare_address)]:
+            _parse_address.cache_clear()
+            uncached_us = per_address_us(plain, requests)
+            cached_us = per_address_us(cached, requests)
+            info = _parse_address.cache_info()
+            per_address_us(cached, hot)
+            hit_us = per_address_us(cached, hot)
+            print(f'{hot_ratio:>9.2f} {name:>16} {uncached_us:>11.2f} {cached_us:>9.2f} {uncached_us / cached_us:>7.1f} {info.hits / (info.hits + info.misses):>8.2f} {hit_us:>6.2f}')
+
+        _parse_address.cache_clear()
+        handler = inspect.unwrap(detect_addresses)
+        batches = [requests[i:i + args.batch] for i in range(0, len(requests), args.batch)]
+        start = time.perf_counter()
+        for batch in batches:
+            asyncio.run(handler(batch))
+        batch_us = (time.perf_counter() - start) / len(requests) * 1e6
+        print(f'{hot_ratio:>9.2f} {"detectAddresses":>16} {"":>11} {batch_us:>9.2f} {"":>7} {"":>8} {"":>6}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Measures bandwidth and latency impact of response compression on getBlockTransactionsExt,
+getTransactions and getAddressInformation responses: compressed size and compression time
+per encoding, and event loop lag while concurrent responses are compressed inline or in
+the thread pool.
+
+Responses are synthetic by default. Pass --api-url to take real responses from a running API.
+
+Usage: python benchmarks/compression.py --requests 200 --concurrency 32
+       python benchmarks/compression.py --api-url https://toncenter.com/api/v2 --address <address>
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import requests
+
+from pyTON.middleware import CompressionMiddleware
+from pyTON.settings import CompressionSettings
+
+
+def random_boc(size):
+    # cells of real BOCs are partly zero padded and repeat prefixes
+    data = bytearray(os.urandom(size))
+    for i in range(0, size, 4):
+        if random.random() < 0.4:
+            data[i:i + 4] = b'\x00\x00\x00\x00'
+    return base64.b64encode(bytes(data)).decode('utf-8')
+
+
+def random_hash():
+    return base64.b64encode(os.urandom(32)).decode('utf-8')
+
+
+def random_address():
+    return '0:' + os.urandom(32).hex().upper()
+
+
+def make_message(source, destination):
+    return {'@type': 'raw.message', 'source': source, 'destination': destination, 'value': str(random.randint(1, 10**10)),
+            'fwd_fee': '666672', 'ihr_fee': '0', 'created_lt': str(random.randint(10**13, 10**14)), 'body_hash': random_hash(),
+            'msg_data': {'@type': 'msg.dataRaw', 'body': random_boc(random.randint(20, 300)), 'init_state': ''}, 'message': ''}
+
+
+def make_transaction(account):
+    return {'@type': 'raw.transaction', 'address': {'@type': 'accountAddress', 'account_address': account},
+            'utime': int(time.time()), 'data': random_boc(random.randint(400, 1200)),
+            'transaction_id': {'@type': 'internal.transactionId', 'lt': str(random.randint(10**13, 10**14)), 'hash': random_hash()},
+            'fee': '5521868', 'storage_fee': '21868', 'other_fee': '5500000',
+            'in_msg': make_message(random_address(), account),
+            'out_msgs': [make_message(account, random_address()) for _ in range(random.randint(0, 2))]}
+
+
+def synthetic_responses():
+    account = random_address()
+    block = {'@type': 'blocks.transactionsExt', 'id': {'@type': 'ton.blockIdExt', 'workchain': 0, 'shard': '-9223372036854775808',
+                                                       'seqno': 40000000, 'root_hash': random_hash(), 'file_hash': random_hash()},
+             'req_count': 256, 'incomplete': False,
+             'transactions': [make_transaction(random_address()) for _ in range(200)]}
+    return {
+        'getBlockTransactionsExt': {'ok': True, 'result': block},
+        'getTransactions': {'ok': True, 'result': [make_transaction(account) for _ in range(10)]},
+        'getAddressInformation': {'ok': True, 'result': {'@type': 'raw.fullAccountState', 'balance': '123456789', 'extra_currencies': [],
+                                                         'code': random_boc(6000), 'data': random_boc(1500),
+                                                         'last_transaction_id': {'@type': 'internal.transactionId', 'lt': '1', 'hash': random_hash()},
+                                                         'frozen_hash': '', 'sync_utime': int(time.time()), 'state': 'active'}},
+    }
+
+
+def real_responses(api_url, address, block):
+    workchain, shard, seqno = block.split(':')
+    requests_params = {
+        'getBlockTransactionsExt': {'workchain': workchain, 'shard': shard, 'seqno': seqno, 'count': 256},
+        'getTransactions': {'address': address, 'limit': 10},
+        'getAddressInformation': {'address': address},
+    }
+    return {method: requests.get(f'{api_url.rstrip("/")}/{method}', params=params).json() for method, params in requests_params.items()}
+
+
+def payload_app(body):
+    async def app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'application/json'),
+                                                                             (b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body', 'body': body})
+    return app
+
+
+async def serve(middleware, encoding, lag):
+    scope = {'type': 'http', 'headers': [(b'accept-encoding', encoding.encode())]}
+    size = 0
+
+    async def send(message):
+        nonlocal size
+        if message['type'] == 'http.response.body':
+            size += len(message['body'])
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    start = time.perf_counter()
+    await middleware(scope, receive, send)
+    return time.perf_counter() - start, size
+
+
+async def measure_lag(body, encoding, threaded, requests_count, concurrency):
+    settings = CompressionSettings(thread_min_size=0 if threaded else 2**62)
+    middleware = CompressionMiddleware(payload_app(body), settings)
+    lags = []
+    running = True
+
+    async def ticker():
+        while running:
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - start - 0.001)
+
+    ticker_task = asyncio.ensure_future(ticker())
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            return await serve(middleware, encoding, lags)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[one() for _ in range(requests_count)])
+    elapsed = time.perf_counter() - start
+    running = False
+    await ticker_task
+    middleware.executor.shutdown()
+    latencies = sorted(r[0] for r in results)
+    return {'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+            'rps': requests_count / elapsed,
+            'max_lag_ms': max(lags) * 1000 if lags else 0}
+
+
+def main():
+    parser = argparse.ArgumentParser('compression')
+    parser.add_argument('--requests', type=int, default=200, help='Number of responses per measurement')
+    parser.add_argument('--concurrency', type=int, default=32, help='Number of responses compressed concurrently')
+    parser.add_argument('--api-url', type=str, default=None, help='Take responses from a running API instead of synthetic ones')
+    parser.add_argument('--address', type=str, default=None, help='Account for getTransactions and getAddressInformation with --api-url')
+    parser.add_argument('--block', type=str, default='-1:-9223372036854775808:40000000', help='workchain:shard:seqno for getBlockTransactionsExt with --api-url')
+    args = parser.parse_args()
+
+    responses = real_responses(args.api_url, args.address, args.block) if args.api_url else synthetic_responses()
+    encodings = list(CompressionMiddleware(None, CompressionSettings()).encoders)
+
+    print(f'{"method":>24} {"encoding":>8} {"bytes":>9} {"ratio":>6} {"compress_ms":>11}')
+    for method, response in responses.items():
+        body = json.dumps(response).encode('utf-8')
+        print(f'{method:>24} {"identity":>8} {len(body):>9} {1:>6.2f} {0:>11.2f}')
+        middleware = CompressionMiddleware(None, CompressionSettings())
+        for encoding in encodings:
+            times = []
+            for _ in range(20):
+                start = time.perf_counter()
+                compressed = middleware.encoders[encoding](body)
+                times.append(time.perf_counter() - start)
+            print(f'{method:>24} {encoding:>8} {len(compressed):>9} {len(compressed) / len(body):>6.2f} {statistics.median(times) * 1000:>11.2f}')
+        middleware.executor.shutdown()
+
+    print()
+    print(f'{"method":>24} {"encoding":>8} {"mode":>8} {"p50_ms":>7} {"p99_ms":>7} {"rps":>8} {"max_lag_ms":>10}')
+    for method, response in responses.items():
+        body = json.dumps(response).encode('utf-8')
+        for encoding in ['identity'] + encodings:
+            for threaded in ([False, True] if encoding != 'identity' else [False]):
+                r = asyncio.run(measure_lag(body, encoding, threaded, args.requests, args.concurrency))
+                mode = 'thread' if threaded else 'inline'
+                print(f'{method:>24} {encoding:>8} {mode:>8} {r["p50_ms"]:>7.2f} {r["p99_ms"]:>7.2f} {r["rps"]:>8.0f} {r["max_lag_ms"]:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Measures logging cost per request of the TonlibManager hot path: previous pipeline
+(unconditional records, enqueue=True) against level checks, sampling and batched writer.
+
+Usage: python benchmarks/logging_overhead.py --requests 100000 --levels WARNING INFO --sample-rates 1 0.1
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from loguru import logger
+
+from pyTON.logs import setup_logging, log_enabled, sampled
+from pyTON.manager import TonlibManager
+from pyTON.models import TonlibClientResult
+from pyTON.settings import LoggingSettings
+
+
+def make_results(count):
+    return [TonlibClientResult(f'{time.time()}:{random.random()}',
+                               'raw_get_account_state',
+                               elapsed_time=0.01,
+                               ls_index=random.randint(0, 15),
+                               result={'@type': 'raw.fullAccountState', 'balance': '1'})
+            for _ in range(count)]
+
+
+def request_old(manager, task_result):
+    logger.info("Sending request method: {method}, task_id: {task_id}, ls_index: {ls_index}",
+        method=task_result.method, task_id=task_result.task_id, ls_index=task_result.ls_index)
+    rec = {
+        'timestamp': datetime.utcnow(),
+        'elapsed': task_result.elapsed_time,
+        'task_id': task_result.task_id,
+        'method': task_result.method,
+        'ls_index': task_result.ls_index,
+        'result_type': task_result.result.get('@type', 'unknown'),
+        'exception': task_result.exception
+    }
+    logger.info("Received result of type: {result_type}, method: {method}, task_id: {task_id}", **rec)
+
+
+def request_new(manager, task_result):
+    if log_enabled('INFO') and sampled(task_result.task_id):
+        logger.info("Sending request method: {method}, task_id: {task_id}, ls_index: {ls_index}",
+            method=task_result.method, task_id=task_result.task_id, ls_index=task_result.ls_index)
+    manager.log_liteserver_task(task_result)
+
+
+def measure(mode, level, sample_rate, results):
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    if mode == 'old':
+        # previous pipeline: no level check before building records, queue hop per line
+        setup_logging(LoggingSettings(jsonify=False, level='TRACE'), devnull)
+        logger.remove()
+        logger.add(os.fdopen(devnull, 'w'), level=level, enqueue=True)
+        request = request_old
+    else:
+        setup_logging(LoggingSettings(jsonify=False, level=level, sample_rate=sample_rate), devnull)
+        request = request_new
+    manager = object.__new__(TonlibManager)
+
+    start = time.perf_counter()
+    for task_result in results:
+        request(manager, task_result)
+    logger.complete()
+    elapsed = time.perf_counter() - start
+    logger.remove()
+    return elapsed / len(results) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser('logging_overhead')
+    parser.add_argument('--requests', type=int, default=100000, help='Number of simulated requests')
+    parser.add_argument('--levels', type=str, nargs='+', default=['WARNING', 'INFO'], help='Logging levels to measure')
+    parser.add_argument('--sample-rates', type=float, nargs='+', default=[1, 0.1, 0.01], help='Sample rates to measure')
+    args = parser.parse_args()
+
+    results = make_results(args.requests)
+    print(f'{"pipeline":>8} {"level":>8} {"sample":>7} {"us_per_request":>15}')
+    for level in args.levels:
+        print(f'{"old":>8} {level:>8} {1:>7} {measure("old", level, 1, results):>15.2f}')
+        for sample_rate in args.sample_rates:
+            print(f'{"new":>8} {level:>8} {sample_rate:>7} {measure("new", level, sample_rate, results):>15.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Measures memory of TonlibWorker processes for different liteservers-per-worker packing.
+
+Usage: python benchmarks/worker_memory.py --liteserver-config private/mainnet.json --liteservers 16 --per-worker 1 4 16
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from pyTON.settings import TonlibSettings
+from pyTON.manager import TonlibManager
+
+
+def read_proc_kb(pid, path, field):
+    try:
+        with open(f'/proc/{pid}/{path}') as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+async def measure(args, per_worker):
+    with tempfile.TemporaryDirectory() as keystore:
+        settings = TonlibSettings(parallel_requests_per_liteserver=50,
+                                  keystore=keystore + '/',
+                                  liteserver_config_path=args.liteserver_config,
+                                  cdll_path=None,
+                                  request_timeout=10,
+                                  verbosity_level=0,
+                                  liteservers_per_worker=per_worker)
+        config = settings.liteserver_config
+        config['liteservers'] = config['liteservers'][:args.liteservers]
+        count = len(config['liteservers'])
+
+        manager = TonlibManager(settings)
+        await asyncio.sleep(args.warmup)
+
+        processes = {id(worker_info['worker']): worker_info['worker'] for worker_info in manager.workers.values()}
+        rss = sum(read_proc_kb(p.pid, 'status', 'VmRSS:') for p in processes.values()) / 1024
+        pss = sum(read_proc_kb(p.pid, 'smaps_rollup', 'Pss:') for p in processes.values()) / 1024
+        await manager.shutdown()
+    print(f'{count:>11} {per_worker:>10} {len(processes):>9} {rss:>8.1f} {rss / count:>10.1f} {pss / count:>10.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser('worker_memory')
+    parser.add_argument('--liteserver-config', type=str, required=True, help='Liteserver config JSON path')
+    parser.add_argument('--liteservers', type=int, default=16, help='Number of liteservers to take from config')
+    parser.add_argument('--per-worker', type=int, nargs='+', default=[1, 4, 16], help='Liteservers per worker values to measure')
+    parser.add_argument('--warmup', type=float, default=10, help='Seconds to wait before measuring')
+    args = parser.parse_args()
+
+    print(f'{"liteservers":>11} {"per_worker":>10} {"processes":>9} {"rss_mb":>8} {"rss_per_ls":>10} {"pss_per_ls":>10}')
+    for per_worker in args.per_worker:
+        asyncio.run(measure(args, per_worker))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,19 +7,94 @@ def setup_environment(args):
     os.environ['TON_API_CACHE_ENABLED'] = ('1' if args.cache else '0')
     os.environ['TON_API_CACHE_REDIS_ENDPOINT'] = args.cache_redis_endpoint
     os.environ['TON_API_CACHE_REDIS_PORT'] = str(args.cache_redis_port)
+    os.environ['TON_API_CACHE_STALE_TTL'] = str(args.cache_stale_ttl)
+    os.environ['TON_API_CACHE_LOCK_TTL'] = str(args.cache_lock_ttl)
+    os.environ['TON_API_CACHE_LOCK_WAIT'] = str(args.cache_lock_wait)
+    os.environ['TON_API_CACHE_EARLY_REFRESH_BETA'] = str(args.cache_early_refresh_beta)
+    os.environ['TON_API_CACHE_NEGATIVE_TTL'] = str(args.cache_negative_ttl)
 
     os.environ['TON_API_LOGS_LEVEL'] = args.logs_level
     os.environ['TON_API_LOGS_JSONIFY'] = ('1' if args.logs_jsonify else '0')
+    os.environ['TON_API_LOGS_SAMPLE_RATE'] = str(args.logs_sample_rate)
 
     os.environ['TON_API_ROOT_PATH'] = args.root
     os.environ['TON_API_GET_METHODS_ENABLED'] = ('1' if args.get_methods else '0')
     os.environ['TON_API_JSON_RPC_ENABLED'] = ('1' if args.json_rpc else '0')
+    os.environ['TON_API_ADDRESS_CACHE_SIZE'] = str(args.address_cache_size)
+    os.environ['TON_API_MAX_BULK_ADDRESSES'] = str(args.max_bulk_addresses)
     
     os.environ['TON_API_TONLIB_LITESERVER_CONFIG'] = args.liteserver_config
     os.environ['TON_API_TONLIB_KEYSTORE'] = args.tonlib_keystore
     os.environ['TON_API_TONLIB_PARALLEL_REQUESTS_PER_LITESERVER'] = str(args.parallel_requests_per_liteserver)
+    os.environ['TON_API_TONLIB_LITESERVER_CONFIG_RELOAD_INTERVAL'] = str(args.liteserver_config_reload_interval)
+    os.environ['TON_API_TONLIB_LITESERVERS_PER_WORKER'] = str(args.liteservers_per_worker)
+    os.environ['TON_API_TONLIB_SHARED_MEMORY_THRESHOLD'] = str(args.shared_memory_threshold)
     if args.cdll_path is not None:
         os.environ['TON_API_TONLIB_CDLL_PATH'] = args.cdll_path
+
+    os.environ['TON_API_SEND_RESEND_INTERVAL'] = str(args.resend_interval)
+    os.environ['TON_API_SEND_RESEND_DURATION'] = str(args.resend_duration)
+    os.environ['TON_API_SEND_MAX_RESEND_MESSAGES'] = str(args.max_resend_messages)
+    os.environ['TON_API_SEND_BROADCAST_FANOUT'] = str(args.broadcast_fanout)
+    os.environ['TON_API_SEND_DEDUP_WINDOW'] = str(args.dedup_window)
+
+    os.environ['TON_API_BLOCK_INDEX_ENABLED'] = ('1' if args.block_index else '0')
+    os.environ['TON_API_BLOCK_INDEX_WINDOW_HOURS'] = str(args.block_index_window_hours)
+    os.environ['TON_API_BLOCK_INDEX_MAX_TRANSACTIONS'] = str(args.block_index_max_transactions)
+    os.environ['TON_API_BLOCK_INDEX_MAX_BLOCK_TRANSACTIONS'] = str(args.block_index_max_block_transactions)
+
+    os.environ['TON_API_BLOCK_STORE_ENABLED'] = ('1' if args.block_store else '0')
+    os.environ['TON_API_BLOCK_STORE_PATH'] = args.block_store_path
+    os.environ['TON_API_BLOCK_STORE_MAX_SIZE_MB'] = str(args.block_store_max_size_mb)
+
+    os.environ['TON_API_TIMELINE_ENABLED'] = ('1' if args.timeline else '0')
+    os.environ['TON_API_TIMELINE_BACKFILL_BLOCKS'] = str(args.timeline_backfill_blocks)
+
+    os.environ['TON_API_CONFIG_SNAPSHOTS_ENABLED'] = ('1' if args.config_snapshots else '0')
+
+    os.environ['TON_API_PREFETCH_ENABLED'] = ('1' if args.prefetch else '0')
+    os.environ['TON_API_PREFETCH_MAX_INFLIGHT'] = str(args.prefetch_max_inflight)
+    os.environ['TON_API_PREFETCH_MIN_HIT_RATE'] = str(args.prefetch_min_hit_rate)
+
+    os.environ['TON_API_TRANSACTION_CACHE_ENABLED'] = ('1' if args.transaction_cache else '0')
+    os.environ['TON_API_TRANSACTION_CACHE_MAX_TRANSACTIONS'] = str(args.transaction_cache_max_transactions)
+
+    os.environ['TON_API_COMPRESSION_ENABLED'] = ('1' if args.compression else '0')
+    os.environ['TON_API_COMPRESSION_MIN_SIZE'] = str(args.compression_min_size)
+    os.environ['TON_API_COMPRESSION_THREAD_MIN_SIZE'] = str(args.compression_thread_min_size)
+    os.environ['TON_API_COMPRESSION_GZIP_LEVEL'] = str(args.compression_gzip_level)
+    os.environ['TON_API_COMPRESSION_BROTLI_QUALITY'] = str(args.compression_brotli_quality)
+    os.environ['TON_API_COMPRESSION_ZSTD_LEVEL'] = str(args.compression_zstd_level)
+    os.environ['TON_API_OFFLOAD_EXECUTOR'] = args.offload_executor
+    os.environ['TON_API_OFFLOAD_MAX_WORKERS'] = str(args.offload_max_workers)
+    os.environ['TON_API_OFFLOAD_MIN_SIZE'] = str(args.offload_min_size)
+    os.environ['TON_API_LOOP_LAG_INTERVAL'] = str(args.loop_lag_interval)
+    os.environ['TON_API_LOOP_LAG_WARNING_THRESHOLD'] = str(args.loop_lag_warning_threshold)
+
+    os.environ['TON_API_CLUSTER_ENABLED'] = ('1' if args.cluster else '0')
+    os.environ['TON_API_CLUSTER_HEARTBEAT_INTERVAL'] = str(args.cluster_heartbeat_interval)
+    os.environ['TON_API_CLUSTER_LEASE_TTL'] = str(args.cluster_lease_ttl)
+    if args.cluster_redis_endpoint is not None:
+        os.environ['TON_API_CLUSTER_REDIS_ENDPOINT'] = args.cluster_redis_endpoint
+        os.environ['TON_API_CLUSTER_REDIS_PORT'] = str(args.cluster_redis_port)
+
+    os.environ['TON_API_RETRY_ENABLED'] = ('0' if args.no_retry else '1')
+    os.environ['TON_API_RETRY_RACE_AFTER'] = str(args.retry_race_after)
+    os.environ['TON_API_RETRY_BACKOFF'] = str(args.retry_backoff)
+    os.environ['TON_API_RETRY_MAX_BACKOFF'] = str(args.retry_max_backoff)
+
+    os.environ['TON_API_RATE_LIMIT_ENABLED'] = ('1' if args.rate_limit else '0')
+    os.environ['TON_API_RATE_LIMIT_RATE'] = str(args.rate_limit_rate)
+    os.environ['TON_API_RATE_LIMIT_BURST'] = str(args.rate_limit_burst)
+    os.environ['TON_API_RATE_LIMIT_NO_KEY_RATE'] = str(args.rate_limit_no_key_rate)
+    os.environ['TON_API_RATE_LIMIT_NO_KEY_BURST'] = str(args.rate_limit_no_key_burst)
+    os.environ['TON_API_RATE_LIMIT_METHOD_WEIGHTS'] = args.rate_limit_method_weights
+    os.environ['TON_API_RATE_LIMIT_SYNC_INTERVAL'] = str(args.rate_limit_sync_interval)
+    os.environ['TON_API_RATE_LIMIT_TRUSTED_PROXIES'] = args.rate_limit_trusted_proxies
+    os.environ['TON_API_RATE_LIMIT_API_KEYS'] = args.rate_limit_api_keys
+    if args.rate_limit_redis_endpoint is not None:
+        os.environ['TON_API_RATE_LIMIT_REDIS_ENDPOINT'] = args.rate_limit_redis_endpoint
+        os.environ['TON_API_RATE_LIMIT_REDIS_PORT'] = str(args.rate_limit_redis_port)
     return
 
 
@@ -32,21 +107,107 @@ def main():
     webserver_args.add_argument('--root', type=str, default='/', help='HTTP API root, default: /')
     webserver_args.add_argument('--no-get-methods', action='store_false', default=True, dest='get_methods', help='Disable runGetMethod endpoint')
     webserver_args.add_argument('--no-json-rpc', action='store_false', default=True, dest='json_rpc', help='Disable jsonRPC endpoint')
+    webserver_args.add_argument('--address-cache-size', type=int, default=100000, help='Number of parsed addresses kept in memory')
+    webserver_args.add_argument('--max-bulk-addresses', type=int, default=10000, help='Maximal number of addresses in detectAddresses request')
 
     tonlib_args = parser.add_argument_group('tonlib')
     tonlib_args.add_argument('--liteserver-config', type=str, default='https://ton.org/global-config.json', help='Liteserver config JSON path')
     tonlib_args.add_argument('--tonlib-keystore', type=str, default='./ton_keystore/', help='Keystore path for tonlibjson')
     tonlib_args.add_argument('--parallel-requests-per-liteserver', type=int, default=50, help='Maximum parallel requests per liteserver')
+    tonlib_args.add_argument('--liteserver-config-reload-interval', type=int, default=0, help='Interval in seconds to reload liteserver config, 0 to disable')
+    tonlib_args.add_argument('--liteservers-per-worker', type=int, default=1, help='Number of liteservers served by one worker process')
+    tonlib_args.add_argument('--shared-memory-threshold', type=int, default=262144, help='Minimal size in bytes of worker result passed through shared memory, 0 to disable')
     tonlib_args.add_argument('--cdll-path', type=str, default=None, help='Path to tonlibjson binary')
     
+    send_args = parser.add_argument_group('send')
+    send_args.add_argument('--resend-interval', type=int, default=5, help='Interval in seconds between resends of sendBocUnsafe messages')
+    send_args.add_argument('--resend-duration', type=int, default=60, help='Duration in seconds to resend sendBocUnsafe messages')
+    send_args.add_argument('--max-resend-messages', type=int, default=10000, help='Maximum number of messages resent at the same time')
+    send_args.add_argument('--broadcast-fanout', type=int, default=4, help='Number of liteservers a message is sent to')
+    send_args.add_argument('--dedup-window', type=int, default=60, help='Time in seconds to return cached result for duplicate messages')
+
+    block_index_args = parser.add_argument_group('block index')
+    block_index_args.add_argument('--block-index', default=False, action='store_true', help='Enable index of recent blocks for tryLocateTx methods')
+    block_index_args.add_argument('--block-index-window-hours', type=float, default=6, help='Hours of recent blocks kept in the index')
+    block_index_args.add_argument('--block-index-max-transactions', type=int, default=1000000, help='Maximum number of entries in the index')
+    block_index_args.add_argument('--block-index-max-block-transactions', type=int, default=10000, help='Maximum number of transactions fetched per indexed block')
+
+    block_store_args = parser.add_argument_group('block store')
+    block_store_args.add_argument('--block-store', default=False, action='store_true', help='Enable persistent store of immutable block data')
+    block_store_args.add_argument('--block-store-path', type=str, default='./ton_block_store/block_store.sqlite3', help='Path to block store database file')
+    block_store_args.add_argument('--block-store-max-size-mb', type=int, default=4096, help='Maximum size of block store in megabytes')
+
+    timeline_args = parser.add_argument_group('timeline')
+    timeline_args.add_argument('--timeline', default=False, action='store_true', help='Enable masterchain timeline index for lookupBlock by lt and unixtime')
+    timeline_args.add_argument('--timeline-backfill-blocks', type=int, default=100000, help='Maximum number of recent masterchain blocks kept in timeline index')
+
+    config_args = parser.add_argument_group('config snapshots')
+    config_args.add_argument('--config-snapshots', default=False, action='store_true', help='Enable in-memory snapshots of blockchain config for getConfigParam')
+
+    prefetch_args = parser.add_argument_group('prefetch')
+    prefetch_args.add_argument('--prefetch', default=False, action='store_true', help='Enable prefetch of the next getTransactions page')
+    prefetch_args.add_argument('--prefetch-max-inflight', type=int, default=16, help='Maximum number of pages prefetched at the same time')
+    prefetch_args.add_argument('--prefetch-min-hit-rate', type=float, default=0.25, help='Minimal share of requested prefetched pages to keep prefetching for an account')
+
+    transaction_cache_args = parser.add_argument_group('transaction cache')
+    transaction_cache_args.add_argument('--transaction-cache', default=False, action='store_true', help='Enable in-memory cache of account transactions for getTransactions')
+    transaction_cache_args.add_argument('--transaction-cache-max-transactions', type=int, default=20000, help='Maximum number of transactions cached in memory by a webserver process')
+
+    compression_args = parser.add_argument_group('compression')
+    compression_args.add_argument('--compression', default=False, action='store_true', help='Enable response compression')
+    compression_args.add_argument('--compression-min-size', type=int, default=1024, help='Minimal size in bytes of compressed response')
+    compression_args.add_argument('--compression-thread-min-size', type=int, default=65536, help='Minimal size in bytes of response compressed in a thread pool')
+    compression_args.add_argument('--compression-gzip-level', type=int, default=6, help='Gzip compression level, 1-9')
+    compression_args.add_argument('--compression-brotli-quality', type=int, default=4, help='Brotli compression quality, 0-11')
+    compression_args.add_argument('--compression-zstd-level', type=int, default=3, help='Zstd compression level, 1-22')
+
+    offload_args = parser.add_argument_group('offload')
+    offload_args.add_argument('--offload-executor', type=str, default='process', choices=['process', 'thread'], help='Pool for serialization of large request data')
+    offload_args.add_argument('--offload-max-workers', type=int, default=2, help='Number of pool workers per webserver worker')
+    offload_args.add_argument('--offload-min-size', type=int, default=4096, help='Minimal size in bytes of request data serialized in the pool')
+    offload_args.add_argument('--loop-lag-interval', type=float, default=0.5, help='Interval in seconds of event loop lag measurements')
+    offload_args.add_argument('--loop-lag-warning-threshold', type=float, default=0.1, help='Event loop lag in seconds to log a warning')
+
+    cluster_args = parser.add_argument_group('cluster')
+    cluster_args.add_argument('--cluster', default=False, action='store_true', help='Share liteserver health and consensus with other instances through Redis')
+    cluster_args.add_argument('--cluster-heartbeat-interval', type=float, default=1, help='Interval in seconds to sync liteserver state with Redis')
+    cluster_args.add_argument('--cluster-lease-ttl', type=float, default=5, help='Time in seconds after which liteservers of a stopped instance are probed by others')
+    cluster_args.add_argument('--cluster-redis-endpoint', type=str, default=None, help='Cluster Redis endpoint, cache Redis is used if not set')
+    cluster_args.add_argument('--cluster-redis-port', type=int, default=6379, help='Cluster Redis port')
+
+    retry_args = parser.add_argument_group('retry')
+    retry_args.add_argument('--no-retry', default=False, action='store_true', help='Disable retries of failed liteserver requests')
+    retry_args.add_argument('--retry-race-after', type=float, default=0, help='Time in seconds after which account state requests are also sent to an archival liteserver, 0 to disable')
+    retry_args.add_argument('--retry-backoff', type=float, default=0.05, help='Initial delay in seconds before a retry after a timeout')
+    retry_args.add_argument('--retry-max-backoff', type=float, default=0.5, help='Maximal delay in seconds before a retry after a timeout')
+
+    rate_limit_args = parser.add_argument_group('rate limit')
+    rate_limit_args.add_argument('--rate-limit', default=False, action='store_true', help='Enable API key rate limit')
+    rate_limit_args.add_argument('--rate-limit-rate', type=float, default=10, help='Requests per second per API key')
+    rate_limit_args.add_argument('--rate-limit-burst', type=float, default=20, help='Burst size per API key')
+    rate_limit_args.add_argument('--rate-limit-no-key-rate', type=float, default=1, help='Requests per second per IP for requests without API key')
+    rate_limit_args.add_argument('--rate-limit-no-key-burst', type=float, default=2, help='Burst size per IP for requests without API key')
+    rate_limit_args.add_argument('--rate-limit-method-weights', type=str, default='runGetMethod:2,getTransactions:2,sendBoc:2,sendBocReturnHash:2', help='Comma separated method:weight pairs, other methods weight 1')
+    rate_limit_args.add_argument('--rate-limit-sync-interval', type=float, default=1, help='Interval in seconds to sync rate limit buckets with Redis')
+    rate_limit_args.add_argument('--rate-limit-trusted-proxies', type=str, default='', help='Comma separated addresses or networks of proxies whose X-Forwarded-For is trusted')
+    rate_limit_args.add_argument('--rate-limit-api-keys', type=str, default='', help='Comma separated API keys limited per key, other keys are limited per IP')
+    rate_limit_args.add_argument('--rate-limit-redis-endpoint', type=str, default=None, help='Rate limit Redis endpoint, limits are local to process if not set')
+    rate_limit_args.add_argument('--rate-limit-redis-port', type=int, default=6379, help='Rate limit Redis port')
+
     cache_args = parser.add_argument_group('cache')
     cache_args.add_argument('--cache', default=False, action='store_true', help='Enable cache')
     cache_args.add_argument('--cache-redis-endpoint', type=str, default='localhost', help='Cache Redis endpoint')
     cache_args.add_argument('--cache-redis-port', type=int, default=6379, help='Cache Redis port')
+    cache_args.add_argument('--cache-stale-ttl', type=float, default=5, help='Time in seconds an expired entry is served while it is recomputed')
+    cache_args.add_argument('--cache-lock-ttl', type=float, default=10, help='Maximal time in seconds an entry is locked for recomputation')
+    cache_args.add_argument('--cache-lock-wait', type=float, default=2, help='Time in seconds to wait for an entry recomputed by another process')
+    cache_args.add_argument('--cache-early-refresh-beta', type=float, default=1, help='Early refresh factor, 0 disables refresh before expiry')
+    cache_args.add_argument('--cache-negative-ttl', type=float, default=5, help='Time in seconds to cache persistent errors such as missing blocks, 0 disables')
 
     logs_args = parser.add_argument_group('logs')
     logs_args.add_argument('--logs-level', type=str, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], default='ERROR', help='Logging level')
     logs_args.add_argument('--logs-jsonify', default=False, action='store_true', help='Print logs in JSON format')
+    logs_args.add_argument('--logs-sample-rate', type=float, default=1, help='Fraction of requests whose per-request logs are printed')
 
     other_args = parser.add_argument_group('other')
     other_args.add_argument('--version', default=False, action='store_true', help='Show version of PyPI package')
@@ -1,24 +1,203 @@
+import asyncio
+import math
+import random
+import time
+import uuid
+import hashlib
 import redis.asyncio
 import ring
 
+from collections import OrderedDict
+from functools import partial, wraps
+from typing import Any, NamedTuple
 from ring.func.asyncio import Aioredis2Storage
+from ring.func.base import NotFound
 from pyTON.settings import RedisCacheSettings
 
+from pytonlib import TonlibError
+from pytonlib.tonlibjson import BlockDeleted, LiteServerTimeout, TonlibNoResponse
 
-class TonlibResultRedisStorage(Aioredis2Storage):
-    async def set(self, key, value, expire=...):
-        if value.get('@type', 'error') == 'error':
+from loguru import logger
+
+
+def blob_hash(blob: str):
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+class BlobStore:
+    """
+    Content-addressed store for contract code and data. Blobs are kept in a bounded
+    in-process LRU and in Redis under `blob:<sha256>` keys, so identical code of thousands
+    of accounts is stored and transferred once.
+    """
+    blob_fields = ('code', 'data')
+
+    def __init__(self, cache_redis, max_bytes=64 * 1024 * 1024, expire=24 * 3600, min_size=64):
+        self.cache_redis = cache_redis
+        self.max_bytes = max_bytes
+        self.expire = expire
+        self.min_size = min_size
+
+        self.blobs = OrderedDict()  # hash -> (blob, written_at)
+        self.size = 0
+
+    def _remember(self, h, blob, written_at):
+        if h in self.blobs:
+            self.blobs.move_to_end(h)
+            self.blobs[h] = (self.blobs[h][0], written_at)
+            return self.blobs[h][0]
+        self.blobs[h] = (blob, written_at)
+        self.size += len(blob)
+        while self.size > self.max_bytes and len(self.blobs) > 1:
+            _, (evicted, _) = self.blobs.popitem(last=False)
+            self.size -= len(evicted)
+        return blob
+
+    async def put(self, blob: str):
+        h = blob_hash(blob)
+        now = time.time()
+        if h in self.blobs and now - self.blobs[h][1] < self.expire / 2:
+            self.blobs.move_to_end(h)
+            return h
+        await self.cache_redis.set(f'blob:{h}', blob, ex=self.expire)
+        self._remember(h, blob, now)
+        return h
+
+    async def get(self, h: str):
+        if h in self.blobs:
+            self.blobs.move_to_end(h)
+            return self.blobs[h][0]
+        blob = await self.cache_redis.get(f'blob:{h}')
+        if blob is None:
+            raise KeyError(h)
+        return self._remember(h, blob.decode('utf-8'), 0)
+
+    def _containers(self, value):
+        if isinstance(value, dict):
+            yield value
+            if isinstance(value.get('account_state'), dict):
+                yield value['account_state']
+
+    async def intern(self, value):
+        """
+        Returns a copy of account state with large code and data replaced by blob references.
+        """
+        if not isinstance(value, dict):
+            return value
+        value = dict(value)
+        if isinstance(value.get('account_state'), dict):
+            value['account_state'] = dict(value['account_state'])
+        for container in self._containers(value):
+            for field in self.blob_fields:
+                blob = container.get(field)
+                if isinstance(blob, str) and len(blob) >= self.min_size:
+                    container[field] = {'@type': 'blobRef', 'hash': await self.put(blob)}
+        return value
+
+    async def rehydrate(self, value):
+        for container in self._containers(value):
+            for field in self.blob_fields:
+                ref = container.get(field)
+                if isinstance(ref, dict) and ref.get('@type') == 'blobRef':
+                    container[field] = await self.get(ref['hash'])
+        return value
+
+
+# errors which repeat for the same request until the blockchain changes
+PERSISTENT_ERRORS = ('Smart contract is not Jetton or NFT', 'Verification with', 'Tx not found',
+                     'INVALID_ACCOUNT_ADDRESS', 'Failed to unpack account state')
+# errors of a liteserver or the network, a retry may succeed. Data not in db of one liteserver
+# may be pruned there or not yet applied, other liteservers can have it
+TRANSIENT_ERRORS = ('timeout', 'LITE_SERVER_NETWORK', 'LITE_SERVER_NOTREADY', 'not ready', 'No working liteservers', 'not in db')
+
+
+def is_persistent_error(error):
+    """
+    Returns True if an exception or an error result is a deterministic answer to the request,
+    such as missing block or invalid address. Timeouts and liteserver failures are never persistent.
+    """
+    if isinstance(error, (LiteServerTimeout, BlockDeleted, TonlibNoResponse, asyncio.TimeoutError, asyncio.CancelledError)):
+        return False
+    if isinstance(error, dict):
+        message = str(error.get('message', ''))
+    elif isinstance(error, TonlibError):
+        message = str(error.result.get('message', ''))
+    elif isinstance(error, Exception):
+        message = str(error)
+    else:
+        return False
+    if any(pattern in message for pattern in TRANSIENT_ERRORS):
+        return False
+    return any(pattern in message for pattern in PERSISTENT_ERRORS)
+
+
+class CachedError(NamedTuple):
+    error: Any  # exception raised or error result returned by the cached function
+
+
+class CacheEntry(NamedTuple):
+    value: Any
+    expires_at: float
+    delta: float  # seconds it took to compute the value
+
+
+class EntryRedisStorage(Aioredis2Storage):
+    """
+    Stores cache entries for stale_ttl longer than they expire, so an expired value can be
+    served while it is recomputed.
+    """
+    def __init__(self, rope, backend, stale_ttl=0):
+        super().__init__(rope, backend)
+        self.stale_ttl = stale_ttl
+
+    async def get(self, key):
+        entry = await super().get(key)
+        if not isinstance(entry, CacheEntry):
+            raise NotFound
+        return entry
+
+    async def set(self, key, entry, expire=...):
+        if expire is ...:
+            expire = self.rope.config.expire_default
+        return await super().set(key, entry, math.ceil(expire + self.stale_ttl))
+
+
+class TonlibResultRedisStorage(EntryRedisStorage):
+    async def set(self, key, entry, expire=...):
+        if not isinstance(entry.value, CachedError) and entry.value.get('@type', 'error') == 'error':
+            return None
+        return await super().set(key, entry, expire)
+
+
+class InterningRedisStorage(TonlibResultRedisStorage):
+    def __init__(self, rope, backend, blob_store: BlobStore, stale_ttl=0):
+        super().__init__(rope, backend, stale_ttl)
+        self.blob_store = blob_store
+
+    async def get(self, key):
+        entry = await super().get(key)
+        if isinstance(entry.value, CachedError):
+            return entry
+        try:
+            return entry._replace(value=await self.blob_store.rehydrate(entry.value))
+        except KeyError:
+            raise NotFound
+
+    async def set(self, key, entry, expire=...):
+        if isinstance(entry.value, CachedError):
+            return await super().set(key, entry, expire)
+        if entry.value.get('@type', 'error') == 'error':
             return None
-        return await super().set(key, value, expire)
+        return await super().set(key, entry._replace(value=await self.blob_store.intern(entry.value)), expire)
 
 
 class CacheManager:
-    def cached(self, expire=0, check_error=True):
+    def cached(self, expire=0, check_error=True, intern_blobs=False):
         pass
 
 
 class DisabledCacheManager:
-    def cached(self, expire=0, check_error=True):
+    def cached(self, expire=0, check_error=True, intern_blobs=False):
         def g(func):
             def wrapper(*args, **kwargs):
                 return func(*args, **kwargs)
@@ -26,13 +205,152 @@ class DisabledCacheManager:
         return g
 
 
+# deletes the lock if it is still held by the caller
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
 class RedisCacheManager:
+    """
+    Redis cache of TonlibManager methods protected from stampedes. When an entry expires, a single
+    caller in the cluster takes a short Redis lock and recomputes it, while other callers get the
+    stale value or, if there is none, wait up to lock_wait for the new one. The stale value is also
+    served if the recomputation fails. Concurrent callers of a process share one recomputation.
+    Entries are also refreshed in background before they expire, with probability growing towards
+    expiry and with compute time of the value, so hot keys are rarely seen expired.
+
+    Persistent errors, such as a missing block, are cached for negative_ttl, so repeated requests
+    for missing data don't reach liteservers. Transient errors are never cached.
+    """
+    lock_poll_interval = 0.05
+    locked = object()
+
     def __init__(self, cache_settings: RedisCacheSettings):
         self.cache_settings = cache_settings
         self.cache_redis = redis.asyncio.from_url(f"redis://{cache_settings.redis.endpoint}:{cache_settings.redis.port}")
+        self.blob_store = BlobStore(self.cache_redis)
+        self.release_lock_script = self.cache_redis.register_script(RELEASE_LOCK_SCRIPT)
+        self.inflight = {}  # key -> recompute task
+        self.token = uuid.uuid4().hex
 
-    def cached(self, expire=0, check_error=True):
-        storage_class = TonlibResultRedisStorage if check_error else Aioredis2Storage
+    def cached(self, expire=0, check_error=True, intern_blobs=False):
+        storage_class = TonlibResultRedisStorage if check_error else EntryRedisStorage
+        if intern_blobs:
+            storage_class = partial(InterningRedisStorage, blob_store=self.blob_store)
+        storage_class = partial(storage_class, stale_ttl=self.cache_settings.stale_ttl)
         def g(func):
-            return ring.aioredis(self.cache_redis, coder='pickle', expire=expire, storage_class=storage_class)(func)
+            cached_func = ring.aioredis(self.cache_redis, coder='pickle', expire=expire, storage_class=storage_class)(func)
+
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                return await self.get_or_update(cached_func, expire, args, kwargs)
+            return wrapper
         return g
+
+    def should_refresh(self, entry: CacheEntry, now: float):
+        # probabilistic early expiration: -log(random) is exponentially distributed
+        beta = self.cache_settings.early_refresh_beta
+        return now - entry.delta * beta * math.log(1 - random.random()) >= entry.expires_at
+
+    @staticmethod
+    def unwrap(entry: CacheEntry):
+        if isinstance(entry.value, CachedError):
+            if isinstance(entry.value.error, BaseException):
+                raise entry.value.error
+            return entry.value.error
+        return entry.value
+
+    async def get_or_update(self, cached_func, expire, args, kwargs):
+        key = cached_func.key(*args, **kwargs)
+        try:
+            entry = await cached_func.storage.get(key)
+        except NotFound:
+            entry = None
+
+        now = time.time()
+        if entry is not None and isinstance(entry.value, CachedError) and entry.expires_at <= now:
+            # expired errors are not served stale
+            entry = None
+        if entry is not None and not self.should_refresh(entry, now):
+            return self.unwrap(entry)
+
+        if entry is not None and entry.expires_at > now:
+            # early refresh doesn't delay the request
+            self.recompute(cached_func, key, expire, args, kwargs)
+            return self.unwrap(entry)
+
+        task = self.recompute(cached_func, key, expire, args, kwargs)
+        try:
+            result = await asyncio.shield(task)
+        except Exception:
+            if entry is None:
+                raise
+            # stale value is served if the entry can't be recomputed
+            return self.unwrap(entry)
+        if result is not self.locked:
+            return result
+        # recomputed by another process
+        if entry is not None:
+            return self.unwrap(entry)
+        deadline = time.time() + self.cache_settings.lock_wait
+        while time.time() < deadline:
+            await asyncio.sleep(self.lock_poll_interval)
+            try:
+                entry = await cached_func.storage.get(key)
+            except NotFound:
+                if not await self.cache_redis.exists(f'lock:{key}'):
+                    break
+            else:
+                return self.unwrap(entry)
+        # the result wasn't cached or the other caller is too slow
+        result = await asyncio.shield(self.recompute(cached_func, key, expire, args, kwargs))
+        if result is not self.locked:
+            return result
+        return await cached_func.execute(*args, **kwargs)
+
+    def recompute(self, cached_func, key, expire, args, kwargs):
+        """
+        Returns task recomputing the entry under the lock. The task returns locked if the lock is
+        held by another process.
+        """
+        task = self.inflight.get(key)
+        if task is None:
+            task = self.inflight[key] = asyncio.ensure_future(self._recompute(cached_func, key, expire, args, kwargs))
+            task.add_done_callback(partial(self.on_recomputed, key))
+        return task
+
+    def on_recomputed(self, key, task):
+        self.inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug('Cache entry refresh failed: {exc}', exc=task.exception())
+
+    async def _recompute(self, cached_func, key, expire, args, kwargs):
+        lock = f'lock:{key}'
+        if not await self.cache_redis.set(lock, self.token, nx=True, px=int(self.cache_settings.lock_ttl * 1000)):
+            return self.locked
+        negative_ttl = self.cache_settings.negative_ttl
+        try:
+            start = time.time()
+            try:
+                result = await cached_func.execute(*args, **kwargs)
+            except Exception as e:
+                if negative_ttl > 0 and is_persistent_error(e):
+                    await self.set_error(cached_func, key, e, start)
+                raise
+            if negative_ttl > 0 and isinstance(result, dict) and result.get('@type') == 'error' and is_persistent_error(result):
+                await self.set_error(cached_func, key, result, start)
+                return result
+            now = time.time()
+            await cached_func.storage.set(key, CacheEntry(result, now + expire, now - start), expire)
+            return result
+        finally:
+            await self.release_lock_script(keys=[lock], args=[self.token])
+
+    async def set_error(self, cached_func, key, error, start):
+        now = time.time()
+        negative_ttl = self.cache_settings.negative_ttl
+        await cached_func.storage.set(key, CacheEntry(CachedError(error), now + negative_ttl, now - start), negative_ttl)
@@ -0,0 +1,161 @@
+import asyncio
+import time
+import traceback
+import uuid
+
+import redis.asyncio
+
+from pyTON.models import TonlibWorkerMsgType
+from pyTON.settings import ClusterSettings
+
+from loguru import logger
+
+
+# takes or extends the probe lease of a liteserver if it's free or already owned by the instance
+ACQUIRE_LEASE_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if owner == false or owner == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# consensus block of the cluster never goes back
+UPDATE_CONSENSUS_SCRIPT = """
+local seqno = tonumber(redis.call('HGET', KEYS[1], 'seqno')) or 0
+if tonumber(ARGV[1]) > seqno then
+    redis.call('HSET', KEYS[1], 'seqno', ARGV[1], 'timestamp', ARGV[2])
+end
+return redis.call('HGET', KEYS[1], 'seqno')
+"""
+
+
+class ClusterState:
+    """
+    Shares liteserver health between API instances through Redis. Each liteserver is probed
+    by a single instance holding its lease, which publishes last block and archival flag of the
+    liteserver. Other instances stop probing it and take its state from Redis. Leases of a stopped
+    instance expire after lease_ttl and are taken over by other instances.
+
+    Instances also publish their request latency to liteservers and consensus block. A new instance
+    starts from the cluster consensus block and liteserver states instead of waiting for own probes,
+    and instances whose liteservers lag behind follow the cluster consensus block.
+    If Redis is not available, the instance falls back to probing all its liteservers.
+    """
+    def __init__(self, tonlib, cluster_settings: ClusterSettings):
+        self.tonlib = tonlib
+        self.settings = cluster_settings
+        self.instance_id = uuid.uuid4().hex
+        self.redis = redis.asyncio.from_url(f"redis://{self.settings.redis.endpoint}:{self.settings.redis.port}",
+                                            socket_timeout=self.settings.redis.timeout)
+        self.acquire_lease_script = self.redis.register_script(ACQUIRE_LEASE_SCRIPT)
+        self.update_consensus_script = self.redis.register_script(UPDATE_CONSENSUS_SCRIPT)
+
+        self.probing = {}  # ls_index -> probe state sent to the worker, workers probe until told otherwise
+        self.loaded = False
+
+    def liteserver_id(self, ls_index):
+        ip, port, _ = self.tonlib.liteserver_key(self.tonlib.liteservers[ls_index])
+        return f'{ip}:{port}'
+
+    def is_probing(self, ls_index):
+        return self.probing.get(ls_index, True)
+
+    async def set_probing(self, ls_index, enabled):
+        if self.is_probing(ls_index) == enabled:
+            return
+        worker = self.tonlib.workers[ls_index]['worker']
+        await self.tonlib.loop.run_in_executor(self.tonlib.threadpool_executor, worker.input_queue.put, (TonlibWorkerMsgType.PROBE_CONTROL, (ls_index, enabled)))
+        self.probing[ls_index] = enabled
+        logger.info('Liteserver #{ls_index:03d} probing {state}', ls_index=ls_index, state='started' if enabled else 'stopped')
+
+    async def fallback(self):
+        for ls_index in list(self.probing):
+            if ls_index in self.tonlib.workers:
+                await self.set_probing(ls_index, True)
+
+    def apply_consensus(self, consensus):
+        if consensus is not None and int(consensus) > self.tonlib.consensus_block.seqno:
+            self.tonlib.consensus_block.seqno = int(consensus)
+            self.tonlib.consensus_block.timestamp = time.time()
+            return True
+        return False
+
+    async def load(self):
+        """
+        Seeds consensus block and archival flags from the cluster.
+        """
+        consensus = await self.redis.hget('cluster:consensus', 'seqno')
+        if self.apply_consensus(consensus):
+            logger.info('Consensus block {seqno} loaded from cluster', seqno=int(consensus))
+        for ls_index, worker_info in self.tonlib.workers.items():
+            health = await self.redis.hgetall(f'cluster:health:{self.liteserver_id(ls_index)}')
+            if health:
+                worker_info['is_archival'] = health[b'is_archival'] == b'1'
+        self.loaded = True
+
+    async def heartbeat(self):
+        ls_indices = [ls_index for ls_index, worker_info in self.tonlib.workers.items() if not worker_info['is_draining']]
+        lease_ttl = int(self.settings.lease_ttl * 1000)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for ls_index in ls_indices:
+                await self.acquire_lease_script(keys=[f'cluster:probe:{self.liteserver_id(ls_index)}'], args=[self.instance_id, lease_ttl], client=pipe)
+            owned = await pipe.execute()
+
+        expire = int(self.settings.lease_ttl * 10)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for ls_index, is_owner in zip(ls_indices, owned):
+                worker_info = self.tonlib.workers[ls_index]
+                key = self.liteserver_id(ls_index)
+                # state of a liteserver probed by another instance is published by it
+                if is_owner and self.is_probing(ls_index):
+                    pipe.hset(f'cluster:health:{key}', mapping={'last_block': worker_info['last_block'],
+                                                                'is_archival': int(worker_info['is_archival']),
+                                                                'instance': self.instance_id})
+                    pipe.expire(f'cluster:health:{key}', expire)
+                if worker_info.get('latency') is not None:
+                    pipe.hset(f'cluster:latency:{key}', self.instance_id, worker_info['latency'])
+                    pipe.expire(f'cluster:latency:{key}', expire)
+            if self.tonlib.consensus_block.seqno > 0:
+                await self.update_consensus_script(keys=['cluster:consensus'], args=[self.tonlib.consensus_block.seqno, self.tonlib.consensus_block.timestamp], client=pipe)
+            pipe.hget('cluster:consensus', 'seqno')
+            for ls_index in ls_indices:
+                pipe.hgetall(f'cluster:health:{self.liteserver_id(ls_index)}')
+                pipe.hvals(f'cluster:latency:{self.liteserver_id(ls_index)}')
+            results = await pipe.execute()
+
+        # consensus block of the cluster is ahead if local liteservers lag behind
+        self.apply_consensus(results[-2 * len(ls_indices) - 1])
+        for i, (ls_index, is_owner) in enumerate(zip(ls_indices, owned)):
+            health, latencies = results[-2 * len(ls_indices) + 2 * i], results[-2 * len(ls_indices) + 2 * i + 1]
+            worker_info = self.tonlib.workers.get(ls_index)
+            if worker_info is None:
+                continue
+            if latencies:
+                worker_info['cluster_latency'] = sum(float(latency) for latency in latencies) / len(latencies)
+            await self.set_probing(ls_index, bool(is_owner))
+            if is_owner or not health:
+                continue
+            # last block of the local client is -1 until it is connected, then the cluster state is used
+            if worker_info['last_block'] != -1:
+                worker_info['last_block'] = int(health[b'last_block'])
+            worker_info['is_archival'] = health[b'is_archival'] == b'1'
+
+    async def run(self):
+        while True:
+            try:
+                if not self.loaded:
+                    await self.load()
+                await self.heartbeat()
+                await asyncio.sleep(self.settings.heartbeat_interval)
+            except asyncio.CancelledError:
+                logger.info('Task ClusterState.run was cancelled')
+                return
+            except:
+                logger.error('Task ClusterState.run exception: {format_exc}', format_exc=traceback.format_exc())
+                try:
+                    await self.fallback()
+                except:
+                    logger.error('ClusterState failed to restore probing: {format_exc}', format_exc=traceback.format_exc())
+                await asyncio.sleep(self.settings.heartbeat_interval)
@@ -0,0 +1,149 @@
+import asyncio
+import base64
+import hashlib
+import traceback
+
+from collections import OrderedDict
+
+from tvm_valuetypes.cell import deserialize_boc
+
+from loguru import logger
+
+
+MASTERCHAIN_SHARD = -9223372036854775808
+
+
+def read_label(bits, max_len):
+    """
+    Reads HmLabel of a hashmap node, returns label bits and position after the label.
+    """
+    width = max_len.bit_length()
+    if not bits[0]:
+        # hml_short$0 len:(Unary ~n) s:(n * Bit)
+        n = 0
+        while bits[1 + n]:
+            n += 1
+        pos = 2 + n
+        return bits[pos:pos + n], pos + n
+    if not bits[1]:
+        # hml_long$10 n:(#<= m) s:(n * Bit)
+        n = int(bits[2:2 + width].to01() or '0', 2)
+        pos = 2 + width
+        return bits[pos:pos + n], pos + n
+    # hml_same$11 v:Bit n:(#<= m)
+    n = int(bits[3:3 + width].to01() or '0', 2)
+    return bits[2:3] * n, 3 + width
+
+
+def parse_config_params(config_boc):
+    """
+    Splits full config cell (Hashmap 32 ^Cell) into params in the format of getConfigParam.
+    """
+    params = {}
+    nodes = [(deserialize_boc(config_boc), '', 32)]
+    while nodes:
+        cell, prefix, key_len = nodes.pop()
+        label, _ = read_label(cell.data.data, key_len)
+        prefix += label.to01()
+        key_len -= len(label)
+        if key_len == 0:
+            param = cell.refs[0].serialize_boc(has_idx=False, hash_crc32=False)
+            params[int(prefix, 2)] = {'@type': 'configInfo',
+                                      'config': {'@type': 'tvm.cell', 'bytes': base64.b64encode(param).decode('utf-8')}}
+        else:
+            nodes.append((cell.refs[0], prefix + '0', key_len - 1))
+            nodes.append((cell.refs[1], prefix + '1', key_len - 1))
+    return params
+
+
+class ConfigSnapshots:
+    """
+    Blockchain config only changes in key blocks. Snapshots of config params are kept in memory
+    by hash of the full config, a snapshot is built from one getConfigAll result per config version.
+    Config version of a masterchain block is the version of its last key block.
+
+    Latest config is checked when the consensus block moves and is loaded only when a new key
+    block appears. Params missing in a snapshot are requested from a liteserver.
+    """
+    max_snapshots = 16
+    max_key_blocks = 4096
+
+    def __init__(self, tonlib):
+        self.tonlib = tonlib
+        self.snapshots = OrderedDict()  # config hash -> {config_id: config info}
+        self.key_blocks = OrderedDict()  # key block seqno -> config hash
+        self.loading = {}  # key block seqno -> snapshot task
+        self.latest_key_block = None
+        self.consensus_seqno = 0
+
+    async def key_block_seqno(self, seqno):
+        header = await self.tonlib.getBlockHeader(-1, MASTERCHAIN_SHARD, seqno)
+        if header.get('@type', 'error') == 'error':
+            raise Exception(f"failed to get block header: {header}")
+        return seqno if header['is_key_block'] else header['prev_key_block_seqno']
+
+    async def load_snapshot(self, key_block_seqno):
+        config = await self.tonlib.get_config_all(key_block_seqno)
+        if config.get('@type', 'error') == 'error':
+            raise Exception(f"failed to get config: {config}")
+        config_boc = base64.b64decode(config['config']['bytes'])
+        config_hash = hashlib.sha256(config_boc).hexdigest()
+        if config_hash not in self.snapshots:
+            self.snapshots[config_hash] = parse_config_params(config_boc)
+            if len(self.snapshots) > self.max_snapshots:
+                self.snapshots.popitem(last=False)
+        self.key_blocks[key_block_seqno] = config_hash
+        if len(self.key_blocks) > self.max_key_blocks:
+            self.key_blocks.popitem(last=False)
+        return self.snapshots.get(config_hash, {})
+
+    async def snapshot(self, key_block_seqno):
+        config_hash = self.key_blocks.get(key_block_seqno)
+        if config_hash in self.snapshots:
+            self.key_blocks.move_to_end(key_block_seqno)
+            self.snapshots.move_to_end(config_hash)
+            return self.snapshots[config_hash]
+        task = self.loading.get(key_block_seqno)
+        if task is None:
+            task = self.loading[key_block_seqno] = asyncio.ensure_future(self.load_snapshot(key_block_seqno))
+            task.add_done_callback(lambda t: self.loading.pop(key_block_seqno, None))
+        return await asyncio.shield(task)
+
+    async def get_param(self, config_id, seqno=None):
+        """
+        Returns config param at masterchain block seqno or in the latest config.
+        """
+        if seqno is None:
+            if self.latest_key_block is None:
+                return await self.tonlib._get_config_param(config_id, None)
+            key_block_seqno = self.latest_key_block
+        else:
+            key_block_seqno = await self.key_block_seqno(seqno)
+
+        snapshot = await self.snapshot(key_block_seqno)
+        if config_id in snapshot:
+            return snapshot[config_id]
+        return await self.tonlib._get_config_param(config_id, key_block_seqno)
+
+    async def refresh(self):
+        consensus_seqno = self.tonlib.consensus_block.seqno
+        if consensus_seqno == 0 or consensus_seqno == self.consensus_seqno:
+            return
+        key_block_seqno = await self.key_block_seqno(consensus_seqno)
+        if key_block_seqno != self.latest_key_block:
+            await self.snapshot(key_block_seqno)
+            logger.info('Latest config is at key block {seqno}, hash: {config_hash}', seqno=key_block_seqno, config_hash=self.key_blocks.get(key_block_seqno))
+            self.latest_key_block = key_block_seqno
+        self.consensus_seqno = consensus_seqno
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                logger.info('Task ConfigSnapshots.run was cancelled')
+                return
+            except:
+                logger.warning('ConfigSnapshots failed to refresh config: {format_exc}', format_exc=traceback.format_exc())
+                await asyncio.sleep(1)
@@ -0,0 +1,145 @@
+import asyncio
+import time
+import traceback
+
+from collections import deque
+from typing import Optional
+
+from pyTON.settings import BlockIndexSettings
+
+from pytonlib.utils.address import detect_address
+from pytonlib.utils.common import hex_to_b64str
+
+from loguru import logger
+
+
+MASTERCHAIN_SHARD = -9223372036854775808
+
+
+def raw_address(address):
+    if isinstance(address, dict):
+        address = address.get('account_address', '')
+    if not address:
+        return None
+    return detect_address(address)['raw_form']
+
+
+class RecentBlockIndexer:
+    """
+    Follows new blocks and indexes their messages, so tryLocate* lookups of recent
+    transactions don't scan archival liteservers. Keeps transaction ids of the last
+    window_hours hours in memory.
+
+    Keys are ('in', source, destination, created_lt) for a transaction by its incoming message,
+    ('out', source, destination, created_lt) for a transaction by its outgoing message
+    and ('hash', msg_hash) for both.
+    """
+    max_catch_up_blocks = 16
+    # transactions per liteserver request, the limit of liteservers
+    page_size = 256
+
+    def __init__(self, tonlib, block_index_settings: BlockIndexSettings, loop: Optional[asyncio.BaseEventLoop]=None):
+        self.tonlib = tonlib
+        self.settings = block_index_settings
+        self.loop = loop or asyncio.get_running_loop()
+
+        self.transactions = {}  # key -> (account, lt, hash)
+        self.blocks = deque()  # (indexed_at, keys) in order of indexing
+        self.shards = {}  # (workchain, shard) -> last indexed seqno
+        self.last_mc_seqno = None
+
+        # requests of the indexer yield to client requests on the liteservers
+        self.task = self.tonlib.create_background_task(self.run())
+
+    async def shutdown(self):
+        self.task.cancel()
+        await self.task
+
+    def add_block(self, transactions):
+        keys = []
+        for tx in transactions:
+            account = tx.get('account') or raw_address(tx.get('address'))
+            tx_id = (account, int(tx['transaction_id']['lt']), tx['transaction_id']['hash'])
+
+            tx_keys = []
+            in_msg = tx.get('in_msg') or {}
+            source = raw_address(in_msg.get('source'))
+            if source is not None:
+                tx_keys.append(('in', source, account, int(in_msg['created_lt'])))
+            if in_msg.get('hash'):
+                tx_keys.append(('hash', in_msg['hash']))
+            for msg in tx.get('out_msgs', []):
+                destination = raw_address(msg.get('destination'))
+                if destination is not None:
+                    tx_keys.append(('out', account, destination, int(msg['created_lt'])))
+
+            for key in tx_keys:
+                self.transactions[key] = tx_id
+            keys.extend(tx_keys)
+        self.blocks.append((time.time(), keys))
+        self.evict()
+
+    def evict(self):
+        expire = time.time() - self.settings.window_hours * 3600
+        while self.blocks and (self.blocks[0][0] < expire or len(self.transactions) > self.settings.max_transactions):
+            _, keys = self.blocks.popleft()
+            for key in keys:
+                self.transactions.pop(key, None)
+
+    def lookup(self, key):
+        return self.transactions.get(key)
+
+    async def index_block(self, workchain, shard, seqno, root_hash=None, file_hash=None):
+        transactions = []
+        after_lt, after_hash = None, None
+        while len(transactions) < self.settings.max_block_transactions:
+            count = min(self.page_size, self.settings.max_block_transactions - len(transactions))
+            result = await self.tonlib.getBlockTransactionsExt(workchain, shard, seqno, count, root_hash, file_hash, after_lt, after_hash)
+            page = result.get('transactions', [])
+            transactions.extend(page)
+            if not result.get('incomplete') or not page:
+                break
+            # next pages are requested by the full block id, so the block is not looked up again
+            block_id = result.get('id') or {}
+            root_hash, file_hash = block_id.get('root_hash', root_hash), block_id.get('file_hash', file_hash)
+            account = page[-1].get('account') or raw_address(page[-1].get('address'))
+            after_lt, after_hash = page[-1]['transaction_id']['lt'], hex_to_b64str(account.split(':')[1])
+        self.add_block(transactions)
+
+    async def index_masterchain_block(self, mc_seqno):
+        shards = await self.tonlib.getShards(mc_seqno)
+        blocks = [(-1, MASTERCHAIN_SHARD, mc_seqno, None, None)]
+        last_shard_seqnos = {}
+        for shard_block in shards.get('shards', []):
+            workchain, shard, seqno = shard_block['workchain'], int(shard_block['shard']), shard_block['seqno']
+            last_seqno = self.shards.get((workchain, shard))
+            if last_seqno is not None and seqno <= last_seqno:
+                continue
+            if last_seqno is not None and seqno - last_seqno <= self.max_catch_up_blocks:
+                # shard blocks between masterchain blocks
+                blocks.extend((workchain, shard, s, None, None) for s in range(last_seqno + 1, seqno))
+            blocks.append((workchain, shard, seqno, shard_block.get('root_hash'), shard_block.get('file_hash')))
+            last_shard_seqnos[(workchain, shard)] = seqno
+        await asyncio.gather(*[self.index_block(*block) for block in blocks])
+        self.shards.update(last_shard_seqnos)
+
+    async def index_new_blocks(self):
+        masterchain_info = await self.tonlib.getMasterchainInfo()
+        last_seqno = masterchain_info['last']['seqno']
+        if self.last_mc_seqno is None or last_seqno - self.last_mc_seqno > self.max_catch_up_blocks:
+            self.last_mc_seqno = last_seqno - 1
+        for mc_seqno in range(self.last_mc_seqno + 1, last_seqno + 1):
+            await self.index_masterchain_block(mc_seqno)
+            self.last_mc_seqno = mc_seqno
+
+    async def run(self):
+        while True:
+            try:
+                await self.index_new_blocks()
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                logger.info('Task RecentBlockIndexer.run was cancelled')
+                return
+            except:
+                logger.warning('RecentBlockIndexer failed to index blocks: {format_exc}', format_exc=traceback.format_exc())
+                await asyncio.sleep(1)
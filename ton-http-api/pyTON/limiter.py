@@ -0,0 +1,247 @@
+import asyncio
+import ipaddress
+import json
+import math
+import time
+import traceback
+
+import redis.asyncio
+
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import parse_qs
+
+from pyTON.settings import RateLimitSettings
+from pyTON.models import TonResponse
+
+from loguru import logger
+
+
+# refills global bucket of the key, takes tokens consumed by the process since last sync
+# and returns tokens left. Redis time is used, so clocks of nodes don't matter
+SYNC_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local consumed = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate) - consumed
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+return tostring(tokens)
+"""
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated_at', 'consumed')
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = now
+        self.consumed = 0
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, weight: float, now: float):
+        """
+        Takes weight tokens and returns 0 or returns seconds to wait until tokens are available.
+        """
+        self.refill(now)
+        if self.tokens >= weight:
+            self.tokens -= weight
+            self.consumed += weight
+            return 0
+        return (weight - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    Per API key token buckets. Buckets are checked in-process and synced to Redis in batches
+    every sync_interval, so limits are shared by all webserver processes without a Redis
+    round-trip per request. Between syncs processes may overspend the limit by their local refill.
+    Buckets of keys idle for longer than the refill time are dropped, and least recently used
+    buckets are dropped above max_buckets.
+
+    Only configured API keys get own buckets, requests with unknown keys are limited as requests
+    without a key, so random keys don't bypass the limit.
+    """
+    max_buckets = 100000
+
+    def __init__(self, rate_limit_settings: RateLimitSettings):
+        self.settings = rate_limit_settings
+        self.api_keys = frozenset(self.settings.api_keys or [])
+        self.buckets = OrderedDict()
+        self.redis = None
+        self.sync_script = None
+        if self.settings.redis is not None:
+            self.redis = redis.asyncio.from_url(f"redis://{self.settings.redis.endpoint}:{self.settings.redis.port}",
+                                                socket_timeout=self.settings.redis.timeout)
+            self.sync_script = self.redis.register_script(SYNC_BUCKET_SCRIPT)
+        self.task = None
+
+    def start(self, loop: Optional[asyncio.BaseEventLoop]=None):
+        loop = loop or asyncio.get_running_loop()
+        self.task = loop.create_task(self.sync_buckets())
+
+    async def shutdown(self):
+        if self.task is not None:
+            self.task.cancel()
+            await self.task
+
+    def acquire(self, api_key: Optional[str], client: Optional[str], method: str):
+        if api_key in self.api_keys:
+            key, rate, burst = f'key:{api_key}', self.settings.rate, self.settings.burst
+        else:
+            key, rate, burst = f'ip:{client}', self.settings.no_key_rate, self.settings.no_key_burst
+        now = time.time()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(rate, burst, now)
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket.acquire(self.settings.method_weights.get(method, 1), now)
+
+    async def sync(self):
+        now = time.time()
+        keys = []
+        for key, bucket in list(self.buckets.items()):
+            if bucket.consumed == 0 and now - bucket.updated_at > bucket.burst / bucket.rate + 60:
+                # idle bucket is full, forget it
+                self.buckets.pop(key)
+            else:
+                keys.append(key)
+        if self.redis is None or not keys:
+            for key in keys:
+                self.buckets[key].consumed = 0
+            return
+
+        consumed = {key: self.buckets[key].consumed for key in keys}
+        for key in keys:
+            self.buckets[key].consumed = 0
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    bucket = self.buckets[key]
+                    await self.sync_script(keys=[f'ratelimit:{key}'], args=[bucket.rate, bucket.burst, consumed[key]], client=pipe)
+                results = await pipe.execute()
+        except Exception:
+            for key in keys:
+                if key in self.buckets:
+                    self.buckets[key].consumed += consumed[key]
+            raise
+
+        now = time.time()
+        for key, tokens in zip(keys, results):
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                continue
+            # tokens consumed while syncing are not in global state yet
+            bucket.tokens = min(bucket.burst, float(tokens)) - bucket.consumed
+            bucket.updated_at = now
+
+    async def sync_buckets(self):
+        while True:
+            try:
+                await self.sync()
+                await asyncio.sleep(self.settings.sync_interval)
+            except asyncio.CancelledError:
+                logger.info('Task RateLimiter.sync_buckets was cancelled')
+                return
+            except:
+                logger.error('Task RateLimiter.sync_buckets exception: {format_exc}', format_exc=traceback.format_exc())
+                await asyncio.sleep(self.settings.sync_interval)
+
+
+class RateLimitMiddleware:
+    """
+    ASGI middleware rejecting requests over API key limit before they reach handlers.
+    JSON-RPC requests are charged by the method in the body. Requests without API key are
+    limited by the client address, which is taken from X-Forwarded-For if the request came
+    from a trusted proxy.
+    """
+    def __init__(self, app, limiter: RateLimiter):
+        self.app = app
+        self.limiter = limiter
+        self.trusted_proxies = [ipaddress.ip_network(proxy, strict=False) for proxy in limiter.settings.trusted_proxies or []]
+
+    def is_trusted(self, address):
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        return any(address in network for network in self.trusted_proxies)
+
+    def client_address(self, scope):
+        client = scope['client'][0] if scope.get('client') else None
+        if client is None or not self.is_trusted(client):
+            return client
+        forwarded = b','.join(value for name, value in scope['headers'] if name == b'x-forwarded-for')
+        # the rightmost address not added by a trusted proxy is the client
+        for address in reversed(forwarded.decode('latin-1').split(',')):
+            address = address.strip()
+            if not address:
+                continue
+            client = address
+            if not self.is_trusted(address):
+                break
+        return client
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        method = scope['path'].rstrip('/').rsplit('/', 1)[-1]
+
+        api_key = None
+        for name, value in scope['headers']:
+            if name == b'x-api-key':
+                api_key = value.decode('latin-1')
+                break
+        if api_key is None and scope.get('query_string'):
+            api_key = parse_qs(scope['query_string'].decode('latin-1')).get('api_key', [None])[0]
+
+        if method == 'jsonRPC':
+            body = b''
+            more_body = True
+            while more_body:
+                message = await receive()
+                body += message.get('body', b'')
+                more_body = message.get('more_body', False)
+            try:
+                method = json.loads(body).get('method', method)
+            except Exception:
+                pass
+
+            # the body is replayed to the app, then messages come from the server again,
+            # so disconnects are seen by the app
+            body_sent = False
+            server_receive = receive
+            async def receive():
+                nonlocal body_sent
+                if body_sent:
+                    return await server_receive()
+                body_sent = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        client = self.client_address(scope)
+        retry_after = self.limiter.acquire(api_key, client, method)
+        if retry_after > 0:
+            res = TonResponse(ok=False, error='Ratelimit exceed', code=429)
+            content = json.dumps(res.dict(exclude_none=True)).encode('utf-8')
+            await send({'type': 'http.response.start',
+                        'status': 429,
+                        'headers': [(b'content-type', b'application/json'),
+                                    (b'content-length', str(len(content)).encode('latin-1')),
+                                    (b'retry-after', str(math.ceil(retry_after)).encode('latin-1'))]})
+            await send({'type': 'http.response.body', 'body': content})
+            return
+        return await self.app(scope, receive, send)
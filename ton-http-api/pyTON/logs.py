@@ -0,0 +1,105 @@
+import os
+import sys
+import atexit
+import threading
+import time
+import zlib
+
+from typing import Optional
+from multiprocessing import util
+from loguru import logger
+
+from pyTON.settings import LoggingSettings
+
+
+LEVELS = ['TRACE', 'DEBUG', 'INFO', 'SUCCESS', 'WARNING', 'ERROR', 'CRITICAL']
+
+# filled by setup_logging, everything is enabled until then
+_enabled_levels = set(LEVELS)
+_sample_rate = 1.0
+
+
+class BatchedWriter:
+    """
+    Loguru sink collecting lines in memory and writing them by a background thread in
+    batches, so logging call doesn't block on stdout. Chunks written at once don't exceed
+    PIPE_BUF, so lines of worker processes sharing stdout are not interleaved.
+    """
+    chunk_size = 4096
+
+    def __init__(self, fd: int, flush_interval: float=0.1):
+        self.fd = fd
+        self.flush_interval = flush_interval
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+        util.register_after_fork(self, BatchedWriter._register_finalizer)
+        atexit.register(self.flush)
+
+    def _register_finalizer(self):
+        # worker processes exit without atexit handlers
+        util.Finalize(self, self.flush, exitpriority=-1)
+
+    def _reset(self):
+        self.lock = threading.Lock()
+        self.lines = []
+        self.thread = None
+
+    def write(self, message):
+        with self.lock:
+            self.lines.append(message.encode('utf-8', errors='replace'))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def flush(self):
+        with self.lock:
+            lines, self.lines = self.lines, []
+        chunk = b''
+        for line in lines:
+            if chunk and len(chunk) + len(line) > self.chunk_size:
+                self._write(chunk)
+                chunk = b''
+            chunk += line
+        if chunk:
+            self._write(chunk)
+
+    def _write(self, data):
+        try:
+            while data:
+                data = data[os.write(self.fd, data):]
+        except OSError:
+            pass
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+
+def setup_logging(logging_settings: LoggingSettings, fd: Optional[int]=None):
+    global _enabled_levels, _sample_rate
+
+    min_level = logger.level(logging_settings.level).no
+    _enabled_levels = {level for level in LEVELS if logger.level(level).no >= min_level}
+    _sample_rate = logging_settings.sample_rate
+
+    logger.remove()
+    fd = sys.stdout.fileno() if fd is None else fd
+    logger.add(BatchedWriter(fd).write, level=logging_settings.level, serialize=logging_settings.jsonify)
+
+
+def log_enabled(level: str):
+    """
+    Cheap level check to skip building log records that would be filtered out.
+    """
+    return level in _enabled_levels
+
+
+def sampled(task_id: str):
+    """
+    Decides whether per-request logs of the task are written. Decision depends only on task id,
+    so the manager and the worker log the same tasks.
+    """
+    if _sample_rate >= 1:
+        return True
+    return zlib.crc32(task_id.encode('utf-8')) < _sample_rate * 0xFFFFFFFF
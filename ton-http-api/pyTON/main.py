@@ -4,13 +4,16 @@ import sys
 sys.setrecursionlimit(2048)
 
 import json
+import time
 import asyncio
 import base64
 import inspect
 import inject
 import codecs
+import hashlib
 
-from functools import wraps
+from contextvars import ContextVar
+from functools import wraps, lru_cache
 
 from typing import Optional, Union, Dict, Any, List
 from fastapi import FastAPI, Depends, Response, Request, BackgroundTasks
@@ -20,14 +23,19 @@ from starlette.exceptions import HTTPException as StarletteHTTPException
 from fastapi.responses import JSONResponse
 from fastapi import status
 
-from tvm_valuetypes.cell import deserialize_cell_from_object
-
 from pyTON.models import TonResponse, TonResponseJsonRPC, TonRequestJsonRPC
-from pyTON.manager import TonlibManager
+from pyTON.manager import TonlibManager, request_deadline
+from pyTON.send import ResendScheduler
+from pyTON.limiter import RateLimiter, RateLimitMiddleware
+from pyTON.middleware import CancelOnDisconnectMiddleware, CompressionMiddleware
+from pyTON.logs import setup_logging
+from pyTON.indexer import RecentBlockIndexer
+from pyTON.store import BlockStore
+from pyTON.offload import Offloader, LoopLagMonitor, cell_object_to_boc, cell_object_size
 from pyTON.cache import CacheManager, RedisCacheManager, DisabledCacheManager
 from pyTON.settings import Settings, RedisCacheSettings
 
-from pytonlib.utils.address import detect_address as __detect_address, prepare_address as _prepare_address
+from pytonlib.utils.address import detect_address as __detect_address
 from pytonlib.utils.wallet import wallets as known_wallets, sha256
 from pytonlib.utils.common import hash_to_hex, hex_to_b64str
 from pytonlib import TonlibException, TonlibError
@@ -66,6 +74,8 @@ In addition to REST API, all methods are available through [JSON-RPC endpoint](#
 The response contains a JSON object, which always has a boolean field `ok` and either `error` or `result`. If `ok` equals true, the request was successful and the result of the query can be found in the `result` field. In case of an unsuccessful request, `ok` equals false and the error is explained in the `error`.
 
 API Key should be sent either as `api_key` query parameter or `X-API-Key` header.
+
+Responses of `getAddressInformation`, `getWalletInformation`, `getAddressBalance` and `getTransactions` have an `ETag` header. Send it in `If-None-Match` header to get an empty `304 Not Modified` response while the account is unchanged.
 """
 
 tags_metadata = [
@@ -116,29 +126,63 @@ app = FastAPI(
     openapi_tags=tags_metadata
 )
 
+rate_limiter = None
+if settings.rate_limit.enabled:
+    rate_limiter = RateLimiter(settings.rate_limit)
+    app.add_middleware(RateLimitMiddleware, limiter=rate_limiter)
 
 tonlib = None
+resend_scheduler = None
+block_indexer = None
+offloader = None
+loop_lag_monitor = None
 
 @app.on_event("startup")
 async def startup():
-    logger.remove()
-    logger.add(sys.stdout, level=settings.logging.level, enqueue=True, serialize=settings.logging.jsonify)
+    setup_logging(settings.logging)
 
     # setup tonlib multiclient
     global tonlib
+    global resend_scheduler
+    global block_indexer
+    global offloader
+    global loop_lag_monitor
 
     loop = asyncio.get_event_loop()
     cache_manager = inject.instance(CacheManager)
+    block_store = BlockStore(settings.block_store) if settings.block_store.enabled else None
     tonlib = TonlibManager(tonlib_settings=settings.tonlib,
                            dispatcher=None,
                            cache_manager=cache_manager,
-                           loop=loop)
+                           loop=loop,
+                           send_settings=settings.send,
+                           block_store=block_store,
+                           timeline_settings=settings.timeline,
+                           config_snapshot_settings=settings.config_snapshots,
+                           prefetch_settings=settings.prefetch,
+                           transaction_cache_settings=settings.transaction_cache,
+                           cluster_settings=settings.cluster,
+                           retry_settings=settings.retry)
+    resend_scheduler = ResendScheduler(tonlib, settings.send, loop)
+    if settings.block_index.enabled:
+        block_indexer = RecentBlockIndexer(tonlib, settings.block_index, loop)
+    if rate_limiter is not None:
+        rate_limiter.start(loop)
+    offloader = Offloader(settings.offload)
+    loop_lag_monitor = LoopLagMonitor(settings.loop_lag, loop)
 
     await asyncio.sleep(2) # wait for manager to spawn all workers and report their status
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    if rate_limiter is not None:
+        await rate_limiter.shutdown()
+    if block_indexer is not None:
+        await block_indexer.shutdown()
+    await resend_scheduler.shutdown()
     await tonlib.shutdown()
+    await loop_lag_monitor.shutdown()
+    offloader.shutdown()
 
 
 @app.middleware("http")
@@ -147,6 +191,10 @@ async def add_process_time_header(request: Request, call_next):
     response.headers["X-API-Version"] = pkg_version
     return response
 
+app.add_middleware(CancelOnDisconnectMiddleware)
+if settings.compression.enabled:
+    app.add_middleware(CompressionMiddleware, compression_settings=settings.compression)
+
 
 # Exception handlers
 @app.exception_handler(StarletteHTTPException)
@@ -182,17 +230,22 @@ async def fastapi_generic_exception_handler(request, exc):
 
 
 # Helper functions
+@lru_cache(maxsize=settings.webserver.address_cache_size)
+def _parse_address(address):
+    # parsed forms are shared by requests and must not be modified
+    return __detect_address(address)
+
 def _detect_address(address):
     try:
-        return __detect_address(address)
+        return _parse_address(address)
     except:
         raise HTTPException(status_code=416, detail="Incorrect address")
 
 def prepare_address(address):
-    try:
-        return _prepare_address(address)
-    except:
-        raise HTTPException(status_code=416, detail="Incorrect address")
+    address = _detect_address(address)
+    if 'non_bounceable' in address['given_type']:
+        return address['non_bounceable']['b64']
+    return address['bounceable']['b64']
 
 def prepare_hash(value):
     if value is None:
@@ -216,13 +269,77 @@ def address_state(account_info):
             return "frozen"
     return "active"
 
+@lru_cache(maxsize=4096)
+def code_hash(code):
+    # account states restored from the blob store share code objects, so the lookup doesn't rehash the code
+    return sha256(code)
+
 def wrap_result(func):
     @wraps(func)
     async def wrapper(*args, **kwargs):
-        result = await asyncio.wait_for(func(*args, **kwargs), settings.tonlib.request_timeout)
+        token = request_deadline.set(time.time() + settings.tonlib.request_timeout)
+        try:
+            result = await asyncio.wait_for(func(*args, **kwargs), settings.tonlib.request_timeout)
+        finally:
+            request_deadline.reset(token)
         return TonResponse(ok=True, result=result)
     return wrapper
 
+# version of the account the response is built from, set by account endpoints for ETag
+response_account_version = ContextVar('response_account_version', default=None)
+
+def set_account_version(transaction_id):
+    holder = response_account_version.get()
+    if holder is not None and transaction_id:
+        holder['version'] = (str(transaction_id['lt']), transaction_id['hash'])
+
+def make_etag(request: Request, version):
+    query = sorted((k, v) for k, v in request.query_params.multi_items() if k != 'api_key')
+    digest = hashlib.sha1(repr((request.url.path, query, version)).encode('utf-8')).hexdigest()
+    return f'W/"{digest}"'
+
+def account_etag(func):
+    """
+    Conditional requests for account endpoints. ETag is derived from the last transaction id
+    of the account, so polls of an unchanged account get 304 without a body. Latest account
+    version is checked once per block by the manager. Responses at a given seqno or transaction
+    are immutable.
+    """
+    @wraps(func)
+    async def wrapper(request: Request, response: Response, **kwargs):
+        immutable = kwargs.get('seqno') is not None or (kwargs.get('lt') is not None and kwargs.get('hash') is not None)
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match:
+            version = 'immutable'
+            if not immutable:
+                try:
+                    version = await tonlib._account_version(prepare_address(kwargs['address']))
+                except HTTPException:
+                    raise
+                except Exception:
+                    version = None
+            if version is not None:
+                etag = make_etag(request, version)
+                if etag in if_none_match:
+                    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        holder = {}
+        token = response_account_version.set(holder)
+        try:
+            result = await func(**kwargs)
+        finally:
+            response_account_version.reset(token)
+        version = 'immutable' if immutable else holder.get('version')
+        if version is not None:
+            response.headers['ETag'] = make_etag(request, version)
+        return result
+
+    sig = inspect.signature(func)
+    params = [inspect.Parameter('request', inspect.Parameter.KEYWORD_ONLY, annotation=Request),
+              inspect.Parameter('response', inspect.Parameter.KEYWORD_ONLY, annotation=Response)]
+    wrapper.__signature__ = sig.replace(parameters=[p.replace(kind=inspect.Parameter.KEYWORD_ONLY) for p in sig.parameters.values()] + params)
+    return wrapper
+
 json_rpc_methods = {}
 
 def json_rpc(method):
@@ -267,8 +384,14 @@ async def healthcheck():
 async def get_worker_state():
     return tonlib.get_workers_state()
 
+@app.get('/getLoopLag', response_model=TonResponse, include_in_schema=False)
+@wrap_result
+async def get_loop_lag():
+    return loop_lag_monitor.get_state()
+
 
 @app.get('/getAddressInformation', response_model=TonResponse, response_model_exclude_none=True, tags=['accounts'])
+@account_etag
 @json_rpc('getAddressInformation')
 @wrap_result
 async def get_address_information(
@@ -280,6 +403,7 @@ async def get_address_information(
     """
     address = prepare_address(address)
     result = await tonlib.raw_get_account_state(address, seqno)
+    set_account_version(result.get("last_transaction_id"))
     result["state"] = address_state(result)
     if "balance" in result and int(result["balance"]) < 0:
         result["balance"] = 0
@@ -300,6 +424,7 @@ async def get_extended_address_information(
     return result
 
 @app.get('/getWalletInformation', response_model=TonResponse, response_model_exclude_none=True, tags=['accounts'])
+@account_etag
 @json_rpc('getWalletInformation')
 @wrap_result
 async def get_wallet_information(
@@ -311,13 +436,14 @@ async def get_wallet_information(
     """
     address = prepare_address(address)
     result = await tonlib.raw_get_account_state(address, seqno)
+    set_account_version(result.get("last_transaction_id"))
     res = {'wallet': False, 'balance': 0, 'extra_currencies': [], 'account_state': None, 'wallet_type': None, 'seqno': None}
     res["account_state"] = address_state(result)
     res["balance"] = result["balance"] if (result["balance"] and int(result["balance"]) > 0) else 0
     res["extra_currencies"] = result["extra_currencies"]
     if "last_transaction_id" in result:
         res["last_transaction_id"] = result["last_transaction_id"]
-    ci = sha256(result["code"])
+    ci = code_hash(result["code"])
     if ci in known_wallets:
         res["wallet"] = True
         wallet_handler = known_wallets[ci]
@@ -326,6 +452,7 @@ async def get_wallet_information(
     return res
 
 @app.get('/getTransactions', response_model=TonResponse, response_model_exclude_none=True, tags=['accounts', 'transactions'])
+@account_etag
 @json_rpc('getTransactions')
 @wrap_result
 async def get_transactions(
@@ -340,9 +467,13 @@ async def get_transactions(
     Get transaction history of a given address.
     """
     address = prepare_address(address)
-    return await tonlib.get_transactions(address, from_transaction_lt=lt, from_transaction_hash=hash, to_transaction_lt=to_lt, limit=limit, archival=archival)
+    result = await tonlib.get_transactions(address, from_transaction_lt=lt, from_transaction_hash=hash, to_transaction_lt=to_lt, limit=limit, archival=archival)
+    if result:
+        set_account_version(result[0]['transaction_id'])
+    return result
 
 @app.get('/getAddressBalance', response_model=TonResponse, response_model_exclude_none=True, tags=['accounts'])
+@account_etag
 @json_rpc('getAddressBalance')
 @wrap_result
 async def get_address_balance(
@@ -354,6 +485,7 @@ async def get_address_balance(
     """
     address = prepare_address(address)
     result = await tonlib.raw_get_account_state(address, seqno)
+    set_account_version(result.get("last_transaction_id"))
     if "balance" in result and int(result["balance"]) < 0:
         result["balance"] = 0
     return result["balance"]
@@ -562,6 +694,21 @@ async def get_token_data(
     except Exception as exc:
         raise TonlibException(exc)
 
+async def locate_tx(direction, source, destination, created_lt):
+    """
+    Looks up recent transactions in the block index and falls back to scanning blocks on liteservers.
+    """
+    if block_indexer is not None:
+        tx_id = block_indexer.lookup((direction, _detect_address(source)['raw_form'], _detect_address(destination)['raw_form'], int(created_lt)))
+        if tx_id is not None:
+            account, lt, tx_hash = tx_id
+            txs = await tonlib.get_transactions(account, from_transaction_lt=lt, from_transaction_hash=tx_hash, limit=1)
+            if txs:
+                return txs[0]
+    if direction == 'in':
+        return await tonlib.tryLocateTxByIncomingMessage(source, destination, created_lt)
+    return await tonlib.tryLocateTxByOutcomingMessage(source, destination, created_lt)
+
 @app.get('/tryLocateTx', response_model=TonResponse, response_model_exclude_none=True, tags=['transactions'])
 @json_rpc('tryLocateTx')
 @wrap_result
@@ -573,7 +720,7 @@ async def get_try_locate_tx(
     """
     Locate outcoming transaction of *destination* address by incoming message.
     """
-    return await tonlib.tryLocateTxByIncomingMessage(source, destination, created_lt)
+    return await locate_tx('in', source, destination, created_lt)
 
 @app.get('/tryLocateResultTx', response_model=TonResponse, response_model_exclude_none=True, tags=['transactions'])
 @json_rpc('tryLocateResultTx')
@@ -586,7 +733,7 @@ async def get_try_locate_result_tx(
     """
     Same as previous. Locate outcoming transaction of *destination* address by incoming message
     """
-    return await tonlib.tryLocateTxByIncomingMessage(source, destination, created_lt)
+    return await locate_tx('in', source, destination, created_lt)
 
 @app.get('/tryLocateSourceTx', response_model=TonResponse, response_model_exclude_none=True, tags=['transactions'])
 @json_rpc('tryLocateSourceTx')
@@ -599,7 +746,7 @@ async def get_try_locate_source_tx(
     """
     Locate incoming transaction of *source* address by outcoming message.
     """
-    return await tonlib.tryLocateTxByOutcomingMessage(source, destination, created_lt)
+    return await locate_tx('out', source, destination, created_lt)
 
 @app.get('/detectAddress', response_model=TonResponse, response_model_exclude_none=True, tags=['accounts'])
 @json_rpc('detectAddress')
@@ -612,6 +759,28 @@ async def detect_address(
     """
     return _detect_address(address)
 
+@app.post('/detectAddresses', response_model=TonResponse, response_model_exclude_none=True, tags=['accounts'])
+@json_rpc('detectAddresses')
+@wrap_result
+async def detect_addresses(
+    addresses: List[str] = Body(..., embed=True, description="Identifiers of TON accounts in any form.")
+    ):
+    """
+    Get all possible forms of multiple addresses. Result has the same order as *addresses*, incorrect addresses are returned as `null`.
+    """
+    if len(addresses) > settings.webserver.max_bulk_addresses:
+        raise HTTPException(status_code=400, detail=f"Too many addresses, maximum is {settings.webserver.max_bulk_addresses}")
+    result = []
+    for i, address in enumerate(addresses):
+        if i % 256 == 255:
+            # uncached addresses take ~0.2 ms each, let other requests run
+            await asyncio.sleep(0)
+        try:
+            result.append(_parse_address(address))
+        except:
+            result.append(None)
+    return result
+
 @app.post('/sendBoc', response_model=TonResponse, response_model_exclude_none=True, tags=['send'])
 @json_rpc('sendBoc')
 @wrap_result
@@ -636,29 +805,18 @@ async def send_boc_return_hash(
     boc = base64.b64decode(boc)
     return await tonlib.raw_send_message_return_hash(boc)
 
-async def send_boc_unsafe_task(boc_bytes: bytes):
-    send_interval = 5
-    send_duration = 60
-    for i in range(int(send_duration / send_interval)):
-        try:
-            await tonlib.raw_send_message(boc_bytes)
-        except:
-            pass
-        await asyncio.sleep(send_interval)
-
 @app.post('/sendBocUnsafe', response_model=TonResponse, response_model_exclude_none=True, include_in_schema=False, tags=['send'])
 @json_rpc('sendBocUnsafe')
 @wrap_result
 async def send_boc_unsafe(
-    background_tasks: BackgroundTasks,
     boc: str = Body(..., embed=True, description="b64 encoded bag of cells")
     ):
     """
-    Unsafe send serialized boc file: fully packed and serialized external message to blockchain. This method creates
-    background task that sends boc to network every 5 seconds for 1 minute.
+    Unsafe send serialized boc file: fully packed and serialized external message to blockchain. The message is
+    resent to network every 5 seconds for 1 minute or until it is found on-chain.
     """
     boc = base64.b64decode(boc)
-    background_tasks.add_task(send_boc_unsafe_task, boc)
+    resend_scheduler.schedule(boc)
     return {'@type': 'ok', '@extra': '0:0:0'}
 
 @app.post('/sendCellSimple', response_model=TonResponse, response_model_exclude_none=True, include_in_schema=False, tags=['send'])
@@ -671,8 +829,8 @@ async def send_cell(
     (Deprecated) Send cell as object: `{"data": {"b64": "...", "len": int }, "refs": [...subcells...]}`, that is fully packed but not serialized external message.
     """
     try:
-        cell = deserialize_cell_from_object(cell)
-        boc = codecs.encode(cell.serialize_boc(), 'base64')
+        boc = await offloader.run(cell_object_size(cell), cell_object_to_boc, cell)
+        boc = codecs.encode(boc, 'base64')
     except:
         raise HTTPException(status_code=400, detail="Error while parsing cell")
     return await tonlib.raw_send_message(boc)
@@ -709,12 +867,12 @@ async def send_query_cell(
     """
     address = prepare_address(address)
     try:
-        body = deserialize_cell_from_object(body).serialize_boc(has_idx=False)
+        body = await offloader.run(cell_object_size(body), cell_object_to_boc, body, False)
         qcode, qdata = b'', b''
         if init_code is not None:
-            qcode = deserialize_cell_from_object(init_code).serialize_boc(has_idx=False)
+            qcode = await offloader.run(cell_object_size(init_code), cell_object_to_boc, init_code, False)
         if init_data is not None:
-            qdata = deserialize_cell_from_object(init_data).serialize_boc(has_idx=False)
+            qdata = await offloader.run(cell_object_size(init_data), cell_object_to_boc, init_data, False)
     except:
         raise HTTPException(status_code=400, detail="Error while parsing cell object")
     return await tonlib.raw_create_and_send_query(address, body, init_code=qcode, init_data=qdata)
@@ -753,12 +911,12 @@ async def estimate_fee_cell(
     """
     address = prepare_address(address)
     try:
-        body = deserialize_cell_from_object(body).serialize_boc(has_idx=False)
+        body = await offloader.run(cell_object_size(body), cell_object_to_boc, body, False)
         qcode, qdata = b'', b''
         if init_code is not None:
-            qcode = deserialize_cell_from_object(init_code).serialize_boc(has_idx=False)
+            qcode = await offloader.run(cell_object_size(init_code), cell_object_to_boc, init_code, False)
         if init_data is not None:
-            qdata = deserialize_cell_from_object(init_data).serialize_boc(has_idx=False)
+            qdata = await offloader.run(cell_object_size(init_data), cell_object_to_boc, init_data, False)
     except:
         raise HTTPException(status_code=400, detail="Error while parsing cell object")
     return await tonlib.raw_estimate_fees(address, body, init_code=qcode, init_data=qdata, ignore_chksig=ignore_chksig)
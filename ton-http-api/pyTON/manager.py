@@ -2,19 +2,28 @@ import asyncio
 import time
 import traceback
 import random
+import pickle
 import queue
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from contextvars import ContextVar
 from collections.abc import Mapping
 from copy import deepcopy
 from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 
-from pyTON.worker import TonlibWorker
-from pyTON.models import TonlibWorkerMsgType, TonlibClientResult, ConsensusBlock
+from pyTON.worker import TonlibWorker, release_shared_memory, drop_result
+from pyTON.models import TonlibWorkerMsgType, TonlibClientResult, ConsensusBlock, SharedMemoryResult, PickledResult, TonlibTaskPriority
 from pyTON.cache import CacheManager, DisabledCacheManager
-from pyTON.settings import TonlibSettings
-
-from pytonlib import TonlibError
+from pyTON.store import BlockStore, DisabledBlockStore
+from pyTON.timeline import MasterchainTimeline
+from pyTON.config import ConfigSnapshots
+from pyTON.transactions import TransactionCache
+from pyTON.cluster import ClusterState
+from pyTON.retry import RetryEngine
+from pyTON.settings import TonlibSettings, SendSettings, TimelineSettings, ConfigSnapshotSettings, PrefetchSettings, TransactionCacheSettings, ClusterSettings, RetrySettings
+from pyTON.send import parse_external_message
+from pyTON.logs import log_enabled, sampled
 
 from typing import Optional, Dict, Any
 from dataclasses import dataclass
@@ -23,55 +32,128 @@ from datetime import datetime
 from loguru import logger
 
 
+# absolute deadline of the request being served, set by the webserver
+request_deadline = ContextVar('request_deadline', default=None)
+# priority of liteserver tasks overriding the one by method, set for speculative work
+request_priority = ContextVar('request_priority', default=None)
+
+SEND_METHODS = {'raw_send_message', 'raw_send_message_return_hash', '_raw_send_query', 'raw_create_and_send_query', 'raw_create_and_send_message'}
+
+# heavy method -> index of its page size argument, the cost of methods without one is fixed
+HEAVY_METHODS = {
+    'get_block_transactions': 3,
+    'get_block_transactions_ext': 3,
+    'raw_get_block_transactions': 1,
+    'get_transactions': 4,
+    'raw_get_transactions': None,
+    'try_locate_tx_by_incoming_message': None,
+    'try_locate_tx_by_outcoming_message': None,
+    'lookup_block': None,
+}
+
+
+def task_priority(method, args):
+    """
+    Returns priority class and cost estimate of a liteserver task.
+    """
+    if method in SEND_METHODS:
+        return TonlibTaskPriority.SEND, 1
+    if method in HEAVY_METHODS:
+        count_index = HEAVY_METHODS[method]
+        if count_index is not None and len(args) > count_index and isinstance(args[count_index], int):
+            return TonlibTaskPriority.HEAVY, max(1, args[count_index] / 10)
+        return TonlibTaskPriority.HEAVY, 4
+    return TonlibTaskPriority.LIGHT, 1
+
+
 class TonlibManager:
+    max_account_versions = 100000
+    worker_join_timeout = 3
+
     def __init__(self,
                  tonlib_settings: TonlibSettings,
                  dispatcher: Optional["Dispatcher"]=None,
                  cache_manager: Optional["CacheManager"]=None,
-                 loop: Optional[asyncio.BaseEventLoop]=None):
+                 loop: Optional[asyncio.BaseEventLoop]=None,
+                 send_settings: Optional[SendSettings]=None,
+                 block_store: Optional[BlockStore]=None,
+                 timeline_settings: Optional[TimelineSettings]=None,
+                 config_snapshot_settings: Optional[ConfigSnapshotSettings]=None,
+                 prefetch_settings: Optional[PrefetchSettings]=None,
+                 transaction_cache_settings: Optional[TransactionCacheSettings]=None,
+                 cluster_settings: Optional[ClusterSettings]=None,
+                 retry_settings: Optional[RetrySettings]=None):
         self.tonlib_settings = tonlib_settings
+        self.send_settings = send_settings or SendSettings()
         self.dispatcher = dispatcher
         self.cache_manager = cache_manager or DisabledCacheManager()
+        self.block_store = block_store or DisabledBlockStore()
+        self.timeline_settings = timeline_settings or TimelineSettings()
+        self.config_snapshot_settings = config_snapshot_settings or ConfigSnapshotSettings()
+        self.prefetch_settings = prefetch_settings or PrefetchSettings()
+        self.transaction_cache_settings = transaction_cache_settings or TransactionCacheSettings()
+        self.cluster_settings = cluster_settings or ClusterSettings()
+        self.retry_settings = retry_settings or RetrySettings()
 
         self.workers = {}
         self.futures = {}
         self.tasks = {}
+        self.sent_messages = OrderedDict()  # (method, msg_hash) -> [broadcast task, expires_at]
+        self.account_versions = OrderedDict()  # address -> (consensus seqno, account state task)
         self.consensus_block = ConsensusBlock()
+        self.timeline = MasterchainTimeline(self, self.timeline_settings)
+        self.config_snapshots = ConfigSnapshots(self) if self.config_snapshot_settings.enabled else None
+        self.transaction_cache = TransactionCache(self, self.transaction_cache_settings, self.prefetch_settings) if self.transaction_cache_settings.enabled else None
+        self.cluster = ClusterState(self, self.cluster_settings) if self.cluster_settings.enabled else None
+        self.retry = RetryEngine(self, self.retry_settings)
 
         # cache setup
         self.setup_cache()
 
         self.threadpool_executor = ThreadPoolExecutor(max_workers=max(32, len(self.tonlib_settings.liteserver_config['liteservers']) * 4))
 
+        # known liteservers, ls_index is a position in this list. Entries are never removed,
+        # so indices of running workers stay stable across config reloads
+        self.liteservers = list(self.tonlib_settings.liteserver_config['liteservers'])
+
         # workers spawn
         self.loop = loop or asyncio.get_running_loop()
-        for ls_index in range(len(self.tonlib_settings.liteserver_config['liteservers'])):
-            self.spawn_worker(ls_index)
+        for ls_indices in self.pack_liteservers(range(len(self.liteservers))):
+            self.spawn_worker(ls_indices)
 
         # running tasks
         self.tasks['check_working'] = self.loop.create_task(self.check_working())
         self.tasks['check_children_alive'] = self.loop.create_task(self.check_children_alive())
+        if self.timeline_settings.enabled:
+            self.tasks['timeline'] = self.loop.create_task(self.timeline.run())
+        if self.config_snapshots is not None:
+            self.tasks['config_snapshots'] = self.loop.create_task(self.config_snapshots.run())
+        if self.cluster is not None:
+            self.tasks['cluster'] = self.loop.create_task(self.cluster.run())
+        if self.tonlib_settings.liteserver_config_reload_interval > 0:
+            self.tasks['reload_liteserver_config'] = self.loop.create_task(self.reload_liteserver_config())
 
     async def shutdown(self):
         for i in self.futures:
             self.futures[i].cancel()
-        
-        self.tasks['check_working'].cancel()
-        await self.tasks['check_working']
-        
-        self.tasks['check_children_alive'].cancel()
-        await self.tasks['check_children_alive']
 
-        await asyncio.wait([self.loop.create_task(self.worker_control(i, enabled=False)) for i in self.workers])
+        for task in list(self.tasks.values()):
+            task.cancel()
+            await task
+
+        processes = {id(worker_info['worker']): ls_index for ls_index, worker_info in self.workers.items()}
+        await asyncio.wait([self.loop.create_task(self.worker_control(i, enabled=False)) for i in processes.values()])
 
         self.threadpool_executor.shutdown()
+        self.block_store.close()
 
     def setup_cache(self):
         self.raw_get_transactions = self.cache_manager.cached(expire=5)(self.raw_get_transactions)
-        self.get_transactions = self.cache_manager.cached(expire=15, check_error=False)(self.get_transactions)
-        self.raw_get_account_state = self.cache_manager.cached(expire=5)(self.raw_get_account_state)
-        self.generic_get_account_state = self.cache_manager.cached(expire=5)(self.generic_get_account_state)
-        self.raw_run_method = self.cache_manager.cached(expire=5)(self.raw_run_method)
+        # fetched parts of history are shared by webserver processes, each keeps its own transaction cache on top
+        self._get_transactions = self.cache_manager.cached(expire=15, check_error=False)(self._get_transactions)
+        self.raw_get_account_state = self.cache_manager.cached(expire=5, intern_blobs=True)(self.raw_get_account_state)
+        self.generic_get_account_state = self.cache_manager.cached(expire=5, intern_blobs=True)(self.generic_get_account_state)
+        self._raw_run_method = self.cache_manager.cached(expire=600)(self._raw_run_method)
         self.raw_estimate_fees = self.cache_manager.cached(expire=5)(self.raw_estimate_fees)
         self.getMasterchainInfo = self.cache_manager.cached(expire=1)(self.getMasterchainInfo)
         self.getMasterchainBlockSignatures = self.cache_manager.cached(expire=5)(self.getMasterchainBlockSignatures)
@@ -87,37 +169,64 @@ class TonlibManager:
         self.tryLocateTxByOutcomingMessage = self.cache_manager.cached(expire=600, check_error=False)(self.tryLocateTxByOutcomingMessage)
         self.tryLocateTxByIncomingMessage = self.cache_manager.cached(expire=600, check_error=False)(self.tryLocateTxByIncomingMessage)
 
-    def spawn_worker(self, ls_index, force_restart=False):
-        if ls_index in self.workers:
-            worker_info = self.workers[ls_index]
-            if not force_restart and worker_info.is_alive():
-                logger.warning('Worker for liteserver #{ls_index} already exists', ls_index=ls_index)
+        # immutable block data is served from the persistent store first
+        by_seqno = lambda workchain, shard, seqno=None, lt=None, unixtime=None: seqno is not None and lt is None and unixtime is None
+        self.lookupBlock = self.block_store.stored(by_seqno)(self.lookupBlock)
+        self.getShards = self.block_store.stored(lambda master_seqno=None, lt=None, unixtime=None: master_seqno is not None and lt is None and unixtime is None)(self.getShards)
+        self.getBlockHeader = self.block_store.stored()(self.getBlockHeader)
+        self.raw_getBlockTransactions = self.block_store.stored()(self.raw_getBlockTransactions)
+        self.getBlockTransactions = self.block_store.stored()(self.getBlockTransactions)
+        self.getBlockTransactionsExt = self.block_store.stored()(self.getBlockTransactionsExt)
+        self.getMasterchainBlockSignatures = self.block_store.stored()(self.getMasterchainBlockSignatures)
+        self.get_config_all = self.block_store.stored()(self.get_config_all)
+        self.getShardBlockProof = self.block_store.stored(lambda workchain, shard, seqno, from_seqno=None: from_seqno is not None)(self.getShardBlockProof)
+
+    def pack_liteservers(self, ls_indices):
+        ls_indices = list(ls_indices)
+        per_worker = max(1, self.tonlib_settings.liteservers_per_worker)
+        return [ls_indices[i:i + per_worker] for i in range(0, len(ls_indices), per_worker)]
+
+    def spawn_worker(self, ls_indices, force_restart=False):
+        old_workers = {self.workers[ls_index]['worker']: self.workers[ls_index]['reader'] for ls_index in ls_indices if ls_index in self.workers}
+        for worker, reader in old_workers.items():
+            if not force_restart and worker.is_alive():
+                logger.warning('Worker for liteservers {ls_indices} already exists', ls_indices=worker.ls_indices)
                 return
             try:
-                worker_info['reader'].cancel()  
-                worker_info['worker'].exit_event.set()
-                worker_info['worker'].output_queue.cancel_join_thread()
-                worker_info['worker'].input_queue.cancel_join_thread()
-                worker_info['worker'].output_queue.close()
-                worker_info['worker'].input_queue.close()
-                worker_info['worker'].join(timeout=3)
+                reader.cancel()
+                worker.exit_event.set()
+                worker.output_queue.cancel_join_thread()
+                worker.input_queue.cancel_join_thread()
+                worker.output_queue.close()
+                worker.input_queue.close()
+                worker.join(timeout=3)
+                release_shared_memory(worker.shm_prefix)
             except Exception as ee:
                 logger.error('Failed to delete existing process: {exc}', exc=ee)
         # running new worker
-        if not ls_index in self.workers:
-            self.workers[ls_index] = {
-                'is_working': False,
-                'is_enabled': True,
-                'restart_count': -1,
-                'tasks_count': 0
-            }
-        
-        tonlib_settings = deepcopy(self.tonlib_settings)
-        tonlib_settings.keystore += f'worker_{ls_index}'
-        self.workers[ls_index]['worker'] = TonlibWorker(ls_index, tonlib_settings)
-        self.workers[ls_index]['reader'] = self.loop.create_task(self.read_results(ls_index))
-        self.workers[ls_index]['worker'].start()
-        self.workers[ls_index]['restart_count'] += 1
+        for ls_index in ls_indices:
+            if not ls_index in self.workers:
+                self.workers[ls_index] = {
+                    'is_working': False,
+                    'is_enabled': True,
+                    'is_draining': False,
+                    'is_archival': False,
+                    'last_block': -1,
+                    'restart_count': -1,
+                    'tasks_count': 0,
+                    'latency': None
+                }
+
+        worker = TonlibWorker(ls_indices, deepcopy(self.tonlib_settings))
+        reader = self.loop.create_task(self.read_results(worker))
+        worker.start()
+        for ls_index in ls_indices:
+            self.workers[ls_index]['worker'] = worker
+            self.workers[ls_index]['reader'] = reader
+            self.workers[ls_index]['restart_count'] += 1
+            if self.cluster is not None:
+                # new process probes its liteservers until told otherwise
+                self.cluster.probing.pop(ls_index, None)
 
     async def worker_control(self, ls_index, enabled):
         if enabled == False:
@@ -129,13 +238,81 @@ class TonlibManager:
             self.workers[ls_index]['worker'].output_queue.close()
             self.workers[ls_index]['worker'].input_queue.close()
 
-            self.workers[ls_index]['worker'].join()
-            
+            await self.join_worker(self.workers[ls_index]['worker'])
+
             await self.workers[ls_index]['reader']
+            release_shared_memory(self.workers[ls_index]['worker'].shm_prefix)
 
         self.workers[ls_index]['is_enabled'] = enabled
 
+    async def join_worker(self, worker):
+        # joined in the thread pool, a process slow to exit doesn't block the event loop
+        await self.loop.run_in_executor(self.threadpool_executor, worker.join, self.worker_join_timeout)
+        if worker.is_alive():
+            logger.warning('Worker for liteservers {ls_indices} did not exit in {timeout}s, killing it', ls_indices=worker.ls_indices, timeout=self.worker_join_timeout)
+            worker.kill()
+            await self.loop.run_in_executor(self.threadpool_executor, worker.join)
+
+    @staticmethod
+    def liteserver_key(liteserver):
+        return (liteserver.get('ip'), liteserver.get('port'), liteserver.get('id', {}).get('key'))
+
+    def update_liteservers(self, liteserver_config):
+        active = {self.liteserver_key(self.liteservers[ls_index]): ls_index 
+                  for ls_index, worker_info in self.workers.items() if not worker_info['is_draining']}
+        new_keys = set(self.liteserver_key(ls) for ls in liteserver_config['liteservers'])
+
+        removed = [ls_index for key, ls_index in active.items() if key not in new_keys]
+        added = []
+        for liteserver in liteserver_config['liteservers']:
+            if self.liteserver_key(liteserver) not in active:
+                added.append(len(self.liteservers))
+                self.liteservers.append(liteserver)
+        if not removed and not added:
+            return
+
+        logger.info('Liteserver config changed: {added} added, {removed} removed', added=len(added), removed=len(removed))
+        self.tonlib_settings.liteserver_config = {**liteserver_config, 'liteservers': list(self.liteservers)}
+        for ls_indices in self.pack_liteservers(added):
+            self.spawn_worker(ls_indices)
+        for ls_index in removed:
+            self.tasks[f'drain_worker_{ls_index}'] = self.loop.create_task(self.drain_worker(ls_index))
+
+    async def drain_worker(self, ls_index):
+        # stop routing new requests to the worker and let in-flight ones finish
+        self.workers[ls_index]['is_draining'] = True
+        self.workers[ls_index]['is_working'] = False
+        try:
+            await asyncio.sleep(self.tonlib_settings.request_timeout)
+            self.workers[ls_index]['is_enabled'] = False
+            worker = self.workers[ls_index]['worker']
+            if any(i != ls_index and self.workers.get(i, {}).get('worker') is worker for i in worker.ls_indices):
+                # other liteservers of the process keep running
+                await self.loop.run_in_executor(self.threadpool_executor, worker.input_queue.put, (TonlibWorkerMsgType.REMOVE_LITESERVER, ls_index))
+            else:
+                await self.worker_control(ls_index, enabled=False)
+            self.workers.pop(ls_index)
+            self.tasks.pop(f'drain_worker_{ls_index}', None)
+            logger.info('TonlibWorker #{ls_index:03d} removed', ls_index=ls_index)
+        except asyncio.CancelledError:
+            logger.info('Task drain_worker #{ls_index:03d} was cancelled', ls_index=ls_index)
+
+    async def reload_liteserver_config(self):
+        while True:
+            try:
+                await asyncio.sleep(self.tonlib_settings.liteserver_config_reload_interval)
+                liteserver_config = await self.loop.run_in_executor(self.threadpool_executor, self.tonlib_settings.load_liteserver_config)
+                self.update_liteservers(liteserver_config)
+            except asyncio.CancelledError:
+                logger.info('Task reload_liteserver_config was cancelled')
+                return
+            except:
+                logger.error('Task reload_liteserver_config failed: {format_exc}', format_exc=traceback.format_exc())
+
     def log_liteserver_task(self, task_result: TonlibClientResult):
+        if not log_enabled('INFO') or not sampled(task_result.task_id):
+            return
+
         result_type = None
         if isinstance(task_result.result, Mapping):
             result_type = task_result.result.get('@type', 'unknown')
@@ -148,19 +325,37 @@ class TonlibManager:
             'elapsed': task_result.elapsed_time,
             'task_id': task_result.task_id,
             'method': task_result.method,
-            'liteserver_info': task_result.liteserver_info,
+            'ls_index': task_result.ls_index,
             'result_type': result_type,
             'exception': task_result.exception 
         }
 
         logger.info("Received result of type: {result_type}, method: {method}, task_id: {task_id}", **rec)
 
-    async def read_results(self, ls_index):
-        worker = self.workers[ls_index]['worker']
+    @staticmethod
+    def load_shared_memory_result(handle: SharedMemoryResult):
+        shm = shared_memory.SharedMemory(name=handle.name)
+        data = shm.buf[:handle.size]
+        try:
+            return pickle.loads(data)
+        finally:
+            data.release()
+            shm.close()
+            shm.unlink()
+
+    def get_worker_message(self, worker):
+        msg_type, msg_content = worker.output_queue.get(True, 1)
+        if msg_type == TonlibWorkerMsgType.TASK_RESULT and isinstance(msg_content.result, SharedMemoryResult):
+            msg_content.result = self.load_shared_memory_result(msg_content.result)
+        elif msg_type == TonlibWorkerMsgType.TASK_RESULT and isinstance(msg_content.result, PickledResult):
+            msg_content.result = pickle.loads(msg_content.result.data)
+        return msg_type, msg_content
+
+    async def read_results(self, worker):
         while True:
             try:
                 try:
-                    msg_type, msg_content = await self.loop.run_in_executor(self.threadpool_executor, worker.output_queue.get, True, 1)
+                    msg_type, msg_content = await self.loop.run_in_executor(self.threadpool_executor, self.get_worker_message, worker)
                 except queue.Empty:
                     continue
                 if msg_type == TonlibWorkerMsgType.TASK_RESULT:
@@ -172,17 +367,30 @@ class TonlibManager:
                         if msg_content.result is not None:    
                             self.futures[task_id].set_result(msg_content.result)
                     else:
-                        logger.warning("TonlibManager received result from TonlibWorker #{ls_index:03d} whose task '{task_id}' doesn't exist or is done.", ls_index=ls_index, task_id=task_id)
+                        logger.warning("TonlibManager received result from TonlibWorker #{ls_index:03d} whose task '{task_id}' doesn't exist or is done.", ls_index=worker.ls_index, task_id=task_id)
 
                     self.log_liteserver_task(msg_content)
 
+                    worker_info = self.workers.get(msg_content.ls_index)
+                    if worker_info is not None and msg_content.exception is None:
+                        latency = worker_info['latency']
+                        worker_info['latency'] = msg_content.elapsed_time if latency is None else latency * 0.9 + msg_content.elapsed_time * 0.1
+
                 if msg_type == TonlibWorkerMsgType.LAST_BLOCK_UPDATE:
-                    worker.last_block = msg_content
+                    ls_index, last_block = msg_content
+                    if ls_index in self.workers:
+                        self.workers[ls_index]['last_block'] = last_block
 
                 if msg_type == TonlibWorkerMsgType.ARCHIVAL_UPDATE:
-                    worker.is_archival = msg_content
+                    ls_index, is_archival = msg_content
+                    if ls_index in self.workers:
+                        self.workers[ls_index]['is_archival'] = is_archival
+
+                if msg_type == TonlibWorkerMsgType.LITESERVER_RESTART:
+                    if msg_content in self.workers:
+                        self.workers[msg_content]['restart_count'] += 1
             except asyncio.CancelledError:
-                logger.info("Task read_results from TonlibWorker #{ls_index:03d} was cancelled", ls_index=ls_index)
+                logger.info("Task read_results from TonlibWorker #{ls_index:03d} was cancelled", ls_index=worker.ls_index)
                 return
             except:
                 logger.error("read_results exception {format_exc}", format_exc=traceback.format_exc())
@@ -190,14 +398,14 @@ class TonlibManager:
     async def check_working(self):
         while True:
             try:
-                last_blocks = [self.workers[ls_index]['worker'].last_block for ls_index in self.workers]
-                best_block = max([i for i in last_blocks])
+                last_blocks = {ls_index: self.workers[ls_index]['last_block'] for ls_index in self.workers}
+                best_block = max(last_blocks.values())
                 consensus_block_seqno = 0
                 # detect 'consensus':
                 # it is no more than 3 blocks less than best block
                 # at least 60% of ls know it
                 # it is not earlier than prev
-                last_blocks_non_zero = [i for i in last_blocks if i != 0]
+                last_blocks_non_zero = [i for i in last_blocks.values() if i != 0]
                 strats = [sum([1 if ls == (best_block-i) else 0 for ls in last_blocks_non_zero]) for i in range(4)]
                 total_suitable = sum(strats)
                 sm = 0
@@ -210,7 +418,7 @@ class TonlibManager:
                     self.consensus_block.seqno = consensus_block_seqno
                     self.consensus_block.timestamp = datetime.utcnow().timestamp()
                 for ls_index in self.workers:
-                    self.workers[ls_index]['is_working'] = last_blocks[ls_index] >= self.consensus_block.seqno
+                    self.workers[ls_index]['is_working'] = not self.workers[ls_index]['is_draining'] and last_blocks[ls_index] >= self.consensus_block.seqno
 
                 await asyncio.sleep(1)
             except asyncio.CancelledError:
@@ -222,6 +430,7 @@ class TonlibManager:
     async def check_children_alive(self):
         while True:
             try:
+                processes = defaultdict(list)
                 for ls_index in self.workers:
                     worker_info = self.workers[ls_index]
                     worker_info['is_enabled'] = worker_info['is_enabled'] or time.time() > worker_info.get('time_to_alive', 1e10)
@@ -229,9 +438,12 @@ class TonlibManager:
                         worker_info['is_enabled'] = False
                         worker_info['time_to_alive'] = time.time() + 10 * 60
                         worker_info['restart_count'] = 0
-                    if not worker_info['worker'].is_alive() and worker_info['is_enabled']:
-                        logger.error("TonlibWorker #{ls_index:03d} is dead!!! Exit code: {exit_code}", ls_index=ls_index, exit_code=self.workers[ls_index]['worker'].exitcode)
-                        self.spawn_worker(ls_index, force_restart=True)
+                    if worker_info['is_enabled'] and not worker_info['is_draining']:
+                        processes[worker_info['worker']].append(ls_index)
+                for worker, ls_indices in processes.items():
+                    if not worker.is_alive():
+                        logger.error("TonlibWorker #{ls_index:03d} is dead!!! Exit code: {exit_code}", ls_index=worker.ls_index, exit_code=worker.exitcode)
+                        self.spawn_worker(ls_indices, force_restart=True)
                 await asyncio.sleep(1)
             except asyncio.CancelledError:
                 logger.info('Task check_children_alive was cancelled')
@@ -244,22 +456,27 @@ class TonlibManager:
         for ls_index, worker_info in self.workers.items():
             result[ls_index] = {
                 'ls_index': ls_index,
-                **self.tonlib_settings.liteserver_config['liteservers'][ls_index],
+                **self.liteservers[ls_index],
                 'is_working': worker_info['is_working'],
-                'is_archival': worker_info['worker'].is_archival,
+                'is_draining': worker_info['is_draining'],
+                'is_archival': worker_info['is_archival'],
                 'is_enabled': worker_info['is_enabled'],
-                'last_block': worker_info['worker'].last_block,
+                'last_block': worker_info['last_block'],
+                'worker': worker_info['worker'].ls_index,
                 'restart_count': worker_info['restart_count'],
-                'tasks_count': worker_info['tasks_count']
+                'tasks_count': worker_info['tasks_count'],
+                'latency': worker_info['latency'],
+                'cluster_latency': worker_info.get('cluster_latency'),
+                'is_probing': self.cluster.is_probing(ls_index) if self.cluster is not None else True
             }
         return result
 
-    def select_worker(self, ls_index=None, archival=None, count=1):
+    def select_worker(self, ls_index=None, archival=None, count=1, exclude=()):
         if count == 1 and ls_index is not None and self.workers[ls_index]['is_working']:
             return ls_index 
 
         suitable = [ls_index for ls_index, worker_info in self.workers.items() if worker_info['is_working'] and 
-                    (archival is None or worker_info['worker'].is_archival == archival)]
+                    (archival is None or worker_info['is_archival'] == archival) and ls_index not in exclude]
         random.shuffle(suitable)
         if len(suitable) < count:
             logger.warning('Required number of workers is not reached: found {found} of {count}', found=len(suitable), count=count)
@@ -267,34 +484,56 @@ class TonlibManager:
             raise RuntimeError(f'No working liteservers with ls_index={ls_index}, archival={archival}')
         return suitable[:count] if count > 1 else suitable[0]
 
+    def get_deadline(self):
+        deadline = time.time() + self.tonlib_settings.request_timeout
+        if request_deadline.get() is not None:
+            deadline = min(deadline, request_deadline.get())
+        return deadline
+
     async def dispatch_request_to_worker(self, method, ls_index, *args, **kwargs):
         task_id = "{}:{}".format(time.time(), random.random())
-        timeout = time.time() + self.tonlib_settings.request_timeout
+        timeout = self.get_deadline()
         self.workers[ls_index]['tasks_count'] += 1
 
-        logger.info("Sending request method: {method}, task_id: {task_id}, ls_index: {ls_index}", 
-            method=method, task_id=task_id, ls_index=ls_index)
-        await self.loop.run_in_executor(self.threadpool_executor, self.workers[ls_index]['worker'].input_queue.put, (task_id, timeout, method, args, kwargs))
+        if log_enabled('INFO') and sampled(task_id):
+            logger.info("Sending request method: {method}, task_id: {task_id}, ls_index: {ls_index}", 
+                method=method, task_id=task_id, ls_index=ls_index)
+        priority, cost = task_priority(method, args)
+        if request_priority.get() is not None:
+            priority = request_priority.get()
+        await self.loop.run_in_executor(self.threadpool_executor, self.workers[ls_index]['worker'].input_queue.put, (TonlibWorkerMsgType.TASK, (task_id, ls_index, timeout, method, args, kwargs, priority, cost)))
 
         try:
             self.futures[task_id] = self.loop.create_future()
             await self.futures[task_id]
             return self.futures[task_id].result()
+        except asyncio.CancelledError:
+            self.cancel_worker_task(ls_index, task_id)
+            raise
         finally:
             self.futures.pop(task_id)
 
-    def dispatch_request(self, method, *args, **kwargs):
-        ls_index = self.select_worker()
-        return self.dispatch_request_to_worker(method, ls_index, *args, **kwargs)
+    def create_background_task(self, coro):
+        """
+        Runs speculative work in a task. Its liteserver requests have background priority
+        and are not bound by the deadline of the request that started it.
+        """
+        async def run():
+            request_priority.set(TonlibTaskPriority.BACKGROUND)
+            request_deadline.set(None)
+            return await coro
+        return self.loop.create_task(run())
 
-    def dispatch_archival_request(self, method, *args, **kwargs):
-        ls_index = None
-        try:
-            ls_index = self.select_worker(archival=True)
-        except RuntimeError as ee:
-            logger.warning(f'Method {method} failed to execute on archival node: {ee}')
-            ls_index = self.select_worker(archival=False)
-        return self.dispatch_request_to_worker(method, ls_index, *args, **kwargs)
+    def cancel_worker_task(self, ls_index, task_id):
+        if ls_index not in self.workers:
+            return
+        self.loop.run_in_executor(self.threadpool_executor, self.workers[ls_index]['worker'].input_queue.put, (TonlibWorkerMsgType.CANCEL_TASK, task_id))
+
+    async def dispatch_request(self, method, *args, **kwargs):
+        return await self.retry.run(method, False, self.get_deadline(), args, kwargs)
+
+    async def dispatch_archival_request(self, method, *args, **kwargs):
+        return await self.retry.run(method, True, self.get_deadline(), args, kwargs)
 
     async def raw_get_transactions(self, account_address: str, from_transaction_lt: str, from_transaction_hash: str, archival: bool):
         method = 'raw_get_transactions'
@@ -309,6 +548,13 @@ class TonlibManager:
          if to_transaction_lt and to_transaction_hash are not defined returns all transactions
          if from_transaction_lt and from_transaction_hash are not defined latest transactions are returned
         """
+        if self.transaction_cache is not None:
+            return await self.transaction_cache.get_transactions(account_address, from_transaction_lt, from_transaction_hash, to_transaction_lt, limit, decode_messages, archival)
+        if from_transaction_lt is None or from_transaction_hash is None:
+            from_transaction_lt, from_transaction_hash = await self._account_version(account_address)
+        return await self._get_transactions(account_address, int(from_transaction_lt), from_transaction_hash, to_transaction_lt or 0, limit, decode_messages, archival)
+
+    async def _get_transactions(self, account_address, from_transaction_lt, from_transaction_hash, to_transaction_lt, limit, decode_messages, archival):
         method = 'get_transactions'
         if archival:
             return await self.dispatch_archival_request(method, account_address, from_transaction_lt, from_transaction_hash, to_transaction_lt, limit, decode_messages)
@@ -316,50 +562,102 @@ class TonlibManager:
             return await self.dispatch_request(method, account_address, from_transaction_lt, from_transaction_hash, to_transaction_lt, limit, decode_messages)
 
     async def raw_get_account_state(self, address: str, seqno: int = None):
-        method = 'raw_get_account_state'
-        try:
-            addr = await self.dispatch_request(method, address, seqno)
-        except TonlibError:
-            addr = await self.dispatch_archival_request(method, address, seqno)
-        return addr
+        return await self.dispatch_request('raw_get_account_state', address, seqno)
 
     async def generic_get_account_state(self, address: str, seqno: int = None):
-        method = 'generic_get_account_state'
-        try:
-            addr = await self.dispatch_request(method, address, seqno)
-        except TonlibError:
-            addr = await self.dispatch_archival_request(method, address, seqno)
-        return addr
+        return await self.dispatch_request('generic_get_account_state', address, seqno)
 
     async def get_token_data(self, address: str):
         return await self.dispatch_request('get_token_data', address)
 
+    async def _account_version(self, address):
+        """
+        Returns last transaction id of the account. Account state is fetched at most once
+        per consensus block, concurrent calls share the request.
+        """
+        seqno = self.consensus_block.seqno
+        entry = self.account_versions.get(address)
+        if entry is None or entry[0] != seqno or (entry[1].done() and entry[1].exception() is not None):
+            entry = (seqno, asyncio.ensure_future(self.dispatch_request('raw_get_account_state', address)))
+            self.account_versions[address] = entry
+            if len(self.account_versions) > self.max_account_versions:
+                self.account_versions.popitem(last=False)
+        else:
+            self.account_versions.move_to_end(address)
+        state = await asyncio.shield(entry[1])
+        return state['last_transaction_id']['lt'], state['last_transaction_id']['hash']
+
     async def raw_run_method(self, address, method, stack_data, seqno):
-        try:
-            return await self.dispatch_request('raw_run_method', address, method, stack_data, seqno)
-        except TonlibError:
-            return await self.dispatch_archival_request('raw_run_method', address, method, stack_data, seqno)
+        """
+        Get method results depend only on the account state, so latest results are cached
+        by last transaction id of the account and are reused until the account changes.
+        """
+        if seqno is not None or isinstance(self.cache_manager, DisabledCacheManager):
+            return await self._raw_run_method(address, method, stack_data, seqno)
+        last_tx_lt, last_tx_hash = await self._account_version(address)
+        result = await self._raw_run_method(address, method, stack_data, None, last_tx_lt, last_tx_hash)
+        last_tx_id = result.get('last_transaction_id') or {}
+        if (last_tx_id.get('lt'), last_tx_id.get('hash')) != (last_tx_lt, last_tx_hash):
+            # account changed after the version check. The result is newer than the key,
+            # which is fine for readers of the old version, but the version is refetched
+            self.account_versions.pop(address, None)
+        return result
+
+    async def _raw_run_method(self, address, method, stack_data, seqno, last_tx_lt=None, last_tx_hash=None):
+        return await self.dispatch_request('raw_run_method', address, method, stack_data, seqno)
 
     async def _send_message(self, serialized_boc, method):
-        ls_index_list = self.select_worker(count=4)
-        result = None
-        try:
-            task_ids = []
-            for ls_index in ls_index_list:
-                task_id = "{}:{}".format(time.time(), random.random())
-                timeout = time.time() + self.tonlib_settings.request_timeout
-                await self.loop.run_in_executor(self.threadpool_executor, self.workers[ls_index]['worker'].input_queue.put, (task_id, timeout, method, [serialized_boc], {}))
+        """
+        Deduplicates messages by hash: concurrent duplicates share one broadcast and
+        duplicates within dedup_window get the result of the accepted broadcast.
+        """
+        msg_hash, _ = parse_external_message(serialized_boc)
+        key = (method, msg_hash)
+
+        now = time.time()
+        while self.sent_messages:
+            task, expires_at = next(iter(self.sent_messages.values()))
+            if not task.done() or expires_at > now:
+                break
+            self.sent_messages.popitem(last=False)
+
+        entry = self.sent_messages.get(key)
+        if entry is None:
+            task = self.loop.create_task(self._broadcast_message(serialized_boc, method))
+            task.add_done_callback(lambda task: self._on_message_sent(key, task))
+            entry = self.sent_messages[key] = [task, float('inf')]
+        else:
+            logger.info("Message {msg_hash} is a duplicate, broadcast is reused", msg_hash=msg_hash)
+        return await asyncio.shield(entry[0])
+
+    def _on_message_sent(self, key, task):
+        entry = self.sent_messages.get(key)
+        if entry is None or entry[0] is not task:
+            return
+        if task.cancelled() or task.exception() is not None or self.send_settings.dedup_window <= 0:
+            self.sent_messages.pop(key)
+        else:
+            entry[1] = time.time() + self.send_settings.dedup_window
 
-                self.futures[task_id] = self.loop.create_future()
-                task_ids.append(task_id)
+    async def _broadcast_message(self, serialized_boc, method):
+        ls_index_list = self.select_worker(count=self.send_settings.broadcast_fanout)
+        if not isinstance(ls_index_list, list):
+            ls_index_list = [ls_index_list]
 
-            done, _ = await asyncio.wait([self.futures[task_id] for task_id in task_ids], return_when=asyncio.FIRST_COMPLETED)
-            result = list(done)[0].result()
+        tasks = [self.loop.create_task(self.dispatch_request_to_worker(method, ls_index, serialized_boc)) for ls_index in ls_index_list]
+        exception = None
+        try:
+            for task in asyncio.as_completed(tasks):
+                try:
+                    return await task
+                except Exception as e:
+                    exception = exception or e
+            raise exception
         finally:
-            for task_id in task_ids:
-                self.futures.pop(task_id)
-
-        return result
+            # first accepted send wins, the rest are not cancelled, since cancelling a running
+            # tonlib call breaks its futures map. They finish in workers and results are dropped
+            for task in tasks:
+                task.add_done_callback(drop_result)
 
     async def raw_send_message(self, serialized_boc):
         return await self._send_message(serialized_boc, 'raw_send_message')
@@ -399,8 +697,14 @@ class TonlibManager:
 
     async def lookupBlock(self, workchain, shard, seqno=None, lt=None, unixtime=None):
         method = 'lookup_block'
+        if workchain == -1 and seqno is None:
+            result = self.timeline.lookup(lt, unixtime)
+            if result is not None:
+                return result
         if workchain == -1 and seqno and self.consensus_block.seqno - seqno < 2000:
             return await self.dispatch_request(method, workchain, shard, seqno, lt, unixtime)
+        elif seqno is None and self.timeline.is_recent(self.consensus_block.seqno - 2000, lt, unixtime):
+            return await self.dispatch_request(method, workchain, shard, seqno, lt, unixtime)
         else:
             return await self.dispatch_archival_request(method, workchain, shard, seqno, lt, unixtime)
 
@@ -428,6 +732,11 @@ class TonlibManager:
             return await self.dispatch_archival_request(method, workchain, shard, seqno, root_hash, file_hash)
 
     async def get_config_param(self, config_id: int, seqno: Optional[int]):
+        if self.config_snapshots is None:
+            return await self._get_config_param(config_id, seqno)
+        return await self.config_snapshots.get_param(config_id, seqno)
+
+    async def _get_config_param(self, config_id: int, seqno: Optional[int]):
         seqno = seqno or self.consensus_block.seqno
         method = 'get_config_param'
         if self.consensus_block.seqno - seqno < 2000:
@@ -435,11 +744,15 @@ class TonlibManager:
         else:
             return await self.dispatch_archival_request(method, config_id, seqno)
 
+    async def get_config_all(self, seqno: int):
+        method = 'get_config_all'
+        if self.consensus_block.seqno - seqno < 2000:
+            return await self.dispatch_request(method, seqno)
+        else:
+            return await self.dispatch_archival_request(method, seqno)
+
     async def getLibraries(self, lib_hashes: list):
-        try:
-            return await self.dispatch_request('get_libraries', lib_hashes)
-        except TonlibError:
-            return await self.dispatch_archival_request('get_libraries', lib_hashes)
+        return await self.dispatch_request('get_libraries', lib_hashes)
 
     async def tryLocateTxByOutcomingMessage(self, source, destination, creation_lt):
         return await self.dispatch_archival_request('try_locate_tx_by_outcoming_message',  source, destination, creation_lt)
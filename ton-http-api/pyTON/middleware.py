@@ -0,0 +1,155 @@
+import asyncio
+import gzip
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Optional
+
+from pyTON.settings import CompressionSettings
+
+from loguru import logger
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class CancelOnDisconnectMiddleware:
+    """
+    ASGI middleware cancelling request handling when the client disconnects, so pending
+    liteserver tasks of the request are cancelled in workers instead of running to completion.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        # the only reader of the connection, messages are passed to the app through the queue
+        messages = asyncio.Queue()
+        disconnected = False
+        response_complete = False
+
+        async def watch_disconnect():
+            nonlocal disconnected
+            while True:
+                message = await receive()
+                messages.put_nowait(message)
+                if message['type'] == 'http.disconnect':
+                    # the server reports disconnect after the response is sent, background tasks keep running
+                    if not response_complete:
+                        disconnected = True
+                        app_task.cancel()
+                    return
+
+        async def send_tracked(message):
+            nonlocal response_complete
+            await send(message)
+            if message['type'] == 'http.response.body' and not message.get('more_body', False):
+                response_complete = True
+                watcher.cancel()
+
+        app_task = asyncio.ensure_future(self.app(scope, messages.get, send_tracked))
+        watcher = asyncio.ensure_future(watch_disconnect())
+        try:
+            await app_task
+        except asyncio.CancelledError:
+            if not disconnected:
+                app_task.cancel()
+                raise
+            logger.info('Client disconnected, request {path} cancelled', path=scope['path'])
+        finally:
+            watcher.cancel()
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing responses with the best encoding accepted by the client:
+    zstd, br or gzip. Responses smaller than min_size are sent as is, bodies larger than
+    thread_min_size are compressed in a thread pool, so the event loop isn't blocked.
+    Brotli and zstd are used if the optional brotli and zstandard packages are installed.
+    """
+    def __init__(self, app, compression_settings: CompressionSettings, executor: Optional[ThreadPoolExecutor]=None):
+        self.app = app
+        self.settings = compression_settings
+        self.executor = executor or ThreadPoolExecutor(max_workers=4, thread_name_prefix='compression')
+        self.encoders = {'gzip': partial(gzip.compress, compresslevel=self.settings.gzip_level, mtime=0)}
+        if brotli is not None:
+            self.encoders['br'] = partial(brotli.compress, quality=self.settings.brotli_quality)
+        if zstandard is not None:
+            self.encoders['zstd'] = zstandard.ZstdCompressor(level=self.settings.zstd_level).compress
+
+    def select_encoding(self, accept_encoding: str):
+        accepted = {}
+        for item in accept_encoding.split(','):
+            name, _, params = item.strip().partition(';')
+            q = 1.0
+            for param in params.split(';'):
+                key, _, value = param.strip().partition('=')
+                if key == 'q':
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            accepted[name.strip().lower()] = q
+        best = None
+        for encoding in ('zstd', 'br', 'gzip'):
+            q = accepted.get(encoding, accepted.get('*', 0.0))
+            if encoding in self.encoders and q > 0 and (best is None or q > best[1]):
+                best = (encoding, q)
+        return best[0] if best is not None else None
+
+    async def compress(self, encoding, body):
+        if len(body) >= self.settings.thread_min_size:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, self.encoders[encoding], body)
+        return self.encoders[encoding](body)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        accept_encoding = ''
+        for name, value in scope['headers']:
+            if name == b'accept-encoding':
+                accept_encoding = value.decode('latin-1')
+                break
+        encoding = self.select_encoding(accept_encoding) if accept_encoding else None
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start_message = None
+        body = []
+
+        async def send_compressed(message):
+            nonlocal start_message
+            if message['type'] == 'http.response.start':
+                headers = {name.lower() for name, _ in message.get('headers', [])}
+                if b'content-encoding' in headers or message['status'] in (204, 304):
+                    start_message = False
+                    return await send(message)
+                start_message = message
+                return
+            if message['type'] != 'http.response.body' or start_message is False:
+                return await send(message)
+
+            body.append(message.get('body', b''))
+            if message.get('more_body', False):
+                return
+            data = b''.join(body)
+            headers = [(name, value) for name, value in start_message.get('headers', []) if name.lower() != b'content-length']
+            if len(data) >= self.settings.min_size:
+                data = await self.compress(encoding, data)
+                headers.append((b'content-encoding', encoding.encode('latin-1')))
+            headers.append((b'content-length', str(len(data)).encode('latin-1')))
+            headers.append((b'vary', b'Accept-Encoding'))
+            await send({**start_message, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': data})
+
+        return await self.app(scope, receive, send_compressed)
@@ -10,16 +10,38 @@ class TonlibClientResult:
     task_id: str
     method: str
     elapsed_time: float
-    params: Optional[Any] = None
+    ls_index: Optional[int] = None
     result: Optional[Any] = None
     exception: Optional[Exception] = None
-    liteserver_info: Optional[Any] = None
+
+
+@dataclass
+class SharedMemoryResult:
+    name: str
+    size: int
+
+
+@dataclass
+class PickledResult:
+    data: bytes
+
+
+class TonlibTaskPriority(Enum):
+    SEND = 0
+    LIGHT = 1
+    HEAVY = 2
+    BACKGROUND = 3
 
 
 class TonlibWorkerMsgType(Enum):
     TASK_RESULT = 0
     LAST_BLOCK_UPDATE = 1
     ARCHIVAL_UPDATE = 2
+    LITESERVER_RESTART = 3
+    TASK = 4
+    REMOVE_LITESERVER = 5
+    CANCEL_TASK = 6
+    PROBE_CONTROL = 7
 
 
 @dataclass
@@ -0,0 +1,113 @@
+import asyncio
+import multiprocessing as mp
+import time
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+from tvm_valuetypes.cell import deserialize_cell_from_object
+
+from pyTON.settings import OffloadSettings, LoopLagSettings
+
+from loguru import logger
+
+
+# functions run in the pool, defined on module level to be picklable
+def cell_object_to_boc(cell_object, has_idx=True):
+    return deserialize_cell_from_object(cell_object).serialize_boc(has_idx=has_idx)
+
+
+def cell_object_size(cell_object):
+    """
+    Estimates size of a cell object by its data without serializing it.
+    """
+    size = 0
+    stack = [cell_object]
+    while stack:
+        cell = stack.pop()
+        if not isinstance(cell, dict):
+            continue
+        data = cell.get('data')
+        if isinstance(data, dict):
+            size += len(data.get('b64') or '')
+        stack.extend(cell.get('refs') or [])
+    return size
+
+
+class Offloader:
+    """
+    Runs CPU-bound serialization of request data larger than min_size in a bounded pool, so
+    large inputs don't stall other requests of the webserver process. Process pool is the
+    default, since cell serialization is pure Python and holds the GIL. Its workers are spawned,
+    forking the multithreaded webserver process may copy locks held by other threads.
+    """
+    def __init__(self, offload_settings: OffloadSettings):
+        self.settings = offload_settings
+        if self.settings.executor == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=self.settings.max_workers, mp_context=mp.get_context('spawn'))
+        elif self.settings.executor == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers=self.settings.max_workers, thread_name_prefix='offload')
+        else:
+            raise ValueError(f"Unknown offload executor: {self.settings.executor}")
+        # pending jobs are bounded too, so a burst of large inputs doesn't pile up in memory
+        self.semaphore = asyncio.Semaphore(self.settings.max_workers * 8)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    async def run(self, size, func, *args):
+        if size < self.settings.min_size:
+            return func(*args)
+        async with self.semaphore:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+
+class LoopLagMonitor:
+    """
+    Measures event loop lag as the delay of a periodic wakeup. Lag above warning_threshold
+    is logged, recent statistics are returned by get_state.
+    """
+    def __init__(self, loop_lag_settings: LoopLagSettings, loop: Optional[asyncio.BaseEventLoop]=None):
+        self.settings = loop_lag_settings
+        self.loop = loop or asyncio.get_running_loop()
+
+        self.last = 0.0
+        self.max = 0.0
+        self.avg = 0.0
+        self.samples = 0
+
+        self.task = self.loop.create_task(self.run())
+
+    async def shutdown(self):
+        self.task.cancel()
+        await self.task
+
+    def get_state(self):
+        return {
+            'last': self.last,
+            'max': self.max,
+            'avg': self.avg,
+            'samples': self.samples,
+        }
+
+    def record(self, lag):
+        self.last = lag
+        self.max = max(self.max, lag)
+        self.avg = lag if self.samples == 0 else self.avg * 0.95 + lag * 0.05
+        self.samples += 1
+        if lag > self.settings.warning_threshold:
+            logger.warning('Event loop lag {lag:.3f}s', lag=lag)
+
+    async def run(self):
+        while True:
+            try:
+                start = time.perf_counter()
+                await asyncio.sleep(self.settings.interval)
+                self.record(max(0.0, time.perf_counter() - start - self.settings.interval))
+            except asyncio.CancelledError:
+                logger.info('Task LoopLagMonitor.run was cancelled')
+                return
+            except:
+                logger.error('Task LoopLagMonitor.run exception: {format_exc}', format_exc=traceback.format_exc())
+                await asyncio.sleep(self.settings.interval)
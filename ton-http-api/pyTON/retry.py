@@ -0,0 +1,189 @@
+import asyncio
+import random
+import time
+
+from dataclasses import dataclass
+from typing import FrozenSet
+
+from pyTON.cache import TRANSIENT_ERRORS
+from pyTON.settings import RetrySettings
+from pyTON.worker import drop_result
+
+from pytonlib import TonlibError
+from pytonlib.tonlibjson import LiteServerTimeout, TonlibNoResponse
+
+from loguru import logger
+
+
+TIMEOUT = 'timeout'  # liteserver did not answer in time or is unreachable
+ERROR = 'error'      # liteserver answered with an error, e.g. state is not in its db
+
+# answers of a liteserver missing the data, retried on archival liteservers rather than as timeouts
+NOT_IN_DB_ERRORS = ('not in db',)
+
+
+def classify_error(error):
+    """
+    Returns kind of a liteserver failure, None for errors of the request itself.
+    """
+    if isinstance(error, (LiteServerTimeout, TonlibNoResponse, asyncio.TimeoutError)):
+        return TIMEOUT
+    if isinstance(error, TonlibError):
+        message = str(error.result.get('message', ''))
+        if any(pattern in message for pattern in NOT_IN_DB_ERRORS):
+            return ERROR
+        return TIMEOUT if any(pattern in message for pattern in TRANSIENT_ERRORS) else ERROR
+    return None
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    Retry behavior of a liteserver method. Each attempt goes to a liteserver not tried yet, the
+    request deadline is split between remaining attempts. Errors are only retried when the retry
+    goes to archival liteservers, since other liteservers give the same answer. If race is set,
+    the next attempt starts after race_after seconds without waiting for the current one.
+    """
+    attempts: int = 1
+    retry_on: FrozenSet[str] = frozenset()
+    archival_fallback: bool = False
+    race: bool = False
+
+
+NO_RETRY = RetryPolicy()
+# a slow or unreachable liteserver is retried on another one
+LIGHT_POLICY = RetryPolicy(attempts=2, retry_on=frozenset({TIMEOUT}))
+# account state may be missing on a non-archival liteserver
+STATE_POLICY = RetryPolicy(attempts=2, retry_on=frozenset({TIMEOUT, ERROR}), archival_fallback=True, race=True)
+
+# tonlib method -> retry policy, other light methods use LIGHT_POLICY
+RETRY_POLICIES = {
+    'raw_get_account_state': STATE_POLICY,
+    'generic_get_account_state': STATE_POLICY,
+    'raw_run_method': RetryPolicy(attempts=2, retry_on=frozenset({TIMEOUT, ERROR}), archival_fallback=True),
+    'get_libraries': STATE_POLICY,
+    # sends are broadcast and resent by their own logic
+    'raw_send_message': NO_RETRY,
+    'raw_send_message_return_hash': NO_RETRY,
+    '_raw_send_query': NO_RETRY,
+    'raw_create_and_send_query': NO_RETRY,
+    'raw_create_and_send_message': NO_RETRY,
+    # heavy methods take most of the deadline, a retry would not fit into it
+    'get_block_transactions': NO_RETRY,
+    'get_block_transactions_ext': NO_RETRY,
+    'raw_get_block_transactions': NO_RETRY,
+    'get_transactions': NO_RETRY,
+    'raw_get_transactions': NO_RETRY,
+    'try_locate_tx_by_incoming_message': NO_RETRY,
+    'try_locate_tx_by_outcoming_message': NO_RETRY,
+    'lookup_block': NO_RETRY,
+}
+
+
+class RetryEngine:
+    """
+    Executes liteserver requests according to the retry policy of the method within the request
+    deadline. A retry is skipped if less than min_attempt_time is left. Sequential retries after
+    timeouts are delayed by jittered exponential backoff. An attempt over its share of the deadline
+    is not cancelled: the retry is started next to it, and the first successful attempt wins.
+    Pending attempts finish in workers and their results are dropped.
+    """
+    min_attempt_time = 0.1
+
+    def __init__(self, tonlib, retry_settings: RetrySettings):
+        self.tonlib = tonlib
+        self.settings = retry_settings
+
+    def policy(self, method):
+        if not self.settings.enabled:
+            return NO_RETRY
+        return RETRY_POLICIES.get(method, LIGHT_POLICY)
+
+    def backoff(self, retry):
+        delay = min(self.settings.max_backoff, self.settings.backoff * 2 ** (retry - 1))
+        return delay * random.uniform(0.5, 1.5)
+
+    def can_retry(self, policy, tried, deadline):
+        return len(tried) < policy.attempts and deadline - time.time() > self.min_attempt_time
+
+    def select_worker(self, method, archival, tried):
+        if not archival:
+            return self.tonlib.select_worker(archival=None, exclude=tried)
+        try:
+            return self.tonlib.select_worker(archival=True, exclude=tried)
+        except RuntimeError as ee:
+            logger.warning(f'Method {method} failed to execute on archival node: {ee}')
+            return self.tonlib.select_worker(archival=None, exclude=tried)
+
+    def wait_timeout(self, race, budgets):
+        timeout = self.settings.race_after if race else None
+        if budgets:
+            budget_left = max(0.0, min(budgets.values()) - time.time())
+            timeout = budget_left if timeout is None else min(timeout, budget_left)
+        return timeout
+
+    async def run(self, method, archival, deadline, args, kwargs):
+        policy = self.policy(method)
+        tried = []
+        running = {}  # attempt task -> ls_index
+        budgets = {}  # attempt task -> time its share of the deadline ends
+        error = None
+        launch = True
+        try:
+            while True:
+                if launch:
+                    launch = False
+                    try:
+                        ls_index = self.select_worker(method, archival, tried)
+                    except RuntimeError:
+                        if error is None and not running:
+                            raise
+                        ls_index = None
+                    if ls_index is not None:
+                        tried.append(ls_index)
+                        task = asyncio.ensure_future(self.tonlib.dispatch_request_to_worker(method, ls_index, *args, **kwargs))
+                        task.add_done_callback(drop_result)
+                        running[task] = ls_index
+                        attempts_left = policy.attempts - len(tried) + 1
+                        # an attempt gets its share of the budget, so a hung liteserver leaves time for a retry
+                        if attempts_left > 1 and TIMEOUT in policy.retry_on:
+                            budgets[task] = time.time() + (deadline - time.time()) / attempts_left
+                if not running:
+                    raise error
+
+                race = policy.race and self.settings.race_after > 0 and len(running) == 1 and self.can_retry(policy, tried, deadline)
+                done, _ = await asyncio.wait(running, timeout=self.wait_timeout(race, budgets), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    overdue = [task for task, ends_at in budgets.items() if ends_at <= time.time()]
+                    if not overdue:
+                        archival = archival or policy.archival_fallback
+                        launch = True
+                        continue
+                    # the attempt keeps running and may still win
+                    for task in overdue:
+                        budgets.pop(task)
+                    ls_index, kind = running[overdue[0]], TIMEOUT
+                    error = error or asyncio.TimeoutError()
+                else:
+                    kind = None
+                    for task in done:
+                        ls_index = running.pop(task)
+                        budgets.pop(task, None)
+                        if task.exception() is None:
+                            return task.result()
+                        error = task.exception()
+                        kind = classify_error(error)
+                if kind not in policy.retry_on or not self.can_retry(policy, tried, deadline):
+                    continue
+                if kind == ERROR and (archival or not policy.archival_fallback):
+                    continue
+                logger.info('Retrying method {method} failed on liteserver #{ls_index:03d}: {kind}', method=method, ls_index=ls_index, kind=kind)
+                archival = archival or policy.archival_fallback
+                launch = True
+                if kind == TIMEOUT and not budgets:
+                    await asyncio.sleep(min(self.backoff(len(tried)), max(0.0, deadline - time.time() - self.min_attempt_time)))
+        except asyncio.CancelledError:
+            # the request itself is cancelled, so are its attempts
+            for task in running:
+                task.cancel()
+            raise
@@ -0,0 +1,157 @@
+import asyncio
+import base64
+import hashlib
+import time
+import traceback
+
+from dataclasses import dataclass
+from typing import Optional
+
+from bitarray import bitarray
+from tvm_valuetypes.cell import deserialize_boc
+from pytonlib.utils.tlb import Slice, MsgAddressInt
+
+from pyTON.settings import SendSettings
+
+from loguru import logger
+
+
+def parse_external_message(boc: bytes):
+    """
+    Returns base64 hash of the message cell and raw destination address of an external inbound message.
+    If BOC can't be parsed, hash of the BOC bytes and no destination are returned.
+    """
+    try:
+        cell = deserialize_boc(boc)
+    except Exception:
+        return base64.b64encode(hashlib.sha256(boc).digest()).decode('utf-8'), None
+    msg_hash = base64.b64encode(cell.hash()).decode('utf-8')
+    try:
+        cell_slice = Slice(cell)
+        if cell_slice.read_next(2) != bitarray('10'):  # ext_in_msg_info$10
+            return msg_hash, None
+        if cell_slice.read_next(2) != bitarray('00'):  # src:MsgAddressExt, only addr_none is expected
+            return msg_hash, None
+        dest = MsgAddressInt(cell_slice)
+        return msg_hash, f'{dest.workchain_id}:{dest.address.upper()}'
+    except Exception:
+        return msg_hash, None
+
+
+@dataclass
+class ResendEntry:
+    boc: bytes
+    msg_hash: str
+    destination: Optional[str]
+    deadline: float
+    next_send: float = 0
+    submissions: int = 1
+    sends: int = 0
+    last_lt: Optional[int] = None
+
+
+class ResendScheduler:
+    """
+    Resends external messages until they are seen on-chain or resend duration expires.
+    Messages are keyed by hash, so repeated submissions of the same message share one schedule.
+    Messages over max_resend_messages are sent once, and dropped if max_send_once_tasks such sends
+    are already in flight.
+    """
+    max_send_once_tasks = 100
+
+    def __init__(self, tonlib, send_settings: SendSettings, loop: Optional[asyncio.BaseEventLoop]=None):
+        self.tonlib = tonlib
+        self.send_settings = send_settings
+        self.loop = loop or asyncio.get_running_loop()
+
+        self.messages = {}
+        self.send_once_tasks = set()
+        self.wakeup = asyncio.Event()
+        self.task = self.loop.create_task(self.run())
+
+    async def shutdown(self):
+        self.task.cancel()
+        await self.task
+
+    def schedule(self, boc: bytes):
+        msg_hash, destination = parse_external_message(boc)
+        if msg_hash in self.messages:
+            self.messages[msg_hash].submissions += 1
+            return msg_hash
+        if len(self.messages) >= self.send_settings.max_resend_messages:
+            if len(self.send_once_tasks) >= self.max_send_once_tasks:
+                logger.warning('Resend queue is full, message {msg_hash} is dropped', msg_hash=msg_hash)
+                return msg_hash
+            logger.warning('Resend queue is full, message {msg_hash} will be sent once', msg_hash=msg_hash)
+            task = self.loop.create_task(self.send_once(boc))
+            self.send_once_tasks.add(task)
+            task.add_done_callback(self.send_once_tasks.discard)
+            return msg_hash
+
+        now = time.time()
+        self.messages[msg_hash] = ResendEntry(boc=boc,
+                                              msg_hash=msg_hash,
+                                              destination=destination,
+                                              deadline=now + self.send_settings.resend_duration,
+                                              next_send=now)
+        self.wakeup.set()
+        return msg_hash
+
+    async def send_once(self, boc: bytes):
+        try:
+            await self.tonlib.raw_send_message(boc)
+        except Exception as e:
+            logger.info('Failed to send message: {exc}', exc=e)
+
+    async def is_included(self, entry: ResendEntry):
+        state = await self.tonlib.raw_get_account_state(entry.destination)
+        lt = int(state.get('last_transaction_id', {}).get('lt', 0))
+        if entry.last_lt is None or lt == entry.last_lt:
+            entry.last_lt = lt
+            return False
+        transactions = await self.tonlib.get_transactions(entry.destination, to_transaction_lt=entry.last_lt, limit=16)
+        entry.last_lt = lt
+        return any(tx.get('in_msg', {}).get('hash') == entry.msg_hash for tx in transactions)
+
+    async def resend(self, entry: ResendEntry):
+        now = time.time()
+        try:
+            if entry.destination is not None and await self.is_included(entry):
+                logger.info('Message {msg_hash} is included after {sends} sends', msg_hash=entry.msg_hash, sends=entry.sends)
+                self.messages.pop(entry.msg_hash, None)
+                return
+        except Exception as e:
+            logger.info('Failed to check message {msg_hash} inclusion: {exc}', msg_hash=entry.msg_hash, exc=e)
+        if now >= entry.deadline:
+            self.messages.pop(entry.msg_hash, None)
+            return
+
+        # each attempt goes to a single liteserver, attempts are spread across liteservers
+        entry.next_send = now + self.send_settings.resend_interval
+        entry.sends += 1
+        try:
+            ls_index = self.tonlib.select_worker()
+            await self.tonlib.dispatch_request_to_worker('raw_send_message', ls_index, entry.boc)
+        except Exception as e:
+            logger.info('Failed to resend message {msg_hash}: {exc}', msg_hash=entry.msg_hash, exc=e)
+
+    async def run(self):
+        while True:
+            try:
+                now = time.time()
+                due = [entry for entry in self.messages.values() if entry.next_send <= now]
+                for entry in due:
+                    entry.next_send = float('inf')
+                    self.loop.create_task(self.resend(entry))
+
+                next_send = min([entry.next_send for entry in self.messages.values()], default=now + 1)
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=max(0, min(next_send - now, 1)))
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                logger.info('Task ResendScheduler.run was cancelled')
+                return
+            except:
+                logger.critical('Task ResendScheduler.run dead: {format_exc}', format_exc=traceback.format_exc())
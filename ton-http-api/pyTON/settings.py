@@ -2,7 +2,7 @@ import os
 import requests
 import json
 
-from typing import Optional
+from typing import Optional, Dict, List
 from dataclasses import dataclass
 from loguru import logger
 
@@ -23,17 +23,26 @@ class TonlibSettings:
     cdll_path: Optional[str] 
     request_timeout: int
     verbosity_level: int
-    
+    liteserver_config_reload_interval: int = 0
+    liteservers_per_worker: int = 1
+    shared_memory_threshold: int = 262144
+
+    def load_liteserver_config(self):
+        if self.liteserver_config_path.startswith('https://') or self.liteserver_config_path.startswith('http://'):
+            return requests.get(self.liteserver_config_path).json()
+        with open(self.liteserver_config_path, 'r') as f:
+            return json.load(f)
+
     @property
     def liteserver_config(self):
         if not hasattr(self, '_liteserver_config'):
-            if self.liteserver_config_path.startswith('https://') or self.liteserver_config_path.startswith('http://'):
-                self._liteserver_config = requests.get(self.liteserver_config_path).json()
-            else:
-                with open(self.liteserver_config_path, 'r') as f:
-                    self._liteserver_config = json.load(f)
+            self._liteserver_config = self.load_liteserver_config()
         return self._liteserver_config
 
+    @liteserver_config.setter
+    def liteserver_config(self, value):
+        self._liteserver_config = value
+
     @classmethod
     def from_environment(cls):
         verbosity_level = 0
@@ -44,7 +53,10 @@ class TonlibSettings:
                               liteserver_config_path=os.environ.get('TON_API_TONLIB_LITESERVER_CONFIG', 'https://ton.org/global-config.json'),
                               cdll_path=os.environ.get('TON_API_TONLIB_CDLL_PATH', None),
                               request_timeout=int(os.environ.get('TON_API_TONLIB_REQUEST_TIMEOUT', '10')),
-                              verbosity_level=verbosity_level)
+                              verbosity_level=verbosity_level,
+                              liteserver_config_reload_interval=int(os.environ.get('TON_API_TONLIB_LITESERVER_CONFIG_RELOAD_INTERVAL', '0')),
+                              liteservers_per_worker=int(os.environ.get('TON_API_TONLIB_LITESERVERS_PER_WORKER', '1')),
+                              shared_memory_threshold=int(os.environ.get('TON_API_TONLIB_SHARED_MEMORY_THRESHOLD', '262144')))
 
 
 @dataclass
@@ -59,17 +71,29 @@ class RedisSettings:
             return RedisSettings(endpoint=os.environ.get('TON_API_CACHE_REDIS_ENDPOINT', 'localhost'),
                                 port=int(os.environ.get('TON_API_CACHE_REDIS_PORT', '6379')),
                                 timeout=int(os.environ.get('TON_API_CACHE_REDIS_TIMEOUT', '1')))
+        if settings_type == 'cluster':
+            return RedisSettings(endpoint=os.environ.get('TON_API_CLUSTER_REDIS_ENDPOINT', os.environ.get('TON_API_CACHE_REDIS_ENDPOINT', 'localhost')),
+                                port=int(os.environ.get('TON_API_CLUSTER_REDIS_PORT', os.environ.get('TON_API_CACHE_REDIS_PORT', '6379'))),
+                                timeout=int(os.environ.get('TON_API_CLUSTER_REDIS_TIMEOUT', '1')))
+        if settings_type == 'rate_limit':
+            if not os.environ.get('TON_API_RATE_LIMIT_REDIS_ENDPOINT'):
+                return None
+            return RedisSettings(endpoint=os.environ.get('TON_API_RATE_LIMIT_REDIS_ENDPOINT'),
+                                port=int(os.environ.get('TON_API_RATE_LIMIT_REDIS_PORT', '6379')),
+                                timeout=int(os.environ.get('TON_API_RATE_LIMIT_REDIS_TIMEOUT', '1')))
 
 
 @dataclass
 class LoggingSettings:
     jsonify: bool
     level: str
+    sample_rate: float = 1.0
 
     @classmethod
     def from_environment(cls):
         return LoggingSettings(jsonify=strtobool(os.environ.get('TON_API_LOGS_JSONIFY', '0')),
-                               level=os.environ.get('TON_API_LOGS_LEVEL', 'WARNING'))
+                               level=os.environ.get('TON_API_LOGS_LEVEL', 'WARNING'),
+                               sample_rate=float(os.environ.get('TON_API_LOGS_SAMPLE_RATE', '1')))
 
 
 @dataclass
@@ -84,11 +108,21 @@ class CacheSettings:
 @dataclass
 class RedisCacheSettings(CacheSettings):
     redis: Optional[RedisSettings]
+    stale_ttl: float = 5
+    lock_ttl: float = 10
+    lock_wait: float = 2
+    early_refresh_beta: float = 1
+    negative_ttl: float = 5
 
     @classmethod
     def from_environment(cls):
         return RedisCacheSettings(enabled=strtobool(os.environ.get('TON_API_CACHE_ENABLED', '0')),
-                                  redis=RedisSettings.from_environment('cache'))
+                                  redis=RedisSettings.from_environment('cache'),
+                                  stale_ttl=float(os.environ.get('TON_API_CACHE_STALE_TTL', '5')),
+                                  lock_ttl=float(os.environ.get('TON_API_CACHE_LOCK_TTL', '10')),
+                                  lock_wait=float(os.environ.get('TON_API_CACHE_LOCK_WAIT', '2')),
+                                  early_refresh_beta=float(os.environ.get('TON_API_CACHE_EARLY_REFRESH_BETA', '1')),
+                                  negative_ttl=float(os.environ.get('TON_API_CACHE_NEGATIVE_TTL', '5')))
 
 
 @dataclass
@@ -96,12 +130,215 @@ class WebServerSettings:
     api_root_path: str
     get_methods: bool
     json_rpc: bool
+    address_cache_size: int = 100000
+    max_bulk_addresses: int = 10000
 
     @classmethod
     def from_environment(cls):
         return WebServerSettings(api_root_path=os.environ.get('TON_API_ROOT_PATH', '/'),
                                  get_methods=strtobool(os.environ.get('TON_API_GET_METHODS_ENABLED', '1')),
-                                 json_rpc=strtobool(os.environ.get('TON_API_JSON_RPC_ENABLED', '1')))
+                                 json_rpc=strtobool(os.environ.get('TON_API_JSON_RPC_ENABLED', '1')),
+                                 address_cache_size=int(os.environ.get('TON_API_ADDRESS_CACHE_SIZE', '100000')),
+                                 max_bulk_addresses=int(os.environ.get('TON_API_MAX_BULK_ADDRESSES', '10000')))
+
+
+@dataclass
+class SendSettings:
+    resend_interval: int = 5
+    resend_duration: int = 60
+    max_resend_messages: int = 10000
+    broadcast_fanout: int = 4
+    dedup_window: int = 60
+
+    @classmethod
+    def from_environment(cls):
+        return SendSettings(resend_interval=int(os.environ.get('TON_API_SEND_RESEND_INTERVAL', '5')),
+                            resend_duration=int(os.environ.get('TON_API_SEND_RESEND_DURATION', '60')),
+                            max_resend_messages=int(os.environ.get('TON_API_SEND_MAX_RESEND_MESSAGES', '10000')),
+                            broadcast_fanout=int(os.environ.get('TON_API_SEND_BROADCAST_FANOUT', '4')),
+                            dedup_window=int(os.environ.get('TON_API_SEND_DEDUP_WINDOW', '60')))
+
+
+def parse_weights(val):
+    weights = {}
+    for item in val.split(','):
+        if not item.strip():
+            continue
+        method, weight = item.split(':')
+        weights[method.strip()] = float(weight)
+    return weights
+
+
+@dataclass
+class RateLimitSettings:
+    enabled: bool
+    rate: float
+    burst: float
+    no_key_rate: float
+    no_key_burst: float
+    method_weights: Dict[str, float]
+    sync_interval: float
+    redis: Optional[RedisSettings]
+    trusted_proxies: Optional[List[str]] = None
+    api_keys: Optional[List[str]] = None
+
+    @classmethod
+    def from_environment(cls):
+        return RateLimitSettings(enabled=strtobool(os.environ.get('TON_API_RATE_LIMIT_ENABLED', '0')),
+                                 rate=float(os.environ.get('TON_API_RATE_LIMIT_RATE', '10')),
+                                 burst=float(os.environ.get('TON_API_RATE_LIMIT_BURST', '20')),
+                                 no_key_rate=float(os.environ.get('TON_API_RATE_LIMIT_NO_KEY_RATE', '1')),
+                                 no_key_burst=float(os.environ.get('TON_API_RATE_LIMIT_NO_KEY_BURST', '2')),
+                                 method_weights=parse_weights(os.environ.get('TON_API_RATE_LIMIT_METHOD_WEIGHTS', 'runGetMethod:2,getTransactions:2,sendBoc:2,sendBocReturnHash:2')),
+                                 sync_interval=float(os.environ.get('TON_API_RATE_LIMIT_SYNC_INTERVAL', '1')),
+                                 redis=RedisSettings.from_environment('rate_limit'),
+                                 trusted_proxies=[item.strip() for item in os.environ.get('TON_API_RATE_LIMIT_TRUSTED_PROXIES', '').split(',') if item.strip()],
+                                 api_keys=[item.strip() for item in os.environ.get('TON_API_RATE_LIMIT_API_KEYS', '').split(',') if item.strip()])
+
+
+@dataclass
+class BlockIndexSettings:
+    enabled: bool
+    window_hours: float = 6
+    max_transactions: int = 1000000
+    max_block_transactions: int = 10000
+
+    @classmethod
+    def from_environment(cls):
+        return BlockIndexSettings(enabled=strtobool(os.environ.get('TON_API_BLOCK_INDEX_ENABLED', '0')),
+                                  window_hours=float(os.environ.get('TON_API_BLOCK_INDEX_WINDOW_HOURS', '6')),
+                                  max_transactions=int(os.environ.get('TON_API_BLOCK_INDEX_MAX_TRANSACTIONS', '1000000')),
+                                  max_block_transactions=int(os.environ.get('TON_API_BLOCK_INDEX_MAX_BLOCK_TRANSACTIONS', '10000')))
+
+
+@dataclass
+class BlockStoreSettings:
+    enabled: bool
+    path: str = './ton_block_store/block_store.sqlite3'
+    max_size_mb: int = 4096
+
+    @classmethod
+    def from_environment(cls):
+        return BlockStoreSettings(enabled=strtobool(os.environ.get('TON_API_BLOCK_STORE_ENABLED', '0')),
+                                  path=os.environ.get('TON_API_BLOCK_STORE_PATH', './ton_block_store/block_store.sqlite3'),
+                                  max_size_mb=int(os.environ.get('TON_API_BLOCK_STORE_MAX_SIZE_MB', '4096')))
+
+
+@dataclass
+class TimelineSettings:
+    enabled: bool = False
+    backfill_blocks: int = 100000
+
+    @classmethod
+    def from_environment(cls):
+        return TimelineSettings(enabled=strtobool(os.environ.get('TON_API_TIMELINE_ENABLED', '0')),
+                                backfill_blocks=int(os.environ.get('TON_API_TIMELINE_BACKFILL_BLOCKS', '100000')))
+
+
+@dataclass
+class ConfigSnapshotSettings:
+    enabled: bool = False
+
+    @classmethod
+    def from_environment(cls):
+        return ConfigSnapshotSettings(enabled=strtobool(os.environ.get('TON_API_CONFIG_SNAPSHOTS_ENABLED', '0')))
+
+
+@dataclass
+class PrefetchSettings:
+    enabled: bool = False
+    max_inflight: int = 16
+    min_hit_rate: float = 0.25
+
+    @classmethod
+    def from_environment(cls):
+        return PrefetchSettings(enabled=strtobool(os.environ.get('TON_API_PREFETCH_ENABLED', '0')),
+                                max_inflight=int(os.environ.get('TON_API_PREFETCH_MAX_INFLIGHT', '16')),
+                                min_hit_rate=float(os.environ.get('TON_API_PREFETCH_MIN_HIT_RATE', '0.25')))
+
+
+@dataclass
+class TransactionCacheSettings:
+    enabled: bool = False
+    max_transactions: int = 20000
+
+    @classmethod
+    def from_environment(cls):
+        return TransactionCacheSettings(enabled=strtobool(os.environ.get('TON_API_TRANSACTION_CACHE_ENABLED', '0')),
+                                        max_transactions=int(os.environ.get('TON_API_TRANSACTION_CACHE_MAX_TRANSACTIONS', '20000')))
+
+
+@dataclass
+class CompressionSettings:
+    enabled: bool = False
+    min_size: int = 1024
+    thread_min_size: int = 65536
+    gzip_level: int = 6
+    brotli_quality: int = 4
+    zstd_level: int = 3
+
+    @classmethod
+    def from_environment(cls):
+        return CompressionSettings(enabled=strtobool(os.environ.get('TON_API_COMPRESSION_ENABLED', '0')),
+                                   min_size=int(os.environ.get('TON_API_COMPRESSION_MIN_SIZE', '1024')),
+                                   thread_min_size=int(os.environ.get('TON_API_COMPRESSION_THREAD_MIN_SIZE', '65536')),
+                                   gzip_level=int(os.environ.get('TON_API_COMPRESSION_GZIP_LEVEL', '6')),
+                                   brotli_quality=int(os.environ.get('TON_API_COMPRESSION_BROTLI_QUALITY', '4')),
+                                   zstd_level=int(os.environ.get('TON_API_COMPRESSION_ZSTD_LEVEL', '3')))
+
+
+@dataclass
+class ClusterSettings:
+    enabled: bool = False
+    heartbeat_interval: float = 1
+    lease_ttl: float = 5
+    redis: Optional[RedisSettings] = None
+
+    @classmethod
+    def from_environment(cls):
+        return ClusterSettings(enabled=strtobool(os.environ.get('TON_API_CLUSTER_ENABLED', '0')),
+                               heartbeat_interval=float(os.environ.get('TON_API_CLUSTER_HEARTBEAT_INTERVAL', '1')),
+                               lease_ttl=float(os.environ.get('TON_API_CLUSTER_LEASE_TTL', '5')),
+                               redis=RedisSettings.from_environment('cluster'))
+
+
+@dataclass
+class RetrySettings:
+    enabled: bool = True
+    race_after: float = 0
+    backoff: float = 0.05
+    max_backoff: float = 0.5
+
+    @classmethod
+    def from_environment(cls):
+        return RetrySettings(enabled=strtobool(os.environ.get('TON_API_RETRY_ENABLED', '1')),
+                             race_after=float(os.environ.get('TON_API_RETRY_RACE_AFTER', '0')),
+                             backoff=float(os.environ.get('TON_API_RETRY_BACKOFF', '0.05')),
+                             max_backoff=float(os.environ.get('TON_API_RETRY_MAX_BACKOFF', '0.5')))
+
+
+@dataclass
+class OffloadSettings:
+    executor: str = 'process'
+    max_workers: int = 2
+    min_size: int = 4096
+
+    @classmethod
+    def from_environment(cls):
+        return OffloadSettings(executor=os.environ.get('TON_API_OFFLOAD_EXECUTOR', 'process'),
+                               max_workers=int(os.environ.get('TON_API_OFFLOAD_MAX_WORKERS', '2')),
+                               min_size=int(os.environ.get('TON_API_OFFLOAD_MIN_SIZE', '4096')))
+
+
+@dataclass
+class LoopLagSettings:
+    interval: float = 0.5
+    warning_threshold: float = 0.1
+
+    @classmethod
+    def from_environment(cls):
+        return LoopLagSettings(interval=float(os.environ.get('TON_API_LOOP_LAG_INTERVAL', '0.5')),
+                               warning_threshold=float(os.environ.get('TON_API_LOOP_LAG_WARNING_THRESHOLD', '0.1')))
 
 
 @dataclass
@@ -110,6 +347,19 @@ class Settings:
     webserver: WebServerSettings
     cache: CacheSettings
     logging: LoggingSettings
+    send: SendSettings
+    rate_limit: RateLimitSettings
+    block_index: BlockIndexSettings
+    block_store: BlockStoreSettings
+    timeline: TimelineSettings
+    config_snapshots: ConfigSnapshotSettings
+    prefetch: PrefetchSettings
+    transaction_cache: TransactionCacheSettings
+    compression: CompressionSettings
+    offload: OffloadSettings
+    loop_lag: LoopLagSettings
+    cluster: ClusterSettings
+    retry: RetrySettings
 
     @classmethod
     def from_environment(cls):
@@ -119,4 +369,17 @@ class Settings:
         return Settings(tonlib=TonlibSettings.from_environment(),
                         webserver=WebServerSettings.from_environment(),
                         logging=logging,
-                        cache=cache)
+                        cache=cache,
+                        send=SendSettings.from_environment(),
+                        rate_limit=RateLimitSettings.from_environment(),
+                        block_index=BlockIndexSettings.from_environment(),
+                        block_store=BlockStoreSettings.from_environment(),
+                        timeline=TimelineSettings.from_environment(),
+                        config_snapshots=ConfigSnapshotSettings.from_environment(),
+                        prefetch=PrefetchSettings.from_environment(),
+                        transaction_cache=TransactionCacheSettings.from_environment(),
+                        compression=CompressionSettings.from_environment(),
+                        offload=OffloadSettings.from_environment(),
+                        loop_lag=LoopLagSettings.from_environment(),
+                        cluster=ClusterSettings.from_environment(),
+                        retry=RetrySettings.from_environment())
@@ -0,0 +1,140 @@
+import asyncio
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from pyTON.settings import BlockStoreSettings
+
+from loguru import logger
+
+
+class DisabledBlockStore:
+    def stored(self, immutable=None):
+        def g(func):
+            return func
+        return g
+
+    def close(self):
+        pass
+
+
+class BlockStore:
+    """
+    Persistent SQLite store for immutable block data. Reads are served from memory-mapped
+    database file, so block data outlives the Redis cache and restarts of the service.
+    Least recently read entries are evicted when the file exceeds max_size.
+    """
+    schema = '''
+        CREATE TABLE IF NOT EXISTS block_data (
+            key TEXT PRIMARY KEY,
+            value BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            accessed_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS block_data_accessed_at ON block_data (accessed_at);
+    '''
+    touch_interval = 3600
+
+    def __init__(self, block_store_settings: BlockStoreSettings):
+        self.settings = block_store_settings
+        self.max_size = block_store_settings.max_size_mb * 1024 * 1024
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='block_store')
+        self.write_lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(self.settings.path))
+        os.makedirs(directory, exist_ok=True)
+        with self.write_lock:
+            self.connection().executescript(self.schema)
+            self.size = self.connection().execute('SELECT COALESCE(SUM(size), 0) FROM block_data').fetchone()[0]
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.settings.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA mmap_size={self.max_size * 2}')
+            self.local.conn = conn
+        return conn
+
+    def close(self):
+        self.executor.shutdown()
+
+    def _get(self, key):
+        row = self.connection().execute('SELECT value, accessed_at FROM block_data WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        value, accessed_at = row
+        now = time.time()
+        if now - accessed_at > self.touch_interval:
+            with self.write_lock:
+                self.connection().execute('UPDATE block_data SET accessed_at = ? WHERE key = ?', (now, key))
+        return pickle.loads(value)
+
+    def _put(self, key, value):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.write_lock:
+            conn = self.connection()
+            conn.execute('INSERT OR REPLACE INTO block_data (key, value, size, accessed_at) VALUES (?, ?, ?, ?)',
+                         (key, data, len(data), time.time()))
+            self.size += len(data)
+            if self.size > self.max_size:
+                self._evict(conn)
+
+    def _evict(self, conn):
+        # total size is shared by webserver processes, so it is recounted before eviction
+        self.size = conn.execute('SELECT COALESCE(SUM(size), 0) FROM block_data').fetchone()[0]
+        target = int(self.max_size * 0.9)
+        while self.size > target:
+            rows = conn.execute('SELECT key, size FROM block_data ORDER BY accessed_at LIMIT 256').fetchall()
+            if not rows:
+                break
+            evicted = []
+            for key, size in rows:
+                if self.size <= target:
+                    break
+                evicted.append((key,))
+                self.size -= size
+            conn.executemany('DELETE FROM block_data WHERE key = ?', evicted)
+        logger.info('BlockStore evicted entries, size: {size}', size=self.size)
+
+    async def get(self, key):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._get, key)
+
+    async def put(self, key, value):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._put, key, value)
+
+    def stored(self, immutable=None):
+        """
+        Serves results from the store first. Results are stored only if immutable(*args, **kwargs)
+        is true for the call and the result is not an error.
+        """
+        def g(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                if immutable is not None and not immutable(*args, **kwargs):
+                    return await func(*args, **kwargs)
+                key = repr((func.__name__, args, sorted(kwargs.items())))
+                try:
+                    result = await self.get(key)
+                except sqlite3.Error as e:
+                    logger.warning('BlockStore read failed: {exc}', exc=e)
+                    result = None
+                if result is not None:
+                    return result
+
+                result = await func(*args, **kwargs)
+                if isinstance(result, dict) and result.get('@type', 'error') != 'error':
+                    try:
+                        await self.put(key, result)
+                    except sqlite3.Error as e:
+                        logger.warning('BlockStore write failed: {exc}', exc=e)
+                return result
+            return wrapper
+        return g
@@ -0,0 +1,206 @@
+import asyncio
+import base64
+import traceback
+
+from array import array
+from bisect import bisect_right
+
+from pyTON.settings import TimelineSettings
+
+from loguru import logger
+
+
+MASTERCHAIN_SHARD = -9223372036854775808
+
+
+class MasterchainTimeline:
+    """
+    Index of masterchain blocks seqno -> (gen_utime, start_lt, end_lt, root_hash, file_hash) kept
+    in flat arrays. Blocks are appended as the consensus block advances, after a stall the index
+    catches up by max_catch_up_blocks per second. Older blocks are backfilled only when a lookup
+    falls below the index, by backfill_chunk blocks per second down to the looked up block, but
+    not further than backfill_blocks below the tip. Entries are contiguous, so lookups by
+    unixtime or lt are binary searches.
+
+    Lookups follow liteserver semantics: the first block with gen_utime > unixtime or end_lt > lt,
+    that is the block containing lt. Values on block boundaries are left to liteservers.
+    """
+    backfill_chunk = 64
+    backfill_interval = 1
+    max_catch_up_blocks = 64
+
+    def __init__(self, tonlib, timeline_settings: TimelineSettings):
+        self.tonlib = tonlib
+        self.settings = timeline_settings
+        self.reset(0)
+
+        # lowest lt and unixtime looked up below the index, backfill goes down to their blocks
+        self.backfill_lt = None
+        self.backfill_utime = None
+        self.backfill_task = None
+
+    def reset(self, first_seqno):
+        self.first_seqno = first_seqno
+        self.utimes = array('q')
+        self.start_lts = array('q')
+        self.end_lts = array('q')
+        self.hashes = bytearray()  # root_hash + file_hash of each block
+
+    def __len__(self):
+        return len(self.utimes)
+
+    @property
+    def last_seqno(self):
+        return self.first_seqno + len(self) - 1
+
+    @staticmethod
+    def parse_header(header):
+        block_id = header['id']
+        return (int(header['gen_utime']), int(header['start_lt']), int(header['end_lt']),
+                base64.b64decode(block_id['root_hash']) + base64.b64decode(block_id['file_hash']))
+
+    def append(self, headers):
+        for header in headers:
+            utime, start_lt, end_lt, hashes = self.parse_header(header)
+            self.utimes.append(utime)
+            self.start_lts.append(start_lt)
+            self.end_lts.append(end_lt)
+            self.hashes += hashes
+
+    def prepend(self, headers):
+        parsed = [self.parse_header(header) for header in headers]
+        self.utimes[0:0] = array('q', [p[0] for p in parsed])
+        self.start_lts[0:0] = array('q', [p[1] for p in parsed])
+        self.end_lts[0:0] = array('q', [p[2] for p in parsed])
+        self.hashes[0:0] = b''.join(p[3] for p in parsed)
+        self.first_seqno -= len(parsed)
+
+    def block_id(self, seqno):
+        i = (seqno - self.first_seqno) * 64
+        return {
+            '@type': 'ton.blockIdExt',
+            'workchain': -1,
+            'shard': str(MASTERCHAIN_SHARD),
+            'seqno': seqno,
+            'root_hash': base64.b64encode(self.hashes[i:i + 32]).decode('utf-8'),
+            'file_hash': base64.b64encode(self.hashes[i + 32:i + 64]).decode('utf-8'),
+        }
+
+    def find(self, values, value):
+        """
+        Returns index of the first block with values[index] > value or None if the answer is
+        outside of the index or value is on a block boundary.
+        """
+        index = bisect_right(values, value)
+        if index == 0 or index == len(values) or values[index - 1] == value:
+            return None
+        return index
+
+    def lookup(self, lt=None, unixtime=None):
+        """
+        Resolves masterchain block by lt or unixtime. Returns None if the index can't answer.
+        Lookups below the index start its backfill.
+        """
+        if lt is not None:
+            if unixtime is not None:
+                return None
+            values, value = self.end_lts, lt
+        elif unixtime is not None:
+            values, value = self.utimes, unixtime
+        else:
+            return None
+        if len(values) and value < values[0]:
+            self.request_backfill(lt, unixtime)
+            return None
+        index = self.find(values, value)
+        if index is None:
+            return None
+        return self.block_id(self.first_seqno + index)
+
+    def is_recent(self, seqno, lt=None, unixtime=None):
+        """
+        Checks that block by lt or unixtime is not older than masterchain block seqno, so it can be
+        looked up on a non-archival liteserver.
+        """
+        index = seqno - self.first_seqno
+        if index < 0 or index >= len(self):
+            return False
+        if lt is not None and lt < self.start_lts[index]:
+            return False
+        if unixtime is not None and unixtime < self.utimes[index]:
+            return False
+        return lt is not None or unixtime is not None
+
+    async def get_headers(self, seqnos):
+        headers = await asyncio.gather(*[self.tonlib.getBlockHeader(-1, MASTERCHAIN_SHARD, seqno) for seqno in seqnos])
+        for header in headers:
+            if header.get('@type', 'error') == 'error':
+                raise Exception(f"failed to get block header: {header}")
+        return headers
+
+    async def follow(self):
+        consensus_seqno = self.tonlib.consensus_block.seqno
+        if consensus_seqno == 0:
+            return
+        if not len(self) or consensus_seqno - self.last_seqno > self.settings.backfill_blocks:
+            # none of indexed blocks would be kept, the index starts from the new tip
+            self.reset(consensus_seqno)
+        last_seqno = min(consensus_seqno, self.last_seqno + self.max_catch_up_blocks)
+        if last_seqno > self.last_seqno:
+            self.append(await self.get_headers(range(self.last_seqno + 1, last_seqno + 1)))
+
+    def needs_backfill(self):
+        if not len(self) or self.first_seqno <= max(1, self.last_seqno - self.settings.backfill_blocks + 1):
+            return False
+        return ((self.backfill_lt is not None and self.end_lts[0] > self.backfill_lt) or
+                (self.backfill_utime is not None and self.utimes[0] > self.backfill_utime))
+
+    def request_backfill(self, lt=None, unixtime=None):
+        if lt is not None:
+            self.backfill_lt = lt if self.backfill_lt is None else min(self.backfill_lt, lt)
+        if unixtime is not None:
+            self.backfill_utime = unixtime if self.backfill_utime is None else min(self.backfill_utime, unixtime)
+        if self.needs_backfill() and (self.backfill_task is None or self.backfill_task.done()):
+            self.backfill_task = self.tonlib.create_background_task(self.backfill())
+
+    async def backfill(self):
+        try:
+            while self.needs_backfill():
+                target = max(1, self.last_seqno - self.settings.backfill_blocks + 1)
+                first_seqno = self.first_seqno
+                headers = await self.get_headers(range(max(target, first_seqno - self.backfill_chunk), first_seqno))
+                # the index was reset or trimmed meanwhile
+                if self.first_seqno == first_seqno:
+                    self.prepend(headers)
+                await asyncio.sleep(self.backfill_interval)
+        except asyncio.CancelledError:
+            logger.info('Task MasterchainTimeline.backfill was cancelled')
+        except:
+            logger.warning('MasterchainTimeline failed to backfill: {format_exc}', format_exc=traceback.format_exc())
+        finally:
+            self.backfill_lt = None
+            self.backfill_utime = None
+
+    def trim(self):
+        extra = len(self) - self.settings.backfill_blocks
+        if extra > 0:
+            del self.utimes[:extra]
+            del self.start_lts[:extra]
+            del self.end_lts[:extra]
+            del self.hashes[:extra * 64]
+            self.first_seqno += extra
+
+    async def run(self):
+        while True:
+            try:
+                await self.follow()
+                self.trim()
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                if self.backfill_task is not None:
+                    self.backfill_task.cancel()
+                logger.info('Task MasterchainTimeline.run was cancelled')
+                return
+            except:
+                logger.warning('MasterchainTimeline failed to update: {format_exc}', format_exc=traceback.format_exc())
+                await asyncio.sleep(1)
@@ -0,0 +1,158 @@
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from typing import Optional
+
+from pyTON.settings import TransactionCacheSettings, PrefetchSettings
+
+from pytonlib.utils.common import hash_to_hex
+
+from loguru import logger
+
+
+class AccountTransactions:
+    """
+    Cached part of account history. Transactions are indexed by lt, prev links lt -> (lt, hash)
+    of the previous transaction are known for transactions fetched together with their predecessor,
+    None marks the first transaction of the account.
+    """
+    __slots__ = ('txs', 'prev', 'lts', 'prefetched', 'prefetches', 'prefetch_hits')
+
+    def __init__(self):
+        self.txs = {}
+        self.prev = {}
+        self.lts = []
+
+        self.prefetched = set()  # lts of prefetched pages not requested yet
+        self.prefetches = 0
+        self.prefetch_hits = 0
+
+    def __len__(self):
+        return len(self.txs)
+
+    def get(self, lt, tx_hash):
+        tx = self.txs.get(lt)
+        if tx is None or hash_to_hex(tx['transaction_id']['hash']) != hash_to_hex(tx_hash):
+            return None
+        return tx
+
+    def below(self, lt):
+        """
+        Returns id of the latest cached transaction older than lt.
+        """
+        i = bisect_left(self.lts, lt)
+        if i == 0:
+            return None
+        tx = self.txs[self.lts[i - 1]]
+        return int(tx['transaction_id']['lt']), tx['transaction_id']['hash']
+
+    def add(self, transactions, bound, ended):
+        """
+        Adds consecutive transactions, newest first. If the page ended before the limit,
+        the predecessor of the last transaction is bound.
+        """
+        for i, tx in enumerate(transactions):
+            lt = int(tx['transaction_id']['lt'])
+            if lt not in self.txs:
+                insort(self.lts, lt)
+            self.txs[lt] = tx
+            if i + 1 < len(transactions):
+                prev = transactions[i + 1]['transaction_id']
+                self.prev[lt] = (int(prev['lt']), prev['hash'])
+            elif ended:
+                self.prev[lt] = bound
+
+
+class TransactionCache:
+    """
+    Per account cache of individual transactions. Transactions are immutable, so requests are
+    served by walking cached chains, and only missing parts of history are fetched: new
+    transactions above the cached top and the tail below the cached bottom. Least recently used
+    accounts are evicted when the cache holds more than max_transactions.
+
+    If prefetch is enabled, the page following a served page is fetched in background, since
+    paginating clients request it next. Prefetch stops for accounts whose prefetched pages are
+    not requested.
+
+    Cached transactions are shared by requests and must not be modified.
+    """
+    min_prefetch_samples = 4
+
+    def __init__(self, tonlib, transaction_cache_settings: Optional[TransactionCacheSettings]=None, prefetch_settings: Optional[PrefetchSettings]=None):
+        self.tonlib = tonlib
+        self.settings = transaction_cache_settings or TransactionCacheSettings()
+        self.prefetch_settings = prefetch_settings or PrefetchSettings()
+        self.accounts = OrderedDict()  # (account, decode_messages) -> AccountTransactions
+        self.size = 0
+        self.prefetch_tasks = set()
+
+    def account(self, key):
+        chain = self.accounts.get(key)
+        if chain is None:
+            chain = self.accounts[key] = AccountTransactions()
+        else:
+            self.accounts.move_to_end(key)
+        return chain
+
+    def evict(self):
+        while self.size > self.settings.max_transactions and len(self.accounts) > 1:
+            _, chain = self.accounts.popitem(last=False)
+            self.size -= len(chain)
+
+    async def fetch(self, chain, account, lt, tx_hash, limit, decode_messages, archival):
+        # fetching stops at the next cached transaction, so only the gap is requested
+        bound = chain.below(lt)
+        to_lt = bound[0] if bound is not None else 0
+        transactions = await self.tonlib._get_transactions(account, lt, tx_hash, to_lt, limit, decode_messages, archival)
+        # a short page ended at the bound or at the first transaction of the account
+        size = len(chain)
+        chain.add(transactions, bound, ended=len(transactions) < limit)
+        if self.accounts.get((account, decode_messages)) is chain:
+            self.size += len(chain) - size
+            self.evict()
+
+    def prefetch(self, chain, account, lt, tx_hash, limit, decode_messages, archival):
+        if len(self.prefetch_tasks) >= self.prefetch_settings.max_inflight or lt in chain.prefetched:
+            return
+        if chain.prefetches >= self.min_prefetch_samples and chain.prefetch_hits < chain.prefetches * self.prefetch_settings.min_hit_rate:
+            return
+        if len(chain.prefetched) > 64:
+            chain.prefetched.clear()
+        chain.prefetches += 1
+        chain.prefetched.add(lt)
+        task = self.tonlib.create_background_task(self.get_transactions(account, lt, tx_hash, 0, limit, decode_messages, archival, prefetch=False))
+        self.prefetch_tasks.add(task)
+        task.add_done_callback(self.on_prefetched)
+
+    def on_prefetched(self, task):
+        self.prefetch_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.info('Transactions prefetch failed: {exc}', exc=task.exception())
+
+    async def get_transactions(self, account, from_transaction_lt=None, from_transaction_hash=None, to_transaction_lt=0, limit=10, decode_messages=True, archival=False, prefetch=True):
+        if from_transaction_lt is None or from_transaction_hash is None:
+            from_transaction_lt, from_transaction_hash = await self.tonlib._account_version(account)
+        lt, tx_hash = int(from_transaction_lt), from_transaction_hash
+        to_lt = to_transaction_lt or 0
+
+        chain = self.account((account, decode_messages))
+        if prefetch and lt in chain.prefetched:
+            chain.prefetched.discard(lt)
+            chain.prefetch_hits += 1
+        result = []
+        fetched_at = None
+        while len(result) < limit and lt > to_lt:
+            tx = chain.get(lt, tx_hash)
+            if tx is None or lt not in chain.prev:
+                if fetched_at == lt:
+                    break
+                await self.fetch(chain, account, lt, tx_hash, limit - len(result) + 1, decode_messages, archival)
+                fetched_at = lt
+                continue
+            result.append(tx)
+            if chain.prev[lt] is None:
+                return result
+            lt, tx_hash = chain.prev[lt]
+
+        if prefetch and self.prefetch_settings.enabled and len(result) == limit and lt > to_lt:
+            self.prefetch(chain, account, lt, tx_hash, limit, decode_messages, archival)
+        return result
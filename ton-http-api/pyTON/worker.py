@@ -1,27 +1,95 @@
 import asyncio
+import os
+import pickle
 import random
 import sys
 import time
 import queue
+import uuid
 import multiprocessing as mp
 
+from multiprocessing import shared_memory, resource_tracker
+
 from pyTON.settings import TonlibSettings
-from pyTON.models import TonlibWorkerMsgType, TonlibClientResult
+from pyTON.logs import log_enabled, sampled
+from pyTON.models import TonlibWorkerMsgType, TonlibClientResult, SharedMemoryResult, PickledResult, TonlibTaskPriority
 from pytonlib import TonlibClient, TonlibException, BlockNotFound
 from datetime import datetime
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from enum import Enum
 from dataclasses import dataclass
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
 
 from loguru import logger
 
 
+def release_shared_memory(prefix):
+    """
+    Unlinks shared memory segments with the prefix. Called for a stopped worker, whose results
+    left in the queue are never read by the manager.
+    """
+    if not os.path.isdir('/dev/shm'):
+        return
+    for name in os.listdir('/dev/shm'):
+        if name.startswith(prefix):
+            try:
+                os.unlink(os.path.join('/dev/shm', name))
+            except FileNotFoundError:
+                pass
+
+
+def drop_result(task):
+    if not task.cancelled():
+        task.exception()
+
+
+class FairTaskQueue:
+    """
+    Weighted fair queue of liteserver tasks with a lane per priority. Task with the smallest
+    virtual finish time (cost / weight after the previous task of its lane) starts first,
+    so each lane gets a share of slots proportional to its weight. Heavy and background tasks
+    may take only part of the slots, the rest is kept for sends and cheap reads.
+    """
+    weights = {TonlibTaskPriority.SEND: 8, TonlibTaskPriority.LIGHT: 4, TonlibTaskPriority.HEAVY: 1, TonlibTaskPriority.BACKGROUND: 0.5}
+    max_share = {TonlibTaskPriority.SEND: 1.0, TonlibTaskPriority.LIGHT: 1.0, TonlibTaskPriority.HEAVY: 0.5, TonlibTaskPriority.BACKGROUND: 0.25}
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.vtime = 0.0
+        self.lanes = {priority: deque() for priority in TonlibTaskPriority}
+        self.finish = {priority: 0.0 for priority in TonlibTaskPriority}
+        self.running = {priority: 0 for priority in TonlibTaskPriority}
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def can_start(self, priority):
+        return sum(self.running.values()) < self.limit and self.running[priority] < max(1, int(self.limit * self.max_share[priority]))
+
+    def push(self, priority, cost, item):
+        finish = max(self.vtime, self.finish[priority]) + cost / self.weights[priority]
+        self.finish[priority] = finish
+        self.lanes[priority].append((finish, item))
+
+    def pop(self):
+        """
+        Returns priority and item of the next task to start or None if no task can start.
+        """
+        candidates = [priority for priority, lane in self.lanes.items() if lane and self.can_start(priority)]
+        if not candidates:
+            return None
+        priority = min(candidates, key=lambda priority: self.lanes[priority][0][0])
+        finish, item = self.lanes[priority].popleft()
+        self.vtime = max(self.vtime, finish)
+        return priority, item
+
+
 class TonlibWorker(mp.Process):
-    def __init__(self, 
-                 ls_index: int, 
+    def __init__(self,
+                 ls_indices: List[int],
                  tonlib_settings: TonlibSettings,
                  input_queue: Optional[mp.Queue]=None,
                  output_queue: Optional[mp.Queue]=None):
@@ -31,19 +99,31 @@ class TonlibWorker(mp.Process):
         self.output_queue = output_queue or mp.Queue()
         self.exit_event = mp.Event()
 
-        self.ls_index = ls_index
+        self.ls_indices = list(ls_indices)
+        self.ls_index = self.ls_indices[0]
         self.tonlib_settings = tonlib_settings
 
-        self.last_block = -1
-        self.is_archival = False
+        self.last_block = {ls_index: -1 for ls_index in self.ls_indices}
+        self.is_archival = {ls_index: False for ls_index in self.ls_indices}
+        # liteservers probed by another API instance are not probed after the first report
+        self.probing = {ls_index: True for ls_index in self.ls_indices}
         self.semaphore = None
         self.loop = None
         self.tasks = {}
-        self.tonlib = None
+        self.liteserver_tasks = {}
+        self.running_tasks = {}
+        self.task_queues = {ls_index: FairTaskQueue(tonlib_settings.parallel_requests_per_liteserver) for ls_index in self.ls_indices}
+        self.queued_tasks = set()
+        self.cancelled_tasks = set()
+        self.tonlib = {}
         self.threadpool_executor = None
+        # segments of the worker are named by the prefix, so the manager can unlink unread ones
+        self.shm_prefix = f'tonapi_{uuid.uuid4().hex[:12]}_'
+        self.shm_count = 0
 
-        self.timeout_count = 0
-        self.is_dead = False
+    @property
+    def is_multiplexed(self):
+        return len(self.ls_indices) > 1
 
     def run(self):
         self.threadpool_executor = ThreadPoolExecutor(max_workers=16)
@@ -52,40 +132,31 @@ class TonlibWorker(mp.Process):
         policy.set_event_loop(policy.new_event_loop())
         self.loop = asyncio.new_event_loop()
 
-        Path(self.tonlib_settings.keystore).mkdir(parents=True, exist_ok=True)
-
         # init tonlib
-        self.tonlib = TonlibClient(ls_index=self.ls_index,
-                                   config=self.tonlib_settings.liteserver_config,
-                                   keystore=self.tonlib_settings.keystore,
-                                   loop=self.loop,
-                                   cdll_path=self.tonlib_settings.cdll_path,
-                                   verbosity_level=self.tonlib_settings.verbosity_level)
-
-        try:
-            self.loop.run_until_complete(self.tonlib.init())
-        except Exception as e:
-            logger.error("TonlibWorker #{ls_index:03d} failed to init and sync tonlib: {exc}", ls_index=self.ls_index, exc=e)
-            self.shutdown(11)
+        for ls_index in self.ls_indices:
+            try:
+                self.loop.run_until_complete(self.init_tonlib(ls_index))
+            except Exception as e:
+                logger.error("TonlibWorker #{ls_index:03d} failed to init and sync tonlib: {exc}", ls_index=ls_index, exc=e)
+                if not self.is_multiplexed:
+                    self.shutdown(11)
 
         # creating tasks
-        self.tasks['report_last_block'] = self.loop.create_task(self.report_last_block())
-        self.tasks['report_archival'] = self.loop.create_task(self.report_archival())
+        for ls_index in self.ls_indices:
+            self.liteserver_tasks[ls_index] = self.loop.create_task(self.run_liteserver(ls_index))
         self.tasks['main_loop'] = self.loop.create_task(self.main_loop())
-        self.tasks['sync_tonlib'] = self.loop.create_task(self.sync_tonlib())
 
-        finished, unfinished = self.loop.run_until_complete(asyncio.wait([
-            self.tasks['report_last_block'], self.tasks['report_archival'], self.tasks['main_loop'], self.tasks['sync_tonlib']], return_when=asyncio.FIRST_COMPLETED))
+        finished, unfinished = self.loop.run_until_complete(asyncio.wait([self.tasks['main_loop']]))
 
         self.shutdown(0 if self.exit_event.is_set() else 12)
 
     def shutdown(self, code: int):
         self.exit_event.set()
-        
-        for task in self.tasks.values():
+
+        for task in [*self.tasks.values(), *self.liteserver_tasks.values()]:
             task.cancel()
             try:
-                self.loop.run_until_complete(to_cancel)
+                self.loop.run_until_complete(task)
             except:
                 pass
 
@@ -97,73 +168,197 @@ class TonlibWorker(mp.Process):
         self.input_queue.close()
         sys.exit(code)
 
-    @property
-    def info(self):
-        return {
-            'ip_int': f"{self.tonlib_settings.liteserver_config['liteservers'][self.ls_index]['ip']}",
-            'port': f"{self.tonlib_settings.liteserver_config['liteservers'][self.ls_index]['port']}",
-            'last_block': self.last_block,
-            'archival': self.is_archival,
-            'number': self.ls_index,
-        }
-
-    async def report_last_block(self):
+    async def init_tonlib(self, ls_index):
+        keystore = os.path.join(self.tonlib_settings.keystore, f'worker_{ls_index}')
+        Path(keystore).mkdir(parents=True, exist_ok=True)
+
+        tonlib = TonlibClient(ls_index=ls_index,
+                              config=self.tonlib_settings.liteserver_config,
+                              keystore=keystore,
+                              loop=self.loop,
+                              cdll_path=self.tonlib_settings.cdll_path,
+                              verbosity_level=self.tonlib_settings.verbosity_level)
+        await tonlib.init()
+        self.tonlib[ls_index] = tonlib
+
+    async def close_tonlib(self, ls_index):
+        tonlib = self.tonlib.pop(ls_index, None)
+        if tonlib is None:
+            return
+        try:
+            await tonlib.close()
+        except Exception as e:
+            logger.error("TonlibWorker #{ls_index:03d} failed to close tonlib: {exc}", ls_index=ls_index, exc=e)
+
+    async def run_liteserver(self, ls_index):
+        """
+        Runs background tasks of a single liteserver. In multiplexed mode failed liteserver
+        is restarted inside the process, so other liteservers of the worker are not affected.
+        """
+        restart_count = 0
         while not self.exit_event.is_set():
+            started_at = time.time()
+            if ls_index in self.tonlib:
+                tasks = [self.loop.create_task(self.report_last_block(ls_index)),
+                         self.loop.create_task(self.report_archival(ls_index)),
+                         self.loop.create_task(self.sync_tonlib(ls_index))]
+                try:
+                    finished, unfinished = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    for task in tasks:
+                        task.cancel()
+                if self.exit_event.is_set():
+                    return
+                for task in finished:
+                    if not task.cancelled() and task.exception() is not None:
+                        logger.error("TonlibWorker #{ls_index:03d} liteserver task failed: {exc}", ls_index=ls_index, exc=task.exception())
+            if not self.is_multiplexed:
+                return
+
+            # restart liteserver
+            await self.close_tonlib(ls_index)
+            self.last_block[ls_index] = -1
+            await self.loop.run_in_executor(self.threadpool_executor, self.output_queue.put, (TonlibWorkerMsgType.LAST_BLOCK_UPDATE, (ls_index, -1)))
+            await self.loop.run_in_executor(self.threadpool_executor, self.output_queue.put, (TonlibWorkerMsgType.LITESERVER_RESTART, ls_index))
+
+            if time.time() - started_at > 600:
+                restart_count = 0
+            await asyncio.sleep(min(2 ** restart_count, 600))
+            restart_count += 1
+            try:
+                await self.init_tonlib(ls_index)
+            except Exception as e:
+                logger.error("TonlibWorker #{ls_index:03d} failed to init and sync tonlib: {exc}", ls_index=ls_index, exc=e)
+
+    async def remove_liteserver(self, ls_index):
+        task = self.liteserver_tasks.pop(ls_index, None)
+        if task is not None:
+            task.cancel()
+        await self.close_tonlib(ls_index)
+        logger.info("TonlibWorker #{ls_index:03d} liteserver removed", ls_index=ls_index)
+
+    async def report_last_block(self, ls_index):
+        timeout_count = 0
+        connected = False
+        while not self.exit_event.is_set():
+            # a liteserver probed by another instance is checked until the local client gets a block
+            if connected and not self.probing.get(ls_index, True):
+                timeout_count = 0
+                await asyncio.sleep(1)
+                continue
             last_block = -1
             try:
-                masterchain_info = await self.tonlib.get_masterchain_info()
+                masterchain_info = await self.tonlib[ls_index].get_masterchain_info()
                 last_block = masterchain_info["last"]["seqno"]
-                self.timeout_count = 0
+                timeout_count = 0
+                connected = True
             except TonlibException as e:
-                logger.error("TonlibWorker #{ls_index:03d} report_last_block exception of type {exc_type}: {exc}", ls_index=self.ls_index, exc_type=type(e).__name__, exc=e)
-                self.timeout_count += 1
-
-            if self.timeout_count >= 10:
-                raise RuntimeError(f'TonlibWorker #{self.ls_index:03d} got {self.timeout_count} timeouts in report_last_block')
-            
-            self.last_block = last_block
-            await self.loop.run_in_executor(self.threadpool_executor, self.output_queue.put, (TonlibWorkerMsgType.LAST_BLOCK_UPDATE, self.last_block))
+                logger.error("TonlibWorker #{ls_index:03d} report_last_block exception of type {exc_type}: {exc}", ls_index=ls_index, exc_type=type(e).__name__, exc=e)
+                timeout_count += 1
+
+            if timeout_count >= 10:
+                raise RuntimeError(f'TonlibWorker #{ls_index:03d} got {timeout_count} timeouts in report_last_block')
+
+            self.last_block[ls_index] = last_block
+            await self.loop.run_in_executor(self.threadpool_executor, self.output_queue.put, (TonlibWorkerMsgType.LAST_BLOCK_UPDATE, (ls_index, last_block)))
             await asyncio.sleep(1)
 
-    async def report_archival(self):
+    async def report_archival(self, ls_index):
         while not self.exit_event.is_set():
+            if not self.probing.get(ls_index, True):
+                await asyncio.sleep(1)
+                continue
             try:
-                block_transactions = await self.tonlib.get_block_transactions(-1, -9223372036854775808, random.randint(2, 4096), count=10)
-                self.is_archival = True
+                block_transactions = await self.tonlib[ls_index].get_block_transactions(-1, -9223372036854775808, random.randint(2, 4096), count=10)
+                self.is_archival[ls_index] = True
             except BlockNotFound as e:
-                self.is_archival = False
+                self.is_archival[ls_index] = False
             except TonlibException as e:
-                logger.error("TonlibWorker #{ls_index:03d} report_archival exception of type {exc_type}: {exc}", ls_index=self.ls_index, exc_type=type(e).__name__, exc=e)
-            
-            await self.loop.run_in_executor(self.threadpool_executor, self.output_queue.put, (TonlibWorkerMsgType.ARCHIVAL_UPDATE, self.is_archival))
+                logger.error("TonlibWorker #{ls_index:03d} report_archival exception of type {exc_type}: {exc}", ls_index=ls_index, exc_type=type(e).__name__, exc=e)
+
+            await self.loop.run_in_executor(self.threadpool_executor, self.output_queue.put, (TonlibWorkerMsgType.ARCHIVAL_UPDATE, (ls_index, self.is_archival[ls_index])))
             await asyncio.sleep(600)
-        
+
     async def main_loop(self):
-        while not self.exit_event.is_set():
+        while not self.exit_event.is_set() and any(not task.done() for task in self.liteserver_tasks.values()):
             try:
-                task_id, timeout, method, args, kwargs = await self.loop.run_in_executor(self.threadpool_executor, self.input_queue.get, True, 1)
+                msg_type, msg_content = await self.loop.run_in_executor(self.threadpool_executor, self.input_queue.get, True, 1)
             except queue.Empty:
                 continue
 
-            self.loop.create_task(self.process_task(task_id, timeout, method, args, kwargs))
+            if msg_type == TonlibWorkerMsgType.TASK:
+                self.schedule_task(msg_content)
+            if msg_type == TonlibWorkerMsgType.CANCEL_TASK:
+                self.cancel_task(msg_content)
+            if msg_type == TonlibWorkerMsgType.REMOVE_LITESERVER:
+                self.loop.create_task(self.remove_liteserver(msg_content))
+            if msg_type == TonlibWorkerMsgType.PROBE_CONTROL:
+                ls_index, enabled = msg_content
+                self.probing[ls_index] = enabled
 
-    async def process_task(self, task_id, timeout, method, args, kwargs):
+    def cancel_task(self, task_id):
+        task = self.running_tasks.pop(task_id, None)
+        if task is not None:
+            # releases the slot, the tonlib call itself keeps running, see process_task
+            task.cancel()
+        elif task_id in self.queued_tasks:
+            # task is skipped when its turn comes
+            self.cancelled_tasks.add(task_id)
+        logger.debug("TonlibWorker #{ls_index:03d} cancelled task '{task_id}'", ls_index=self.ls_index, task_id=task_id)
+
+    def schedule_task(self, task):
+        task_id, ls_index, timeout, method, args, kwargs, priority, cost = task
+        task_queue = self.task_queues.setdefault(ls_index, FairTaskQueue(self.tonlib_settings.parallel_requests_per_liteserver))
+        task_queue.push(priority, cost, task)
+        self.queued_tasks.add(task_id)
+        self.start_tasks(ls_index)
+
+    def start_tasks(self, ls_index):
+        task_queue = self.task_queues[ls_index]
+        while True:
+            next_task = task_queue.pop()
+            if next_task is None:
+                return
+            priority, (task_id, ls_index, timeout, method, args, kwargs, _, _) = next_task
+            self.queued_tasks.discard(task_id)
+            if task_id in self.cancelled_tasks:
+                self.cancelled_tasks.discard(task_id)
+                continue
+            task_queue.running[priority] += 1
+            task = self.loop.create_task(self.process_task(task_id, ls_index, timeout, method, args, kwargs))
+            task.add_done_callback(lambda task, task_id=task_id, priority=priority, ls_index=ls_index: self.finish_task(task_id, ls_index, priority))
+            self.running_tasks[task_id] = task
+
+    def finish_task(self, task_id, ls_index, priority):
+        self.running_tasks.pop(task_id, None)
+        self.task_queues[ls_index].running[priority] -= 1
+        self.start_tasks(ls_index)
+
+    async def process_task(self, task_id, ls_index, timeout, method, args, kwargs):
         result = None
         exception = None
 
         start_time = datetime.now()
         if time.time() < timeout:
             try:
-                result = await self.tonlib.__getattribute__(method)(*args, **kwargs)
+                if ls_index not in self.tonlib:
+                    raise RuntimeError(f'Liteserver #{ls_index:03d} is not available')
+                # the slot is released at the deadline, nobody waits for the result after it. The tonlib
+                # call is shielded: pytonlib fails on cancelled futures it still keeps, so the call
+                # runs until tonlib answers or expires it, and a late result is dropped
+                call = self.loop.create_task(self.tonlib[ls_index].__getattribute__(method)(*args, **kwargs))
+                call.add_done_callback(drop_result)
+                result = await asyncio.wait_for(asyncio.shield(call), timeout - time.time())
             except Exception as e:
                 exception = e
-                logger.warning("TonlibWorker #{ls_index:03d} raised exception of type {exc_type} while executing task. Method: {method}, args: {args}, kwargs: {kwargs}, exception: {exc}", 
-                    ls_index=self.ls_index, method=method, args=args, kwargs=kwargs, exc_type=type(e).__name__, exc=e)
+                logger.warning("TonlibWorker #{ls_index:03d} raised exception of type {exc_type} while executing task. Method: {method}, args: {args}, kwargs: {kwargs}, exception: {exc}",
+                    ls_index=ls_index, method=method, args=args, kwargs=kwargs, exc_type=type(e).__name__, exc=e)
             else:
-                logger.debug("TonlibWorker #{ls_index:03d} got result {method} for task '{task_id}'", ls_index=self.ls_index, method=method, task_id=task_id)
+                if log_enabled('DEBUG') and sampled(task_id):
+                    logger.debug("TonlibWorker #{ls_index:03d} got result {method} for task '{task_id}'", ls_index=ls_index, method=method, task_id=task_id)
         else:
             exception = asyncio.TimeoutError()
-            logger.warning("TonlibWorker #{ls_index:03d} received task '{task_id}' after timeout", ls_index=self.ls_index, task_id=task_id)
+            logger.warning("TonlibWorker #{ls_index:03d} received task '{task_id}' after timeout", ls_index=ls_index, task_id=task_id)
         end_time = datetime.now()
         elapsed_time = (end_time - start_time).total_seconds()
 
@@ -171,14 +366,48 @@ class TonlibWorker(mp.Process):
         tonlib_task_result = TonlibClientResult(task_id,
                                                 method,
                                                 elapsed_time=elapsed_time,
-                                                params=[args, kwargs],
+                                                ls_index=ls_index,
                                                 result=result,
-                                                exception=exception,
-                                                liteserver_info=self.info)
-        await self.loop.run_in_executor(self.threadpool_executor, self.output_queue.put, (TonlibWorkerMsgType.TASK_RESULT, tonlib_task_result))
+                                                exception=exception)
+        await self.loop.run_in_executor(self.threadpool_executor, self.send_result, tonlib_task_result)
+
+    def send_result(self, tonlib_task_result: TonlibClientResult):
+        tonlib_task_result.result = self.pack_result(tonlib_task_result.result)
+        try:
+            self.output_queue.put((TonlibWorkerMsgType.TASK_RESULT, tonlib_task_result))
+        except:
+            if isinstance(tonlib_task_result.result, SharedMemoryResult):
+                shm = shared_memory.SharedMemory(name=tonlib_task_result.result.name)
+                shm.close()
+                shm.unlink()
+            raise
+
+    def pack_result(self, result):
+        """
+        Moves results larger than shared_memory_threshold to a shared memory segment,
+        so only a small handle is sent through the queue. The segment is unlinked by TonlibManager.
+        Smaller results are sent pickled, since the queue passes bytes without pickling them again.
+        """
+        threshold = self.tonlib_settings.shared_memory_threshold
+        if not threshold or result is None:
+            return result
+        data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) < threshold:
+            return PickledResult(data)
+        self.shm_count += 1
+        try:
+            shm = shared_memory.SharedMemory(name=f'{self.shm_prefix}{self.shm_count}', create=True, size=len(data))
+        except OSError as e:
+            logger.warning("TonlibWorker #{ls_index:03d} failed to allocate shared memory: {exc}", ls_index=self.ls_index, exc=e)
+            return PickledResult(data)
+        shm.buf[:len(data)] = data
+        # ownership of the segment goes to the manager
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        shm.close()
+        return SharedMemoryResult(shm.name, len(data))
 
-    async def sync_tonlib(self):
-        await self.tonlib.sync_tonlib()
+    async def sync_tonlib(self, ls_index):
+        await self.tonlib[ls_index].sync_tonlib()
 
         while not self.exit_event.is_set():
             await asyncio.sleep(1)
@@ -27,6 +27,9 @@ setup(
         'pytonlib==0.0.72',
         'inject==4.3.1'
     ],
+    extras_require={
+        'compression': ['brotli==1.1.0', 'zstandard==0.22.0']
+    },
     package_data={},
     zip_safe=True,
     python_requires='>=3.9',
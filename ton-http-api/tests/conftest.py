@@ -0,0 +1,299 @@
+import asyncio
+import base64
+import queue
+import time
+
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from tvm_valuetypes.cell import Cell
+
+from pyTON.manager import TonlibManager, request_priority
+from pyTON.models import ConsensusBlock
+from pyTON.settings import ClusterSettings, RedisSettings, RetrySettings, TimelineSettings, TonlibSettings
+
+
+def liteserver(i):
+    return {'ip': i, 'port': 1000 + i, 'id': {'key': f'key{i}'}}
+
+
+def make_header(seqno, key_blocks=None):
+    # block seqno is generated at 1000 + 5 * seqno and holds lts [seqno * 100, seqno * 100 + 10]
+    block_id = {'seqno': seqno, 'root_hash': base64.b64encode(seqno.to_bytes(32, 'big')).decode(),
+                'file_hash': base64.b64encode(bytes(32)).decode()}
+    header = {'@type': 'blocks.header', 'id': block_id, 'gen_utime': 1000 + 5 * seqno,
+              'start_lt': seqno * 100, 'end_lt': seqno * 100 + 10}
+    if key_blocks is not None:
+        key_block = max(key_block for key_block in key_blocks if key_block <= seqno)
+        header.update(is_key_block=seqno == key_block, prev_key_block_seqno=key_block)
+    return header
+
+
+def tx_hash(lt):
+    return f'{lt:064x}'
+
+
+def make_tx(lt):
+    return {'@type': 'raw.transaction', 'transaction_id': {'lt': str(lt), 'hash': tx_hash(lt)}}
+
+
+def param_cell(value):
+    cell = Cell()
+    cell.data.put_arbitrary_uint(value, 32)
+    return cell
+
+
+def put_label(cell, label, max_len):
+    width = max_len.bit_length()
+    if len(label) > 1 and len(set(label)) == 1:
+        # hml_same
+        cell.data.put_arbitrary_uint(0b11, 2)
+        cell.data.put_bool(label[0] == '1')
+        cell.data.put_arbitrary_uint(len(label), width)
+    elif len(label) <= 2:
+        # hml_short
+        cell.data.put_bool(False)
+        for _ in label:
+            cell.data.put_bool(True)
+        cell.data.put_bool(False)
+        for bit in label:
+            cell.data.put_bool(bit == '1')
+    else:
+        # hml_long
+        cell.data.put_arbitrary_uint(0b10, 2)
+        cell.data.put_arbitrary_uint(len(label), width)
+        for bit in label:
+            cell.data.put_bool(bit == '1')
+
+
+def build_hashmap(items, key_len):
+    # items: key bits -> value cell
+    keys = sorted(items)
+    label = ''
+    while len(label) < key_len and all(key[len(label)] == keys[0][len(label)] for key in keys):
+        label += keys[0][len(label)]
+    cell = Cell()
+    put_label(cell, label, key_len)
+    if len(label) == key_len:
+        cell.refs.append(items[keys[0]])
+        return cell
+    for bit in '01':
+        branch = {key[len(label) + 1:]: value for key, value in items.items() if key[len(label)] == bit}
+        cell.refs.append(build_hashmap(branch, key_len - len(label) - 1))
+    return cell
+
+
+def config_boc(params):
+    items = {format(config_id, '032b'): param_cell(value) for config_id, value in params.items()}
+    return build_hashmap(items, 32).serialize_boc(has_idx=False, hash_crc32=False)
+
+
+class FakeWorker:
+    def __init__(self):
+        self.input_queue = queue.Queue()
+
+
+class FakeTonlib:
+    """
+    TonlibManager of a simulated chain for tests of its components:
+
+    - masterchain block seqno is described by make_header, key blocks hold config params
+      key_blocks[seqno] (config id -> value);
+    - masterchain block consensus_seqno has a single shard block of block_transactions transactions;
+    - account history has a transaction at every 10th lt up to last_lt;
+    - liteserver ls_index answers after a delay with a result or an exception, answers[ls_index] is
+      (delay, result or exception), odd liteservers are archival;
+    - sent messages are delivered once released is set.
+
+    Calls are recorded with the priority they are made with.
+    """
+    liteserver_key = staticmethod(TonlibManager.liteserver_key)
+    create_background_task = TonlibManager.create_background_task
+
+    def __init__(self, consensus_seqno=0, key_blocks=None, block_transactions=0, last_lt=0, answers=None, last_block=-1):
+        self.consensus_block = ConsensusBlock(seqno=consensus_seqno)
+        self.key_blocks = key_blocks or {0: {}}
+        self.block_transactions = [{'account': '0:' + 'AB' * 32, 'transaction_id': {'lt': str(lt), 'hash': tx_hash(lt)}, 'in_msg': {'hash': f'msg{lt}'}}
+                                   for lt in range(1, block_transactions + 1)]
+        self.last_lt = last_lt
+        self.answers = answers or {}
+
+        self.threadpool_executor = ThreadPoolExecutor(max_workers=1)
+        self.liteservers = [liteserver(0)]
+        self.workers = {0: {'worker': FakeWorker(), 'last_block': last_block, 'is_archival': False, 'is_draining': False}}
+        self.released = asyncio.Event()
+
+        self.calls = []  # (method, *args)
+        self.priorities = set()
+        self.started = {}  # ls_index -> time the attempt started
+        self.finished = set()
+        self.cancelled = set()
+
+    @property
+    def loop(self):
+        return asyncio.get_running_loop()
+
+    def record(self, method, *args):
+        self.calls.append((method,) + args)
+        self.priorities.add(request_priority.get())
+
+    def calls_of(self, method):
+        return [call[1:] for call in self.calls if call[0] == method]
+
+    async def getMasterchainInfo(self):
+        self.record('getMasterchainInfo')
+        return {'last': {'seqno': self.consensus_block.seqno}}
+
+    async def getBlockHeader(self, workchain, shard, seqno):
+        self.record('getBlockHeader', seqno)
+        return make_header(seqno, self.key_blocks)
+
+    async def getShards(self, master_seqno):
+        self.record('getShards', master_seqno)
+        return {'shards': [{'workchain': 0, 'shard': '-9223372036854775808', 'seqno': master_seqno, 'root_hash': 'root', 'file_hash': 'file'}]}
+
+    async def getBlockTransactionsExt(self, workchain, shard, seqno, count, root_hash=None, file_hash=None, after_lt=None, after_hash=None):
+        self.record('getBlockTransactionsExt', workchain, count, root_hash, after_lt)
+        transactions = self.block_transactions if workchain == 0 else []
+        start = int(after_lt) if after_lt else 0
+        return {'id': {'root_hash': 'root', 'file_hash': 'file'}, 'transactions': transactions[start:start + count],
+                'incomplete': start + count < len(transactions)}
+
+    async def get_config_all(self, seqno):
+        self.record('get_config_all', seqno)
+        await asyncio.sleep(0)
+        return {'@type': 'configInfo', 'config': {'@type': 'tvm.cell', 'bytes': base64.b64encode(config_boc(self.key_blocks[seqno])).decode()}}
+
+    async def _get_config_param(self, config_id, seqno):
+        self.record('_get_config_param', config_id, seqno)
+        return {'@type': 'error', 'code': 0}
+
+    async def _account_version(self, address):
+        return str(self.last_lt), tx_hash(self.last_lt)
+
+    async def _get_transactions(self, account, lt, hash, to_lt, limit, decode_messages, archival):
+        self.record('_get_transactions', lt, to_lt, limit)
+        lts = [tx_lt for tx_lt in range(lt, 0, -10) if tx_lt > to_lt][:limit]
+        return [make_tx(tx_lt) for tx_lt in lts]
+
+    async def raw_send_message(self, boc):
+        self.record('raw_send_message', boc)
+        await self.released.wait()
+
+    def select_worker(self, archival=None, exclude=()):
+        for ls_index in sorted(self.answers):
+            if ls_index not in exclude and (archival is None or archival == (ls_index % 2 == 1)):
+                return ls_index
+        raise RuntimeError('No working liteservers')
+
+    async def dispatch_request_to_worker(self, method, ls_index, *args, **kwargs):
+        self.started[ls_index] = time.time()
+        delay, answer = self.answers[ls_index]
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled.add(ls_index)
+            raise
+        self.finished.add(ls_index)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+@pytest.fixture
+def make_tonlib():
+    return FakeTonlib
+
+
+@pytest.fixture(name='make_header')
+def make_header_fixture():
+    return make_header
+
+
+@pytest.fixture(name='tx_hash')
+def tx_hash_fixture():
+    return tx_hash
+
+
+@pytest.fixture(name='config_boc')
+def config_boc_fixture():
+    return config_boc
+
+
+@pytest.fixture(name='liteserver')
+def liteserver_fixture():
+    return liteserver
+
+
+@pytest.fixture
+def make_timeline():
+    from pyTON.timeline import MasterchainTimeline
+
+    def make(first_seqno, last_seqno, backfill_blocks=1000):
+        timeline = MasterchainTimeline(FakeTonlib(last_seqno), TimelineSettings(enabled=True, backfill_blocks=backfill_blocks))
+        timeline.backfill_interval = 0
+        timeline.reset(first_seqno)
+        timeline.append([make_header(seqno) for seqno in range(first_seqno, last_seqno + 1)])
+        return timeline
+    return make
+
+
+@pytest.fixture
+def redis_server():
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def make_cluster():
+    fakeredis = pytest.importorskip('fakeredis')
+    from pyTON.cluster import ClusterState
+
+    def make(server, tonlib):
+        cluster = ClusterState(tonlib, ClusterSettings(enabled=True, redis=RedisSettings(endpoint='localhost', port=6379, timeout=1)))
+        cluster.redis = fakeredis.aioredis.FakeRedis(server=server)
+        cluster.acquire_lease_script = cluster.redis.register_script(cluster.acquire_lease_script.script)
+        cluster.update_consensus_script = cluster.redis.register_script(cluster.update_consensus_script.script)
+        return cluster
+    return make
+
+
+@pytest.fixture
+def run_engine():
+    from pyTON.retry import RetryEngine
+
+    def run_engine(tonlib, method='get_masterchain_info', deadline=1.0, archival=False, settings=None):
+        async def run():
+            engine = RetryEngine(tonlib, settings or RetrySettings(backoff=0.01, max_backoff=0.01))
+            started_at = time.time()
+            try:
+                return await engine.run(method, archival, started_at + deadline, (), {}), time.time() - started_at
+            finally:
+                # let abandoned attempts finish
+                await asyncio.sleep(0.5)
+
+        return asyncio.run(run())
+    return run_engine
+
+
+@pytest.fixture
+def make_manager():
+    def make(liteservers):
+        manager = TonlibManager.__new__(TonlibManager)
+        manager.tonlib_settings = TonlibSettings(parallel_requests_per_liteserver=4, keystore='/tmp/ton_keystore/', liteserver_config_path='',
+                                                 cdll_path=None, request_timeout=10, verbosity_level=0)
+        manager.tonlib_settings.liteserver_config = {'liteservers': list(liteservers)}
+        manager.liteservers = list(liteservers)
+        manager.workers = {ls_index: {'is_draining': False} for ls_index in range(len(liteservers))}
+        manager.tasks = {}
+        manager.spawned = []
+        manager.drained = []
+        manager.spawn_worker = lambda ls_indices: manager.spawned.append(list(ls_indices))
+
+        async def drain_worker(ls_index):
+            manager.drained.append(ls_index)
+        manager.drain_worker = drain_worker
+        return manager
+    return make
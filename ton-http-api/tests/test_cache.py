@@ -0,0 +1,119 @@
+import asyncio
+import pickle
+import time
+
+import pytest
+
+from pyTON.cache import RedisCacheManager, is_persistent_error
+from pyTON.settings import RedisCacheSettings, RedisSettings
+
+from pytonlib import TonlibError
+from pytonlib.tonlibjson import LiteServerTimeout
+
+
+def test_persistent_errors_are_recognized_by_message():
+    assert is_persistent_error({'@type': 'error', 'code': 500, 'message': 'Tx not found'})
+    assert is_persistent_error(TonlibError({'@type': 'error', 'code': 500, 'message': 'INVALID_ACCOUNT_ADDRESS'}))
+    assert is_persistent_error(Exception('Smart contract is not Jetton or NFT'))
+    # error code alone doesn't make an error persistent
+    assert not is_persistent_error({'@type': 'error', 'code': 400, 'message': 'Failed to parse request'})
+
+
+def test_transient_errors_are_never_persistent():
+    assert not is_persistent_error(LiteServerTimeout({'@type': 'error', 'code': 500, 'message': 'not in db'}))
+    assert not is_persistent_error(asyncio.TimeoutError())
+    assert not is_persistent_error({'@type': 'error', 'code': 400, 'message': 'LITE_SERVER_NOTREADY: block is not in db'})
+    assert not is_persistent_error(None)
+    # another liteserver may have the data
+    assert not is_persistent_error(TonlibError({'@type': 'error', 'code': 500, 'message': 'LITE_SERVER_UNKNOWN: block is not in db'}))
+
+
+class Backend:
+    """
+    Cached methods of a fake TonlibManager, calls are counted.
+    """
+    def __init__(self, cache_manager, delay=0):
+        self.calls = 0
+        self.delay = delay
+        self.error = None
+        self.get_state = cache_manager.cached(expire=5)(self.get_state)
+
+    async def get_state(self, address):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return {'@type': 'raw.fullAccountState', 'address': address, 'version': self.calls}
+
+
+def make_cache_manager(server):
+    fakeredis = pytest.importorskip('fakeredis')
+    settings = RedisCacheSettings(enabled=True, redis=RedisSettings(endpoint='localhost', port=6379, timeout=1),
+                                  lock_wait=1, early_refresh_beta=0)
+    cache_manager = RedisCacheManager(settings)
+    cache_manager.cache_redis = fakeredis.aioredis.FakeRedis(server=server)
+    cache_manager.blob_store.cache_redis = cache_manager.cache_redis
+    cache_manager.release_lock_script = cache_manager.cache_redis.register_script(cache_manager.release_lock_script.script)
+    return cache_manager
+
+
+def test_concurrent_callers_share_one_computation(redis_server):
+    async def run():
+        first, second = Backend(make_cache_manager(redis_server), delay=0.2), Backend(make_cache_manager(redis_server))
+        results = await asyncio.gather(first.get_state('A'), first.get_state('A'), second.get_state('A'))
+        # the other process waits for the value computed under the lock
+        assert [result['version'] for result in results] == [1, 1, 1]
+        assert (first.calls, second.calls) == (1, 0)
+        assert (await second.get_state('A'))['version'] == 1
+
+    asyncio.run(run())
+
+
+def test_persistent_errors_are_cached(redis_server):
+    async def run():
+        backend = Backend(make_cache_manager(redis_server))
+        backend.error = TonlibError({'@type': 'error', 'code': 500, 'message': 'INVALID_ACCOUNT_ADDRESS'})
+        for _ in range(2):
+            with pytest.raises(TonlibError):
+                await backend.get_state('A')
+        assert backend.calls == 1
+
+        backend.error = LiteServerTimeout({'@type': 'error', 'code': 500, 'message': 'timeout'})
+        for _ in range(2):
+            with pytest.raises(LiteServerTimeout):
+                await backend.get_state('B')
+        assert backend.calls == 3
+
+    asyncio.run(run())
+
+
+async def expire_entry(cache_manager):
+    # the only cached entry is marked expired
+    key, = await cache_manager.cache_redis.keys('*')
+    entry = pickle.loads(await cache_manager.cache_redis.get(key))
+    await cache_manager.cache_redis.set(key, pickle.dumps(entry._replace(expires_at=time.time() - 1)))
+    return key.decode()
+
+
+def test_stale_entry_is_served_while_locked_or_on_failure(redis_server):
+    async def run():
+        cache_manager = make_cache_manager(redis_server)
+        backend = Backend(cache_manager)
+        assert (await backend.get_state('A'))['version'] == 1
+
+        # another process recomputes the entry
+        key = await expire_entry(cache_manager)
+        await cache_manager.cache_redis.set(f'lock:{key}', 'other')
+        assert (await backend.get_state('A'))['version'] == 1
+        assert backend.calls == 1
+        await cache_manager.cache_redis.delete(f'lock:{key}')
+
+        # recomputation fails
+        backend.error = LiteServerTimeout({'@type': 'error', 'code': 500, 'message': 'timeout'})
+        assert (await backend.get_state('A'))['version'] == 1
+        assert backend.calls == 2
+
+        backend.error = None
+        assert (await backend.get_state('A'))['version'] == 3
+
+    asyncio.run(run())
@@ -0,0 +1,27 @@
+import asyncio
+
+
+def test_state_of_liteserver_and_consensus_is_shared(make_tonlib, make_cluster, redis_server):
+    async def run():
+        owner = make_cluster(redis_server, make_tonlib(consensus_seqno=100, last_block=100))
+        other = make_cluster(redis_server, make_tonlib(consensus_seqno=0, last_block=-1))
+        await owner.load()
+        await owner.heartbeat()
+        await other.load()
+        await other.heartbeat()
+        assert not other.is_probing(0)
+        # the local client is not connected yet, cluster state is taken once it is
+        assert other.tonlib.workers[0]['last_block'] == -1
+        other.tonlib.workers[0]['last_block'] = 90
+        await other.heartbeat()
+        assert other.tonlib.workers[0]['last_block'] == 100
+
+        # cluster consensus is followed on every heartbeat, not only on load
+        owner.tonlib.consensus_block.seqno = 105
+        owner.tonlib.workers[0]['last_block'] = 105
+        await owner.heartbeat()
+        await other.heartbeat()
+        assert other.tonlib.consensus_block.seqno == 105
+        assert other.tonlib.workers[0]['last_block'] == 105
+
+    asyncio.run(run())
@@ -0,0 +1,55 @@
+import asyncio
+import base64
+
+from tvm_valuetypes.cell import deserialize_boc
+
+from pyTON.config import ConfigSnapshots, parse_config_params
+
+
+# key block seqno -> config params
+KEY_BLOCKS = {100: {0: 1, 34: 2}, 50: {0: 1, 34: 3}}
+
+
+def param_value(config_info):
+    cell = deserialize_boc(base64.b64decode(config_info['config']['bytes']))
+    return int(cell.data.data.to01(), 2)
+
+
+def test_config_cell_is_split_into_params(config_boc):
+    params = {0: 100, 1: 101, 15: 115, 34: 134, 71: 171, 2 ** 31 + 5: 999}
+    parsed = parse_config_params(config_boc(params))
+    assert sorted(parsed) == sorted(params)
+    for config_id, value in params.items():
+        assert parsed[config_id]['@type'] == 'configInfo'
+        assert param_value(parsed[config_id]) == value
+
+
+def test_params_are_served_from_snapshots(make_tonlib):
+    async def run():
+        tonlib = make_tonlib(consensus_seqno=105, key_blocks=KEY_BLOCKS)
+        snapshots = ConfigSnapshots(tonlib)
+        await snapshots.refresh()
+        assert snapshots.latest_key_block == 100
+        results = await asyncio.gather(*[snapshots.get_param(34) for _ in range(3)], snapshots.get_param(34, 70))
+        assert [param_value(result) for result in results] == [2, 2, 2, 3]
+        assert tonlib.calls_of('get_config_all') == [(100,), (50,)]
+        # missing params are requested from a liteserver
+        assert (await snapshots.get_param(12))['@type'] == 'error'
+        assert tonlib.calls[-1] == ('_get_config_param', 12, 100)
+
+    asyncio.run(run())
+
+
+def test_refresh_waits_for_consensus_to_move(make_tonlib):
+    async def run():
+        tonlib = make_tonlib(consensus_seqno=105, key_blocks=KEY_BLOCKS)
+        snapshots = ConfigSnapshots(tonlib)
+        await snapshots.refresh()
+        await snapshots.refresh()
+        assert tonlib.calls == [('getBlockHeader', 105), ('get_config_all', 100)]
+        tonlib.consensus_block.seqno = 106
+        await snapshots.refresh()
+        # config of the same key block is not reloaded
+        assert tonlib.calls[2:] == [('getBlockHeader', 106)]
+
+    asyncio.run(run())
@@ -0,0 +1,39 @@
+import asyncio
+
+from pyTON.indexer import RecentBlockIndexer
+from pyTON.models import TonlibTaskPriority
+from pyTON.settings import BlockIndexSettings
+
+
+def index(tonlib, max_block_transactions):
+    async def run():
+        indexer = RecentBlockIndexer(tonlib, BlockIndexSettings(enabled=True, max_block_transactions=max_block_transactions))
+        # the indexing task starts on the next iteration of the loop
+        indexer.page_size = 4
+        await asyncio.sleep(0.1)
+        await indexer.shutdown()
+        return indexer
+
+    return asyncio.run(run())
+
+
+def shard_requests(tonlib):
+    return [request for request in tonlib.calls_of('getBlockTransactionsExt') if request[0] == 0]
+
+
+def test_block_transactions_are_requested_in_pages_with_background_priority(make_tonlib, tx_hash):
+    tonlib = make_tonlib(consensus_seqno=10, block_transactions=10)
+    indexer = index(tonlib, max_block_transactions=100)
+    # the next page starts after the last transaction, by the full block id
+    assert shard_requests(tonlib) == [(0, 4, 'root', None), (0, 4, 'root', '4'), (0, 4, 'root', '8')]
+    account = tonlib.block_transactions[0]['account']
+    assert all(indexer.lookup(('hash', f'msg{lt}')) == (account, lt, tx_hash(lt)) for lt in range(1, 11))
+    assert tonlib.priorities == {TonlibTaskPriority.BACKGROUND}
+
+
+def test_block_transactions_are_capped(make_tonlib):
+    tonlib = make_tonlib(consensus_seqno=10, block_transactions=10)
+    indexer = index(tonlib, max_block_transactions=6)
+    assert shard_requests(tonlib) == [(0, 4, 'root', None), (0, 2, 'root', '4')]
+    assert indexer.lookup(('hash', 'msg6')) is not None
+    assert indexer.lookup(('hash', 'msg7')) is None
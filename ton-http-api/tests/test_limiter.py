@@ -0,0 +1,152 @@
+import asyncio
+import json
+
+import pytest
+
+from pyTON.limiter import TokenBucket, RateLimiter, RateLimitMiddleware
+from pyTON.settings import RateLimitSettings, RedisSettings
+
+
+def make_settings(**kwargs):
+    params = dict(enabled=True, rate=10, burst=20, no_key_rate=1, no_key_burst=2,
+                  method_weights={'runGetMethod': 2}, sync_interval=1, redis=None, api_keys=['key'])
+    params.update(kwargs)
+    return RateLimitSettings(**params)
+
+
+def test_bucket_starts_full_and_refills():
+    bucket = TokenBucket(rate=10, burst=20, now=0)
+    for _ in range(20):
+        assert bucket.acquire(1, now=0) == 0
+    assert bucket.acquire(1, now=0) == pytest.approx(0.1)
+    assert bucket.acquire(1, now=0.1) == 0
+    # refill is capped by burst
+    bucket.refill(now=100)
+    assert bucket.tokens == 20
+
+
+def test_bucket_returns_wait_time_for_weight():
+    bucket = TokenBucket(rate=2, burst=2, now=0)
+    assert bucket.acquire(2, now=0) == 0
+    assert bucket.acquire(3, now=0) == pytest.approx(1.5)
+    assert bucket.consumed == 2
+
+
+def test_limiter_buckets_by_key_and_client():
+    limiter = RateLimiter(make_settings())
+    assert limiter.acquire(None, '1.1.1.1', 'getAddressInformation') == 0
+    assert limiter.acquire(None, '1.1.1.1', 'getAddressInformation') == 0
+    assert limiter.acquire(None, '1.1.1.1', 'getAddressInformation') > 0
+    # other client and API keys have own buckets
+    assert limiter.acquire(None, '2.2.2.2', 'getAddressInformation') == 0
+    assert limiter.acquire('key', '1.1.1.1', 'getAddressInformation') == 0
+
+
+def test_unknown_keys_share_client_bucket():
+    limiter = RateLimiter(make_settings())
+    assert limiter.acquire('random-1', '1.1.1.1', 'getAddressInformation') == 0
+    assert limiter.acquire('random-2', '1.1.1.1', 'getAddressInformation') == 0
+    assert limiter.acquire('random-3', '1.1.1.1', 'getAddressInformation') > 0
+    assert list(limiter.buckets) == ['ip:1.1.1.1']
+
+
+def test_limiter_keeps_bounded_number_of_buckets():
+    limiter = RateLimiter(make_settings())
+    limiter.max_buckets = 3
+    for client in ['1.1.1.1', '2.2.2.2', '3.3.3.3']:
+        limiter.acquire(None, client, 'getAddressInformation')
+    limiter.acquire(None, '1.1.1.1', 'getAddressInformation')
+    limiter.acquire(None, '4.4.4.4', 'getAddressInformation')
+    # least recently used bucket is dropped
+    assert list(limiter.buckets) == ['ip:3.3.3.3', 'ip:1.1.1.1', 'ip:4.4.4.4']
+
+
+def test_limiter_charges_method_weight():
+    limiter = RateLimiter(make_settings(burst=3))
+    assert limiter.acquire('key', None, 'runGetMethod') == 0
+    assert limiter.acquire('key', None, 'runGetMethod') > 0
+    assert limiter.acquire('key', None, 'getMasterchainInfo') == 0
+
+
+def test_limiter_sync_shares_consumed_tokens():
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+
+    async def run():
+        server = fakeredis.FakeServer()
+        limiters = []
+        for _ in range(2):
+            limiter = RateLimiter(make_settings(redis=RedisSettings(endpoint='localhost', port=6379, timeout=1)))
+            limiter.redis = fakeredis.aioredis.FakeRedis(server=server)
+            limiter.sync_script = limiter.redis.register_script(limiter.sync_script.script)
+            limiters.append(limiter)
+        for _ in range(15):
+            assert limiters[0].acquire('key', None, 'getMasterchainInfo') == 0
+        await limiters[0].sync()
+        limiters[1].acquire('key', None, 'getMasterchainInfo')
+        await limiters[1].sync()
+        # the second process sees tokens taken by the first one
+        assert limiters[1].buckets['key:key'].tokens < 6
+
+    asyncio.run(run())
+
+
+async def call(middleware, scope, messages):
+    sent = []
+    received = []
+    messages = list(messages)
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    await middleware(scope, receive, send)
+    return sent
+
+
+def make_scope(path='/api/v2/getAddressInformation', headers=(), client=('10.0.0.1', 1234)):
+    return {'type': 'http', 'path': path, 'headers': list(headers), 'query_string': b'', 'client': client}
+
+
+def test_jsonrpc_body_is_replayed_and_receive_is_handed_over():
+    app_messages = []
+
+    async def app(scope, receive, send):
+        app_messages.append(await receive())
+        app_messages.append(await receive())
+
+    limiter = RateLimiter(make_settings())
+    middleware = RateLimitMiddleware(app, limiter)
+    body = json.dumps({'method': 'runGetMethod', 'params': {}}).encode()
+    server_messages = [{'type': 'http.request', 'body': body, 'more_body': False},
+                       {'type': 'http.disconnect', 'marker': True}]
+    asyncio.run(call(middleware, make_scope('/api/v2/jsonRPC'), server_messages))
+    assert app_messages[0] == {'type': 'http.request', 'body': body, 'more_body': False}
+    # the next message comes from the server, not a synthesized disconnect
+    assert app_messages[1].get('marker') is True
+    assert limiter.buckets['ip:10.0.0.1'].consumed == 2
+
+
+def test_request_over_limit_is_rejected():
+    async def app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+
+    middleware = RateLimitMiddleware(app, RateLimiter(make_settings(no_key_burst=1)))
+    assert asyncio.run(call(middleware, make_scope(), []))[0]['status'] == 200
+    sent = asyncio.run(call(middleware, make_scope(), []))
+    assert sent[0]['status'] == 429
+    assert (b'retry-after', b'1') in sent[0]['headers']
+
+
+def test_forwarded_client_is_used_only_behind_trusted_proxy():
+    limiter = RateLimiter(make_settings(trusted_proxies=['10.0.0.0/8']))
+    middleware = RateLimitMiddleware(None, limiter)
+    headers = [(b'x-forwarded-for', b'6.6.6.6, 1.2.3.4, 10.0.0.2')]
+    assert middleware.client_address(make_scope(headers=headers)) == '1.2.3.4'
+    assert middleware.client_address(make_scope(headers=headers, client=('5.5.5.5', 1))) == '5.5.5.5'
+    assert middleware.client_address(make_scope()) == '10.0.0.1'
+
+    untrusted = RateLimitMiddleware(None, RateLimiter(make_settings()))
+    assert untrusted.client_address(make_scope(headers=headers)) == '10.0.0.1'
@@ -0,0 +1,89 @@
+import asyncio
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def test_reload_spawns_added_and_drains_removed_liteservers(make_manager, liteserver):
+    async def run():
+        manager = make_manager([liteserver(0), liteserver(1)])
+        manager.loop = asyncio.get_running_loop()
+        manager.update_liteservers({'liteservers': [liteserver(1), liteserver(2)]})
+        await asyncio.sleep(0)
+        # indices of known liteservers are stable, new ones are appended
+        assert manager.liteservers == [liteserver(0), liteserver(1), liteserver(2)]
+        assert manager.spawned == [[2]]
+        assert manager.drained == [0]
+        assert manager.tonlib_settings.liteserver_config['liteservers'] == manager.liteservers
+
+        # unchanged config does nothing
+        manager.workers[0]['is_draining'] = True
+        manager.workers[2] = {'is_draining': False}
+        manager.update_liteservers({'liteservers': [liteserver(1), liteserver(2)]})
+        await asyncio.sleep(0)
+        assert manager.spawned == [[2]]
+        assert manager.drained == [0]
+
+        # a liteserver returning after removal gets a new index
+        manager.update_liteservers({'liteservers': [liteserver(0), liteserver(1), liteserver(2)]})
+        assert manager.spawned == [[2], [3]]
+        assert manager.liteservers[3] == liteserver(0)
+
+    asyncio.run(run())
+
+
+class StuckProcess:
+    """
+    Worker process which doesn't exit until it's killed.
+    """
+    def __init__(self):
+        self.ls_indices = [0]
+        self.exit_event = threading.Event()
+        self.killed = threading.Event()
+        self.shm_prefix = 'tonapi_test_'
+
+    def join(self, timeout=None):
+        self.killed.wait(timeout)
+
+    def is_alive(self):
+        return not self.killed.is_set()
+
+    def kill(self):
+        self.killed.set()
+
+
+def test_stuck_worker_is_killed_without_blocking_event_loop(make_manager, liteserver):
+    async def run():
+        manager = make_manager([liteserver(0)])
+        manager.loop = asyncio.get_running_loop()
+        manager.threadpool_executor = ThreadPoolExecutor(max_workers=2)
+        manager.worker_join_timeout = 0.3
+        worker = StuckProcess()
+        async def read_results():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                return
+        manager.workers[0] = {'worker': worker, 'reader': asyncio.ensure_future(read_results()), 'is_enabled': True}
+        await asyncio.sleep(0)
+        worker.input_queue = worker.output_queue = type('FakeQueue', (), {'cancel_join_thread': lambda self: None, 'close': lambda self: None})()
+
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(time.time())
+                await asyncio.sleep(0.05)
+        ticker = asyncio.ensure_future(tick())
+        started_at = time.time()
+        await manager.worker_control(0, enabled=False)
+        ticker.cancel()
+        assert worker.killed.is_set()
+        assert time.time() - started_at < 1
+        assert manager.workers[0]['is_enabled'] is False
+        # the loop kept running while the process was joined
+        assert len(ticks) >= 4
+        manager.threadpool_executor.shutdown()
+
+    asyncio.run(run())
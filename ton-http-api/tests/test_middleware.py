@@ -0,0 +1,152 @@
+import asyncio
+import gzip
+
+from pyTON.middleware import CancelOnDisconnectMiddleware, CompressionMiddleware
+from pyTON.settings import CompressionSettings
+
+
+def make_middleware(app=None, encoders=('gzip', 'br', 'zstd'), **kwargs):
+    middleware = CompressionMiddleware(app, CompressionSettings(enabled=True, **kwargs))
+    # optional encoders are replaced by stubs, so negotiation doesn't depend on installed packages
+    for encoding in ('br', 'zstd'):
+        if encoding in encoders:
+            middleware.encoders[encoding] = lambda body, encoding=encoding: encoding.encode() + body
+        else:
+            middleware.encoders.pop(encoding, None)
+    return middleware
+
+
+def test_best_available_encoding_is_selected():
+    middleware = make_middleware()
+    assert middleware.select_encoding('gzip, deflate, br, zstd') == 'zstd'
+    assert middleware.select_encoding('gzip, br') == 'br'
+    assert middleware.select_encoding('deflate') is None
+    assert make_middleware(encoders=('gzip',)).select_encoding('gzip, br, zstd') == 'gzip'
+
+
+def test_quality_values_are_respected():
+    middleware = make_middleware()
+    assert middleware.select_encoding('zstd;q=0.5, br;q=0.8, gzip;q=0.9') == 'gzip'
+    assert middleware.select_encoding('zstd;q=0, br;q=0, gzip') == 'gzip'
+    assert middleware.select_encoding('gzip;q=0') is None
+    assert middleware.select_encoding('gzip;q=bad, Br') == 'br'
+    # wildcard covers encodings not listed
+    assert middleware.select_encoding('*') == 'zstd'
+    assert middleware.select_encoding('*;q=0.1, br;q=0.5, zstd;q=0') == 'br'
+
+
+async def call(middleware, accept_encoding=None):
+    scope = {'type': 'http', 'path': '/api/v2/getMasterchainInfo', 'headers': []}
+    if accept_encoding is not None:
+        scope['headers'].append((b'accept-encoding', accept_encoding.encode()))
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    await middleware(scope, None, send)
+    return dict(sent[0]['headers']), b''.join(message.get('body', b'') for message in sent[1:])
+
+
+def make_app(body, headers=(), chunk_size=None):
+    async def app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())] + list(headers)})
+        chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)] if chunk_size else [body]
+        for i, chunk in enumerate(chunks):
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': i + 1 < len(chunks)})
+    return app
+
+
+def test_large_response_is_compressed():
+    body = b'{"ok": true, "result": "' + b'x' * 4096 + b'"}'
+    headers, data = asyncio.run(call(make_middleware(make_app(body, chunk_size=1000), min_size=1024), 'gzip'))
+    assert headers[b'content-encoding'] == b'gzip'
+    assert headers[b'content-length'] == str(len(data)).encode()
+    assert headers[b'vary'] == b'Accept-Encoding'
+    assert gzip.decompress(data) == body
+
+
+def test_large_response_is_compressed_in_thread_pool():
+    body = b'x' * 4096
+    headers, data = asyncio.run(call(make_middleware(make_app(body), min_size=1024, thread_min_size=2048), 'zstd'))
+    assert headers[b'content-encoding'] == b'zstd'
+    assert data == b'zstd' + body
+
+
+def test_small_or_encoded_responses_are_sent_as_is():
+    body = b'{"ok": true}'
+    headers, data = asyncio.run(call(make_middleware(make_app(body), min_size=1024), 'gzip'))
+    assert b'content-encoding' not in headers
+    assert data == body
+
+    large = b'x' * 4096
+    headers, data = asyncio.run(call(make_middleware(make_app(large, headers=[(b'content-encoding', b'br')]), min_size=1024), 'gzip'))
+    assert headers[b'content-encoding'] == b'br'
+    assert data == large
+
+    headers, data = asyncio.run(call(make_middleware(make_app(large), min_size=1024)))
+    assert b'content-encoding' not in headers
+    assert data == large
+
+
+class FakeServer:
+    """
+    Connection which reports disconnect after the response is sent or when the client goes away.
+    """
+    def __init__(self):
+        self.sent = []
+        self.closed = asyncio.Event()
+        self.request_sent = False
+
+    async def receive(self):
+        if not self.request_sent:
+            self.request_sent = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await self.closed.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(self, message):
+        self.sent.append(message)
+        if message['type'] == 'http.response.body' and not message.get('more_body', False):
+            self.closed.set()
+
+
+def test_background_task_runs_after_completed_response():
+    background_done = []
+
+    async def app(scope, receive, send):
+        await receive()
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'ok'})
+        # background task of the response, runs after the body is sent
+        await asyncio.sleep(0.05)
+        background_done.append(True)
+
+    async def run():
+        server = FakeServer()
+        await CancelOnDisconnectMiddleware(app)({'type': 'http', 'path': '/'}, server.receive, server.send)
+        assert server.sent[-1]['body'] == b'ok'
+
+    asyncio.run(run())
+    assert background_done == [True]
+
+
+def test_request_is_cancelled_when_client_disconnects():
+    cancelled = []
+
+    async def app(scope, receive, send):
+        await receive()
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def run():
+        server = FakeServer()
+        asyncio.get_running_loop().call_later(0.05, server.closed.set)
+        await CancelOnDisconnectMiddleware(app)({'type': 'http', 'path': '/'}, server.receive, server.send)
+
+    asyncio.run(run())
+    assert cancelled == [True]
@@ -0,0 +1,99 @@
+import asyncio
+import time
+
+import pytest
+
+from pyTON.retry import RetryEngine, LIGHT_POLICY, STATE_POLICY
+from pyTON.settings import RetrySettings
+
+from pytonlib import TonlibError
+from pytonlib.tonlibjson import LiteServerTimeout
+
+
+def timeout_error():
+    return LiteServerTimeout({'@type': 'error', 'code': 500, 'message': 'timeout'})
+
+
+def not_in_db_error():
+    return TonlibError({'@type': 'error', 'code': 500, 'message': 'LITE_SERVER_UNKNOWN: state not in db'})
+
+
+def test_hung_attempt_gets_its_share_of_deadline_and_is_not_cancelled(make_tonlib, run_engine):
+    assert LIGHT_POLICY.attempts == 2
+    tonlib = make_tonlib(answers={0: (0.8, 'slow'), 2: (0, 'fast')})
+    result, elapsed = run_engine(tonlib, deadline=1.0)
+    assert result == 'fast'
+    # the retry starts after half of the deadline
+    assert 0.45 < tonlib.started[2] - tonlib.started[0] < 0.7
+    assert elapsed < 0.8
+    assert tonlib.cancelled == set()
+    assert tonlib.finished == {0, 2}
+
+
+def test_overdue_attempt_answering_first_wins(make_tonlib, run_engine):
+    tonlib = make_tonlib(answers={0: (0.6, 'late'), 2: (0.5, 'retry')})
+    result, elapsed = run_engine(tonlib, deadline=1.0)
+    assert result == 'late'
+    assert 2 in tonlib.started
+    assert elapsed < 0.8
+
+
+def test_timeouts_are_retried_and_last_error_is_raised(make_tonlib, run_engine):
+    tonlib = make_tonlib(answers={0: (0, timeout_error()), 2: (0, timeout_error()), 4: (0, 'unused')})
+    with pytest.raises(LiteServerTimeout):
+        run_engine(tonlib)
+    # a single retry is allowed by the policy
+    assert sorted(tonlib.started) == [0, 2]
+
+
+def test_errors_are_retried_on_archival_liteserver_only(make_tonlib, run_engine):
+    tonlib = make_tonlib(answers={0: (0, not_in_db_error()), 1: (0, 'archival'), 2: (0, 'unused')})
+    assert STATE_POLICY.archival_fallback
+    result, _ = run_engine(tonlib, method='raw_get_account_state')
+    assert result == 'archival'
+    assert sorted(tonlib.started) == [0, 1]
+
+    # the same liteserver answer is expected from another non-archival liteserver
+    tonlib = make_tonlib(answers={0: (0, not_in_db_error()), 2: (0, 'unused')})
+    with pytest.raises(TonlibError):
+        run_engine(tonlib, method='get_masterchain_info')
+    assert sorted(tonlib.started) == [0]
+
+
+def test_race_starts_archival_attempt_next_to_slow_one(make_tonlib, run_engine):
+    tonlib = make_tonlib(answers={0: (0.5, 'slow'), 1: (0, 'archival')})
+    settings = RetrySettings(race_after=0.1, backoff=0.01, max_backoff=0.01)
+    result, elapsed = run_engine(tonlib, method='raw_get_account_state', deadline=2.0, settings=settings)
+    assert result == 'archival'
+    assert 0.05 < tonlib.started[1] - tonlib.started[0] < 0.3
+    assert tonlib.cancelled == set()
+
+
+def test_retries_are_disabled(make_tonlib, run_engine):
+    tonlib = make_tonlib(answers={0: (0, timeout_error()), 2: (0, 'unused')})
+    with pytest.raises(LiteServerTimeout):
+        run_engine(tonlib, settings=RetrySettings(enabled=False))
+    assert sorted(tonlib.started) == [0]
+
+
+def test_backoff_grows_exponentially_up_to_limit(monkeypatch):
+    monkeypatch.setattr('random.uniform', lambda a, b: 1)
+    engine = RetryEngine(None, RetrySettings(backoff=0.05, max_backoff=0.5))
+    assert [engine.backoff(retry) for retry in range(1, 6)] == pytest.approx([0.05, 0.1, 0.2, 0.4, 0.5])
+    monkeypatch.setattr('random.uniform', lambda a, b: a)
+    assert engine.backoff(1) == pytest.approx(0.025)
+
+
+def test_cancelled_request_cancels_its_attempts(make_tonlib):
+    async def run():
+        tonlib = make_tonlib(answers={0: (1, 'slow')})
+        engine = RetryEngine(tonlib, RetrySettings())
+        task = asyncio.ensure_future(engine.run('get_masterchain_info', False, time.time() + 2, (), {}))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0)
+        assert tonlib.cancelled == {0}
+
+    asyncio.run(run())
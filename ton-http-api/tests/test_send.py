@@ -0,0 +1,28 @@
+import asyncio
+
+from pyTON.send import ResendScheduler
+from pyTON.settings import SendSettings
+
+
+def test_sends_over_resend_limit_are_bounded(make_tonlib):
+    async def run():
+        # sends hang until released, so they stay in flight
+        tonlib = make_tonlib()
+        scheduler = ResendScheduler(tonlib, SendSettings(max_resend_messages=0))
+        scheduler.max_send_once_tasks = 3
+        for i in range(5):
+            scheduler.schedule(f'message {i}'.encode())
+        await asyncio.sleep(0)
+        # messages over the limit of in-flight sends are dropped
+        assert tonlib.calls_of('raw_send_message') == [(b'message 0',), (b'message 1',), (b'message 2',)]
+        assert len(scheduler.send_once_tasks) == 3
+
+        tonlib.released.set()
+        await asyncio.sleep(0.01)
+        assert scheduler.send_once_tasks == set()
+        scheduler.schedule(b'message 5')
+        await asyncio.sleep(0)
+        assert tonlib.calls_of('raw_send_message')[-1] == (b'message 5',)
+        await scheduler.shutdown()
+
+    asyncio.run(run())
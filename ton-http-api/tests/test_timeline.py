@@ -0,0 +1,88 @@
+import asyncio
+import base64
+
+from pyTON.settings import TimelineSettings
+from pyTON.timeline import MasterchainTimeline
+
+
+def test_lookup_by_unixtime_returns_first_block_after_it(make_timeline):
+    timeline = make_timeline(10, 20)
+    # block 12 is generated at 1060, block 13 at 1065
+    assert timeline.lookup(unixtime=1062)['seqno'] == 13
+    assert timeline.lookup(unixtime=1062)['root_hash'] == base64.b64encode((13).to_bytes(32, 'big')).decode()
+
+
+def test_lookup_by_lt_returns_block_containing_it(make_timeline):
+    timeline = make_timeline(10, 20)
+    assert timeline.lookup(lt=1205)['seqno'] == 12
+    # lt between blocks belongs to the next one
+    assert timeline.lookup(lt=1250)['seqno'] == 13
+
+
+def test_lookup_leaves_boundaries_to_liteservers(make_timeline):
+    timeline = make_timeline(10, 20)
+    assert timeline.lookup(unixtime=1060) is None
+    assert timeline.lookup(lt=1210) is None
+    # the answer may be after the last indexed block
+    assert timeline.lookup(unixtime=1101) is None
+    assert timeline.lookup(lt=2011) is None
+    # ambiguous and empty queries
+    assert timeline.lookup(lt=1205, unixtime=1062) is None
+    assert timeline.lookup() is None
+
+
+def test_empty_timeline_answers_nothing(make_tonlib):
+    timeline = MasterchainTimeline(make_tonlib(), TimelineSettings())
+    assert timeline.lookup(unixtime=1062) is None
+    assert timeline.backfill_task is None
+
+
+def test_lookup_below_index_backfills_down_to_the_block(make_timeline):
+    async def run():
+        timeline = make_timeline(500, 510)
+        timeline.backfill_chunk = 16
+        assert timeline.lookup(unixtime=1000 + 5 * 450 + 1) is None
+        await timeline.backfill_task
+        # backfill stops at the first chunk covering the block
+        assert 450 >= timeline.first_seqno > 450 - 16
+        assert timeline.lookup(unixtime=1000 + 5 * 450 + 1)['seqno'] == 451
+        assert timeline.backfill_utime is None
+
+    asyncio.run(run())
+
+
+def test_backfill_is_bounded_by_backfill_blocks(make_timeline):
+    async def run():
+        timeline = make_timeline(500, 510, backfill_blocks=100)
+        assert timeline.lookup(lt=100) is None
+        await timeline.backfill_task
+        assert timeline.first_seqno == 411
+        assert len(timeline) == 100
+        # nothing to backfill within the limit
+        timeline.lookup(lt=100)
+        assert timeline.backfill_task.done()
+
+    asyncio.run(run())
+
+
+def test_follow_catches_up_in_chunks_without_dropping_index(make_timeline):
+    async def run():
+        timeline = make_timeline(100, 110)
+        timeline.tonlib.consensus_block.seqno = 110 + 150
+        await timeline.follow()
+        assert (timeline.first_seqno, timeline.last_seqno) == (100, 110 + timeline.max_catch_up_blocks)
+        await timeline.follow()
+        await timeline.follow()
+        assert (timeline.first_seqno, timeline.last_seqno) == (100, 260)
+
+    asyncio.run(run())
+
+
+def test_follow_restarts_from_tip_after_long_stall(make_timeline):
+    async def run():
+        timeline = make_timeline(100, 110, backfill_blocks=1000)
+        timeline.tonlib.consensus_block.seqno = 5000
+        await timeline.follow()
+        assert (timeline.first_seqno, timeline.last_seqno) == (5000, 5000)
+
+    asyncio.run(run())
@@ -0,0 +1,89 @@
+import asyncio
+
+from pyTON.manager import TonlibManager
+from pyTON.settings import TransactionCacheSettings
+from pyTON.transactions import TransactionCache
+
+
+def lts(transactions):
+    return [int(tx['transaction_id']['lt']) for tx in transactions]
+
+
+def test_cached_page_is_served_without_fetch(make_tonlib, tx_hash):
+    async def run():
+        tonlib = make_tonlib(last_lt=500)
+        cache = TransactionCache(tonlib)
+        assert lts(await cache.get_transactions('A', limit=5)) == [500, 490, 480, 470, 460]
+        assert lts(await cache.get_transactions('A', 480, tx_hash(480), limit=3)) == [480, 470, 460]
+        assert tonlib.calls_of('_get_transactions') == [(500, 0, 6)]
+
+    asyncio.run(run())
+
+
+def test_only_missing_parts_of_history_are_fetched(make_tonlib, tx_hash):
+    async def run():
+        tonlib = make_tonlib(last_lt=500)
+        cache = TransactionCache(tonlib)
+        await cache.get_transactions('A', limit=5)
+        # the next page continues below the cached bottom
+        assert lts(await cache.get_transactions('A', 450, tx_hash(450), limit=5)) == [450, 440, 430, 420, 410]
+        assert tonlib.calls_of('_get_transactions')[-1] == (450, 0, 6)
+        # new transactions are fetched down to the cached top only
+        tonlib.last_lt = 520
+        assert lts(await cache.get_transactions('A', limit=5)) == [520, 510, 500, 490, 480]
+        assert tonlib.calls_of('_get_transactions')[-1] == (520, 500, 6)
+        # cached pages are joined
+        assert lts(await cache.get_transactions('A', limit=12)) == list(range(520, 400, -10))
+        assert len(tonlib.calls_of('_get_transactions')) == 3
+
+
+def test_gap_between_cached_pages_is_fetched_down_to_next_cached_transaction(make_tonlib, tx_hash):
+    async def run():
+        tonlib = make_tonlib(last_lt=500)
+        cache = TransactionCache(tonlib)
+        await cache.get_transactions('A', 300, tx_hash(300), limit=3)
+        await cache.get_transactions('A', limit=3)
+        assert tonlib.calls_of('_get_transactions') == [(300, 0, 4), (500, 300, 4)]
+        assert lts(await cache.get_transactions('A', limit=30)) == list(range(500, 200, -10))
+        # the gap is fetched from the bottom of the upper page down to the top of the lower one
+        assert tonlib.calls_of('_get_transactions')[2] == (470, 300, 28)
+
+    asyncio.run(run())
+
+
+def test_history_ends_at_first_transaction_and_to_lt(make_tonlib, tx_hash):
+    async def run():
+        tonlib = make_tonlib(last_lt=30)
+        cache = TransactionCache(tonlib)
+        assert lts(await cache.get_transactions('A', limit=10)) == [30, 20, 10]
+        assert lts(await cache.get_transactions('A', limit=10)) == [30, 20, 10]
+        assert lts(await cache.get_transactions('A', to_transaction_lt=10, limit=10)) == [30, 20]
+        assert len(tonlib.calls_of('_get_transactions')) == 1
+
+    asyncio.run(run())
+
+
+def test_least_recent_accounts_are_evicted(make_tonlib, tx_hash):
+    async def run():
+        tonlib = make_tonlib(last_lt=500)
+        cache = TransactionCache(tonlib, TransactionCacheSettings(max_transactions=12))
+        for account in 'ABC':
+            await cache.get_transactions(account, limit=5)
+        assert list(cache.accounts) == [('B', True), ('C', True)]
+        assert cache.size == 12
+
+    asyncio.run(run())
+
+
+def test_transactions_are_fetched_directly_if_cache_is_disabled(make_tonlib, tx_hash):
+    async def run():
+        tonlib = make_tonlib(last_lt=500)
+        manager = TonlibManager.__new__(TonlibManager)
+        manager.transaction_cache = None
+        manager._account_version = tonlib._account_version
+        manager._get_transactions = tonlib._get_transactions
+        assert lts(await manager.get_transactions('A', limit=5)) == [500, 490, 480, 470, 460]
+        assert lts(await manager.get_transactions('A', 480, tx_hash(480), limit=3)) == [480, 470, 460]
+        assert tonlib.calls_of('_get_transactions') == [(500, 0, 5), (480, 0, 3)]
+
+    asyncio.run(run())
@@ -0,0 +1,204 @@
+import asyncio
+import os
+import pickle
+import queue
+import time
+
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pyTON.manager import TonlibManager
+from pyTON.models import SharedMemoryResult, PickledResult, TonlibTaskPriority
+from pyTON.settings import TonlibSettings
+from pyTON.worker import TonlibWorker, FairTaskQueue, release_shared_memory
+from pytonlib import TonlibException
+from pytonlib.tonlibjson import TonLib
+
+
+def make_settings(**kwargs):
+    settings = TonlibSettings(parallel_requests_per_liteserver=4, keystore='/tmp/ton_keystore/', liteserver_config_path='',
+                              cdll_path=None, request_timeout=10, verbosity_level=0, **kwargs)
+    settings.liteserver_config = {'liteservers': []}
+    return settings
+
+
+def shm_names(prefix):
+    return [name for name in os.listdir('/dev/shm') if name.startswith(prefix)]
+
+
+def test_small_result_is_pickled_once():
+    worker = TonlibWorker([0], make_settings(shared_memory_threshold=1024))
+    packed = worker.pack_result({'@type': 'ok'})
+    assert isinstance(packed, PickledResult)
+    assert pickle.loads(packed.data) == {'@type': 'ok'}
+
+
+def test_result_is_passed_as_is_without_threshold():
+    worker = TonlibWorker([0], make_settings(shared_memory_threshold=0))
+    assert worker.pack_result({'@type': 'ok'}) == {'@type': 'ok'}
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='POSIX shared memory is not available')
+def test_large_result_goes_through_shared_memory():
+    worker = TonlibWorker([0], make_settings(shared_memory_threshold=1024))
+    result = {'@type': 'ok', 'data': 'x' * 4096}
+    packed = worker.pack_result(result)
+    assert isinstance(packed, SharedMemoryResult)
+    assert TonlibManager.load_shared_memory_result(packed) == result
+    assert shm_names(worker.shm_prefix) == []
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='POSIX shared memory is not available')
+def test_unread_segments_are_released():
+    worker = TonlibWorker([0], make_settings(shared_memory_threshold=1024))
+    for _ in range(3):
+        worker.pack_result({'data': 'x' * 4096})
+    assert len(shm_names(worker.shm_prefix)) == 3
+    release_shared_memory(worker.shm_prefix)
+    assert shm_names(worker.shm_prefix) == []
+
+
+def start(task_queue):
+    # pops the next task and marks it running as TonlibWorker.start_tasks does
+    next_task = task_queue.pop()
+    if next_task is not None:
+        task_queue.running[next_task[0]] += 1
+    return next_task
+
+
+def test_fair_queue_keeps_order_within_lane():
+    task_queue = FairTaskQueue(limit=100)
+    for i in range(5):
+        task_queue.push(TonlibTaskPriority.LIGHT, 1, i)
+    assert [task_queue.pop()[1] for _ in range(5)] == list(range(5))
+    assert task_queue.pop() is None
+
+
+def test_fair_queue_shares_slots_by_weight():
+    task_queue = FairTaskQueue(limit=1000)
+    for i in range(50):
+        task_queue.push(TonlibTaskPriority.HEAVY, 1, ('heavy', i))
+        task_queue.push(TonlibTaskPriority.LIGHT, 1, ('light', i))
+    first = [task_queue.pop()[1][0] for _ in range(25)]
+    # light lane weighs 4 times more than heavy one
+    assert first.count('light') == 20
+    assert first.count('heavy') == 5
+
+
+def test_fair_queue_prefers_sends_and_cheap_tasks():
+    task_queue = FairTaskQueue(limit=100)
+    task_queue.push(TonlibTaskPriority.HEAVY, 4, 'heavy')
+    task_queue.push(TonlibTaskPriority.BACKGROUND, 1, 'background')
+    task_queue.push(TonlibTaskPriority.LIGHT, 1, 'light')
+    task_queue.push(TonlibTaskPriority.SEND, 1, 'send')
+    assert [task_queue.pop()[1] for _ in range(4)] == ['send', 'light', 'background', 'heavy']
+
+
+def test_fair_queue_limits_share_of_heavy_and_background_tasks():
+    task_queue = FairTaskQueue(limit=4)
+    for i in range(4):
+        task_queue.push(TonlibTaskPriority.HEAVY, 1, ('heavy', i))
+        task_queue.push(TonlibTaskPriority.BACKGROUND, 1, ('background', i))
+    started = [start(task_queue)[1][0] for _ in range(3)]
+    assert sorted(started) == ['background', 'heavy', 'heavy']
+    # heavy lane holds half of the slots and background a quarter, the rest is kept for light tasks
+    assert start(task_queue) is None
+    task_queue.push(TonlibTaskPriority.LIGHT, 1, ('light', 0))
+    assert start(task_queue)[1] == ('light', 0)
+    # all slots are taken
+    task_queue.push(TonlibTaskPriority.SEND, 1, ('send', 0))
+    assert start(task_queue) is None
+    task_queue.running[TonlibTaskPriority.LIGHT] -= 1
+    assert start(task_queue)[1] == ('send', 0)
+
+
+class FakeTonlibClient:
+    """
+    Client whose calls go through pytonlib futures map, tonlib never answers.
+    """
+    def __init__(self, loop):
+        self.tonlib_wrapper = TonLib.__new__(TonLib)
+        self.tonlib_wrapper.loop = loop
+        self.tonlib_wrapper.ls_index = 0
+        self.tonlib_wrapper.futures = {}
+        self.tonlib_wrapper._state = None
+        self.tonlib_wrapper.send = lambda query: None
+        self.tonlib_wrapper._client = None
+        self.tonlib_wrapper._tonlib_json_client_destroy = lambda client: None
+
+    async def get_masterchain_info(self):
+        return await self.tonlib_wrapper.execute({'@type': 'blocks.getMasterchainInfo'}, timeout=0.2)
+
+
+def make_worker(loop):
+    worker = TonlibWorker([0], make_settings())
+    worker.loop = loop
+    worker.threadpool_executor = ThreadPoolExecutor(max_workers=1)
+    worker.output_queue = queue.Queue()
+    worker.tonlib[0] = FakeTonlibClient(loop)
+    return worker
+
+
+def test_cancelled_task_keeps_tonlib_futures_consistent():
+    async def run():
+        worker = make_worker(asyncio.get_running_loop())
+        wrapper = worker.tonlib[0].tonlib_wrapper
+        worker.schedule_task(('task', 0, time.time() + 5, 'get_masterchain_info', (), {}, TonlibTaskPriority.LIGHT, 1))
+        await asyncio.sleep(0.05)
+        assert len(wrapper.futures) == 1
+        worker.cancel_task('task')
+        await asyncio.sleep(0.05)
+        # the slot is released while the tonlib call is still pending
+        assert worker.task_queues[0].running[TonlibTaskPriority.LIGHT] == 0
+        await asyncio.sleep(0.2)
+        wrapper.cancel_futures()
+        await asyncio.sleep(0)
+        assert wrapper.futures == {}
+        worker.threadpool_executor.shutdown()
+
+    asyncio.run(run())
+
+
+def test_task_after_deadline_keeps_tonlib_futures_consistent():
+    async def run():
+        worker = make_worker(asyncio.get_running_loop())
+        wrapper = worker.tonlib[0].tonlib_wrapper
+        worker.schedule_task(('task', 0, time.time() + 0.05, 'get_masterchain_info', (), {}, TonlibTaskPriority.LIGHT, 1))
+        await asyncio.sleep(0.3)
+        _, result = worker.output_queue.get_nowait()
+        assert isinstance(result.exception, asyncio.TimeoutError)
+        wrapper.cancel_futures()
+        await asyncio.sleep(0)
+        assert wrapper.futures == {}
+        worker.threadpool_executor.shutdown()
+
+    asyncio.run(run())
+
+
+class FlakyTonlibClient:
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    async def get_masterchain_info(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise TonlibException('liteserver is not ready')
+        return {'last': {'seqno': 100}}
+
+
+def test_last_block_is_probed_until_client_is_connected():
+    async def run():
+        worker = make_worker(asyncio.get_running_loop())
+        worker.tonlib[0] = FlakyTonlibClient(failures=1)
+        # the liteserver is probed by another instance
+        worker.probing[0] = False
+        task = asyncio.ensure_future(worker.report_last_block(0))
+        await asyncio.sleep(2.5)
+        task.cancel()
+        assert worker.tonlib[0].calls == 2
+        assert worker.last_block[0] == 100
+        worker.threadpool_executor.shutdown()
+
+    asyncio.run(run())